@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Run the pipeline benchmarks on synthetic inputs, comparing with baseline results
+
+The stored baseline, benchmarks/baseline.json, has the results of every
+benchmark for '-n 100000' (single-threaded), so
+
+    benchmark.py -n 100000
+
+runs them all and fails if the outputs (row counts and checksums) differ
+or the timings or memory use regress by more than the tolerance.  The
+timings are from one machine: elsewhere, save a baseline of your own from
+an unchanged checkout ('-b mine.json --save') and compare with that.
+The outputs depend only on the random seeds, so the row counts and
+checksums stored should hold anywhere.
+"""
+
+import os
+import sys
+import inspect
+from argparse import ArgumentParser
+from hsc.benchmark import BENCHMARKS, compareResults, readBaselines, writeBaselines
+
+BASELINE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "baseline.json")
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("name", nargs="*", help="Benchmarks to run (default: all)")
+    parser.add_argument("-n", "--rows", dest="num", type=int, nargs="+", default=[1000000],
+                        help="Number(s) of rows")
+    parser.add_argument("-j", dest="threads", type=int, default=0,
+                        help="Number of threads, for the benchmarks that use them")
+    parser.add_argument("-b", "--baseline", default=BASELINE, help="File of baseline results to compare with")
+    parser.add_argument("--save", action="store_true", default=False,
+                        help="Save the results as the baseline, rather than comparing")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Fraction by which timings and memory use may exceed the baseline")
+    args = parser.parse_args()
+
+    baselines = readBaselines(args.baseline)
+    regressions = []
+    for name in args.name if args.name else sorted(BENCHMARKS):
+        func = BENCHMARKS[name]
+        kwargs = dict(threads=args.threads) if "threads" in inspect.getargspec(func).args else {}
+        for num in args.num:
+            results = func(num=num, **kwargs)
+            for key, value in sorted(results.items()):
+                print "%s %d %s: %s" % (name, num, key, ("%.3f" % value) if isinstance(value, float) else value)
+            if args.save:
+                baselines.setdefault(name, {})[str(num)] = results
+            elif str(num) in baselines.get(name, {}):
+                regressions += ["%s %d %s" % (name, num, r) for r in
+                                compareResults(results, baselines[name][str(num)], args.tolerance)]
+
+    if args.save:
+        writeBaselines(args.baseline, baselines)
+        print "Saved baselines as %s" % args.baseline
+    elif regressions:
+        print "Regressions from the baseline:"
+        for line in regressions:
+            print "    " + line
+        sys.exit(1)
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+#
+# Convert catalogs (e.g., PSPS or SDSS sweep FITS files) to Parquet, so that
+# reprocessing reads only the columns and row groups it needs.
+#
+
+import os
+from argparse import ArgumentParser
+from hsc.catalogIO import convertCatalog
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("input", nargs="+", help="Input catalogs")
+    parser.add_argument("-o", "--outdir", default=".", help="Output directory")
+    parser.add_argument("-c", "--columns", nargs="*", help="Columns to keep (default: all)")
+    parser.add_argument("-n", "--rows", type=int, default=100000, help="Rows per row group")
+    args = parser.parse_args()
+
+    for inName in args.input:
+        outName = os.path.join(args.outdir, os.path.splitext(os.path.basename(inName))[0] + ".parquet")
+        num = convertCatalog(inName, outName, columns=args.columns, chunkRows=args.rows)
+        print "Wrote %d rows as %s" % (num, outName)
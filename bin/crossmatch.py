@@ -0,0 +1,3 @@
+#!/usr/bin/env python
+from hsc.crossmatch import CrossMatch
+CrossMatch.parseAndRun()
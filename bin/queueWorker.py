@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+from hsc.workQueue import runWorker
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Run tasks from a work queue (e.g., ps1dbToAnd.py --queue)")
+    parser.add_argument("queue", help="Work queue directory, shared with the coordinator")
+    parser.add_argument("--no-wait", dest="wait", action="store_false", default=True,
+                        help="Don't wait for the coordinator to create the queue")
+    args = parser.parse_args()
+    runWorker(args.queue, wait=args.wait)
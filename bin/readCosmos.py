@@ -1,43 +1,47 @@
 #!/usr/bin/env python
 
 from argparse import ArgumentParser
-import asciitable
 import numpy
-import pyfits
 from collections import OrderedDict
 
+from hsc.fixedWidth import readFixedWidth
+from hsc.fitsTable import MemmapTableWriter
+
 FILTERS = "uBVgriz"
-MAPPING = OrderedDict()
-MAPPING['ID'] = pyfits.Column(name="id", format="K")
-MAPPING['RA'] = pyfits.Column(name="ra", format="D")
-MAPPING['DEC'] = pyfits.Column(name="dec", format="D")
-MAPPING['star'] = pyfits.Column(name="starnotgal", format="L")
+MAPPING = OrderedDict() # Input column name --> (output column name, FITS format, numpy type)
+MAPPING['ID'] = ("id", "K", numpy.int64)
+MAPPING['RA'] = ("ra", "D", numpy.float64)
+MAPPING['DEC'] = ("dec", "D", numpy.float64)
+MAPPING['star'] = ("starnotgal", "L", numpy.bool_)
 for f in FILTERS:
-    MAPPING[f + '_mag'] = pyfits.Column(name=f, format="E")
-    MAPPING[f + '_mag_err'] = pyfits.Column(name=f + "_err", format="E")
-
-
-def convertCosmos(inName, outName):
-    inFile = open(inName, "r")
-    table = asciitable.read(inFile, Reader=asciitable.FixedWidthTwoLine, delimiter='|', header_start=0,
-                            data_start=4, data_end=-1)
-
-    schema = pyfits.ColDefs([column for column in MAPPING.values()])
-    outHdu = pyfits.new_table(schema, nrows=len(table))
-    outData = outHdu.data
-
-    for name, column in MAPPING.items():
-        outData.field(column.name)[:] = table.field(name)
-
-    for f in FILTERS:
-        mag = outData.field(f)
-        err = outData.field(f + "_err")
-        indices = numpy.where(numpy.logical_or(mag < 0, mag > 50))
-        mag[indices] = numpy.NAN
-        err[indices] = numpy.NAN
-
-    outHdu.writeto(outName, clobber=True)
-    print "Wrote %s" % outName
+    MAPPING[f + '_mag'] = (f, "E", numpy.float32)
+    MAPPING[f + '_mag_err'] = (f + "_err", "E", numpy.float32)
+
+
+def convertCosmos(inName, outName, chunkRows=1000000):
+    """Convert the COSMOS catalog (fixed-width text) to FITS
+
+    The catalog is read in chunks (see hsc.fixedWidth), with the layout
+    that asciitable.FixedWidthTwoLine was given: names on the first line,
+    dashes marking the columns on the second, data from the fifth line up to
+    the last.  Magnitudes outside 0..50 are set to NaN, along with their errors.
+    """
+    schema = OrderedDict((name, fmt) for name, fmt, _ in MAPPING.values())
+    writer = MemmapTableWriter(outName, schema)
+    for columns in readFixedWidth(inName, [(col, dtype) for col, (_, _, dtype) in MAPPING.items()],
+                                  chunkRows=chunkRows, delimiter='|', headerLine=0, positionLine=1, dataStart=4,
+                                  dataEnd=-1):
+        outData = dict((name, columns[col]) for col, (name, _, _) in MAPPING.items())
+        for f in FILTERS:
+            mag = outData[f]
+            err = outData[f + "_err"]
+            indices = numpy.where(numpy.logical_or(mag < 0, mag > 50))
+            mag[indices] = numpy.NAN
+            err[indices] = numpy.NAN
+        writer.append(outData)
+    num = writer.close()
+
+    print "Wrote %d rows as %s" % (num, outName)
     print "To create an astrometry.net catalogue, execute:"
     outBase = outName.replace(".fits", "")
     print "build-index -i %s -o %s_and_0.fits -I 77770 -P0 -n 100 -S r -L 20 -E -M -j 0.4" % (inName, outBase)
@@ -48,5 +52,6 @@ if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("inFile", help="Name of input file")
     parser.add_argument("outFile", help="Name of output file")
+    parser.add_argument("--chunk", dest="chunkRows", type=int, default=1000000, help="Rows to read at a time")
     args = parser.parse_args()
-    convertCosmos(args.inFile, args.outFile)
+    convertCosmos(args.inFile, args.outFile, chunkRows=args.chunkRows)
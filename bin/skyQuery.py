@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import time
+from argparse import ArgumentParser
+
+from hsc.skyIndex import SkyIndex
+from hsc.region import Cone, Box, Polygon
+from hsc.catalogIO import getSchema, writeCatalog
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Build a sky index for catalog shards, or query it")
+    parser.add_argument("root", help="Root name of the shards (<root>_hp_<healpix>.fits)")
+    subparsers = parser.add_subparsers(dest="command")
+    build = subparsers.add_parser("build", help="Build the index")
+    build.add_argument("-s", "--nside", type=int, default=32, help="HEALPix nside of the shards")
+    build.add_argument("-f", "--fine", dest="fineFactor", type=int, default=64,
+                       help="Ratio of the nside of the index's fine healpixes to that of the shards")
+    build.add_argument("-j", dest="threads", type=int, default=0, help="Number of threads")
+    cone = subparsers.add_parser("cone", help="Sources within a radius of a position")
+    cone.add_argument("ra", type=float, help="RA of centre (degrees)")
+    cone.add_argument("dec", type=float, help="Dec of centre (degrees)")
+    cone.add_argument("radius", type=float, help="Radius (degrees)")
+    box = subparsers.add_parser("box", help="Sources within RA and Dec ranges")
+    box.add_argument("raMin", type=float, help="Minimum RA (degrees)")
+    box.add_argument("raMax", type=float, help="Maximum RA (degrees); less than raMin to wrap through zero")
+    box.add_argument("decMin", type=float, help="Minimum Dec (degrees)")
+    box.add_argument("decMax", type=float, help="Maximum Dec (degrees)")
+    polygon = subparsers.add_parser("polygon", help="Sources within a polygon (e.g., a CCD)")
+    polygon.add_argument("vertices", type=float, nargs="+", help="RA and Dec of each vertex (degrees)")
+    for sub in (cone, box, polygon):
+        sub.add_argument("-c", "--columns", nargs="+", help="Columns to write (default: all)")
+        sub.add_argument("-o", "--output", help="Catalog to write the sources to")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        SkyIndex.build(args.root, nside=args.nside, fineFactor=args.fineFactor, threads=args.threads)
+        exit(0)
+
+    if args.command == "cone":
+        region = Cone(args.ra, args.dec, args.radius)
+    elif args.command == "box":
+        region = Box(args.raMin, args.raMax, args.decMin, args.decMax)
+    else:
+        if len(args.vertices) % 2 != 0:
+            parser.error("Polygon vertices must be pairs of RA, Dec")
+        region = Polygon(zip(args.vertices[::2], args.vertices[1::2]))
+
+    start = time.time()
+    index = SkyIndex.read(args.root)
+    sources = index.query(region, columns=args.columns)
+    num = len(next(iter(sources.values()))) if sources else 0
+    print "Found %d sources in %s in %.1f ms" % (num, region, 1000*(time.time() - start))
+    if args.output:
+        schema = getSchema(index.shards[0][1], args.columns)
+        writeCatalog(args.output, schema, sources)
+        print "Wrote %s" % args.output
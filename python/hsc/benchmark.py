@@ -0,0 +1,784 @@
+"""
+Benchmarks on synthetic catalogs
+
+These generate catalogs resembling the real inputs (PSPS dumps, SDSS sweeps
+and PS1-MD skycells), so that changes to the catalog processing can be timed
+and checked without production data.  Some benchmarks compare an
+implementation with the original one; others time the stages of a whole
+pipeline on synthetic inputs written to disk (in chunks, so they can be of
+any size), with the astrometry.net tools replaced by stubs.
+
+Results are dicts of measurements, keyed by name and unit.  They can be
+compared with stored baselines to catch regressions: timings and memory
+may vary within a tolerance, while row counts and checksums of the outputs
+must match exactly.
+"""
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+import shutil
+import hashlib
+import resource
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy
+import pyfits
+
+from . import ps1md
+from . import ps1db
+from . import sdssSweep
+from .wcs import TanWcs
+from .manifest import Manifest
+from .runLog import getMemoryStatus
+from .selection import Selection
+from .fitsTable import makeColDefs, makeDtype, readTable, FitsTableWriter, MemmapTableWriter
+
+__all__ = ["timeCall", "measurePeakMemory", "makeMdSkycell", "makePsps", "makeSweep", "writeSynthetic",
+           "stubTools", "benchmarkMdAdd", "benchmarkConvert", "benchmarkPs1Filter", "benchmarkWcs",
+           "benchmarkSelection", "benchmarkPs1Build", "benchmarkSdssBuild", "benchmarkMdMerge", "compareResults",
+           "readBaselines", "writeBaselines", "BENCHMARKS",]
+
+# Area (RA and Dec ranges) over which the pipeline benchmarks' sources lie: hsc_spring
+AREA = (127.0, 225.5, -2.5, 5.5)
+
+# Stub for build-astrometry-index: creates an empty output
+STUB_INDEX = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    [ "$1" = "-o" ] && : > "$2"
+    shift
+done
+exit 0
+"""
+
+
+def timeCall(func, *args, **kwargs):
+    """Call a function, returning the elapsed (wall-clock) time and the result"""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def measurePeakMemory(func, *args, **kwargs):
+    """Call a function, returning the elapsed time, the peak memory increase (MB) and the result
+
+    The peak resident set size is reset before the call (Linux only;
+    elsewhere the memory increase is NaN).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        start = getMemoryStatus("VmRSS")
+    except (IOError, RuntimeError):
+        start = None
+    elapsed, result = timeCall(func, *args, **kwargs)
+    peak = (getMemoryStatus("VmHWM") - start)/1024.0 if start is not None else numpy.nan
+    return elapsed, peak, result
+
+
+def getResourcePeak():
+    """Return the peak resident set size (MB) of any finished child process"""
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024.0
+
+
+@contextmanager
+def quiet():
+    """Send output to /dev/null (including from worker processes started within)"""
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+@contextmanager
+def stubTools(directory):
+    """Put stub astrometry.net tools (build-astrometry-index) in 'directory', first on the PATH"""
+    stubName = os.path.join(directory, "build-astrometry-index")
+    with open(stubName, "w") as f:
+        f.write(STUB_INDEX)
+    os.chmod(stubName, 0755)
+    path = os.environ.get("PATH", "")
+    os.environ["PATH"] = directory + os.pathsep + path
+    try:
+        yield
+    finally:
+        os.environ["PATH"] = path
+
+
+def makeTable(columns):
+    """Make an in-memory HDUList from a list of (name, FITS format, array)"""
+    table = pyfits.new_table(pyfits.ColDefs([pyfits.Column(name=name, format=fmt, array=array) for
+                                             name, fmt, array in columns]))
+    return pyfits.HDUList([pyfits.PrimaryHDU(), table])
+
+
+def getPositions(rng, num, area=None):
+    """Return ra, dec (degrees) uniform over the sky, or over an 'area' (raMin, raMax, decMin, decMax)"""
+    raMin, raMax, decMin, decMax = area if area is not None else (0.0, 360.0, -90.0, 90.0)
+    ra = rng.uniform(raMin, raMax, num)
+    dec = numpy.degrees(numpy.arcsin(rng.uniform(numpy.sin(numpy.radians(decMin)),
+                                                 numpy.sin(numpy.radians(decMax)), num)))
+    return ra, dec
+
+
+def writeSynthetic(filename, getColumns, num, seed=0, start=0, chunkRows=1000000, **kwargs):
+    """Write a synthetic catalog of 'num' rows, generated and written 'chunkRows' at a time
+
+    'getColumns(num, rng, start, **kwargs)' returns a list of (name, FITS
+    format, array) for 'num' rows, numbered from 'start'.  Returns the number
+    of rows written.
+    """
+    if num <= 0:
+        raise RuntimeError("Can't write an empty synthetic catalog")
+    writer = None
+    for i, first in enumerate(range(0, num, chunkRows)):
+        columns = getColumns(min(chunkRows, num - first), numpy.random.RandomState([seed, start + first]),
+                             start=start + first, **kwargs)
+        if writer is None:
+            writer = MemmapTableWriter(filename, OrderedDict((name, fmt) for name, fmt, _ in columns))
+        writer.append(dict((name, array) for name, _, array in columns))
+    return writer.close()
+
+
+def writeInputs(directory, prefix, getColumns, num, fileRows, seed=0, **kwargs):
+    """Write 'num' synthetic rows in files of up to 'fileRows' rows, returning a list of (filename, rows)"""
+    inputs = []
+    for i, start in enumerate(range(0, num, fileRows)):
+        filename = os.path.join(directory, "%s_%d.fits" % (prefix, i))
+        inputs.append((filename, writeSynthetic(filename, getColumns, min(fileRows, num - start), seed=seed,
+                                                start=start, **kwargs)))
+    return inputs
+
+
+def getChecksum(fileList, schema):
+    """Return the number of rows in catalogs and a checksum of their contents
+
+    The checksum doesn't depend on the order of the rows within each file.
+    """
+    sha = hashlib.sha1()
+    num = 0
+    for filename in sorted(fileList, key=os.path.basename):
+        columns = readTable(filename, schema)
+        order = numpy.lexsort([columns[col] for col in schema if columns[col].ndim == 1][::-1])
+        sha.update(os.path.basename(filename))
+        for col in schema:
+            sha.update(numpy.ascontiguousarray(columns[col][order]).tostring())
+        num += len(order)
+    return num, sha.hexdigest()
+
+
+def measureStage(results, name, rows, func, *args, **kwargs):
+    """Run a stage of a pipeline, recording its time, throughput and peak memory increase in results"""
+    elapsed, peak, result = measurePeakMemory(func, *args, **kwargs)
+    results[name + " (sec)"] = elapsed
+    results[name + " (rows/sec)"] = rows/elapsed if elapsed > 0 else numpy.nan
+    results[name + " (MB)"] = peak
+    return result
+
+
+def makeMdSkycell(num, filterName, ident=None, seed=0, size=ps1md.SIZE):
+    """Make a synthetic PS1-MD skycell catalog as an in-memory HDUList
+
+    The catalog has the IPP columns and headers read by ps1md.Data.  If 'ident'
+    is not provided, the IPP_IDET values are 0..num-1.
+    """
+    rng = numpy.random.RandomState(seed)
+    if ident is None:
+        ident = numpy.arange(num, dtype=numpy.int64)
+    num = len(ident)
+
+    primary = pyfits.PrimaryHDU()
+    header = primary.header
+    header["FPA.FILTER"] = filterName + ".00000"
+    header["NAXIS1"] = size
+    header["NAXIS2"] = size
+    for key, value in (("CRVAL1", 150.0), ("CRVAL2", 2.2), ("CRPIX1", 0.5*size), ("CRPIX2", 0.5*size),
+                       ("CDELT1", -0.25/3600), ("CDELT2", 0.25/3600),
+                       ("PC001001", 1.0), ("PC001002", 0.0), ("PC002001", 0.0), ("PC002002", 1.0)):
+        header[key] = value
+
+    columns = [("IPP_IDET", "K", ident),
+               ("X_PSF", "E", rng.uniform(0, size, num)),
+               ("Y_PSF", "E", rng.uniform(0, size, num)),
+               ("FLAGS", "J", rng.randint(0, 0x10000, num) | ((rng.uniform(size=num) < 0.05) << 20)),
+               ("CAL_PSF_MAG", "E", rng.uniform(15, 25, num)),
+               ("CAL_PSF_MAG_SIG", "E", rng.uniform(0, 0.2, num)),
+               ("KRON_FLUX", "E", rng.uniform(1, 1.0e5, num)),
+               ("PSF_INST_MAG", "E", rng.uniform(-16, -5, num)),
+               ]
+    table = pyfits.new_table(pyfits.ColDefs([pyfits.Column(name=name, format=fmt, array=array) for
+                                             name, fmt, array in columns]))
+    for i, key in enumerate(ps1md.MASK):
+        table.header[key] = 1 << (i + 20)
+    return pyfits.HDUList([primary, table])
+
+
+def getPspsColumns(num, rng, start=0, area=None):
+    """Return the columns of a synthetic PS1 PSPS catalog, as a list of (name, FITS format, array)
+
+    The catalog has the columns read by ps1db.BuildPS1, with positions uniform
+    over the sky (or the 'area'), and about 10% of magnitudes missing (-999).
+    """
+    ra, dec = getPositions(rng, num, area)
+    columns = [("o_objID", "K", numpy.arange(start, start + num, dtype=numpy.int64)),
+               ("o_ra", "D", ra),
+               ("o_dec", "D", dec),
+               ("o_qualityFlag", "I", rng.randint(0, 128, num)),
+               ]
+    for f in ps1db.FILTERS:
+        for kind in ("Mean", "Stack"):
+            mag = rng.uniform(14, 24, num)
+            mag[rng.uniform(size=num) < 0.1] = -999
+            columns.append(("o_%s%sPSFMag" % (f, kind), "E", mag))
+            columns.append(("o_%s%sPSFMagErr" % (f, kind), "E", rng.uniform(0, 0.1, num)))
+        columns.append(("o_%sFlags" % f, "J", rng.randint(0, 1000, num)))
+    return columns
+
+
+def makePsps(num, seed=0):
+    """Make a synthetic PS1 PSPS catalog as an in-memory HDUList"""
+    return makeTable(getPspsColumns(num, numpy.random.RandomState(seed), start=seed*10**9))
+
+
+def getSweepColumns(num, rng, start=0, area=None):
+    """Return the columns of a synthetic SDSS sweep, as a list of (name, FITS format, array)
+
+    The catalog has the columns read by sdssSweep.BuildSdss and sdss-select.py:
+    about 70% are stars (STARNOTGAL) and each band is PHOTOMETRIC in
+    CALIB_STATUS 90% of the time.
+    """
+    ra, dec = getPositions(rng, num, area)
+    numBands = len(sdssSweep.FILTERS)
+    calib = rng.randint(0, 0x1000, (num, numBands)) & ~0x0001
+    calib |= (rng.uniform(size=(num, numBands)) < 0.9).astype(calib.dtype)
+    columns = [("ID", "K", numpy.arange(start, start + num, dtype=numpy.int64)),
+               ("THING_ID", "K", numpy.where(rng.uniform(size=num) < 0.05, -1,
+                                             numpy.arange(start, start + num, dtype=numpy.int64))),
+               ("RA", "D", ra),
+               ("DEC", "D", dec),
+               ("STARNOTGAL", "L", rng.uniform(size=num) < 0.7),
+               ("CALIB_STATUS", "%dJ" % numBands, calib),
+               ]
+    for f in sdssSweep.FILTERS:
+        columns.append((f, "E", rng.uniform(14, 24, num)))
+        columns.append((f + "_ERR", "E", rng.uniform(0, 0.2, num)))
+    return columns
+
+
+def makeSweep(num, seed=0):
+    """Make a synthetic SDSS sweep as an in-memory HDUList"""
+    return makeTable(getSweepColumns(num, numpy.random.RandomState(seed), start=seed*10**9))
+
+
+def getBytesWritten():
+    """Return the number of bytes this process has passed to write() (Linux only; else zero)"""
+    if not os.path.exists("/proc/self/io"):
+        return 0
+    with open("/proc/self/io") as f:
+        for line in f:
+            if line.startswith("wchar:"):
+                return int(line.split()[1])
+    return 0
+
+
+def convertNewTable(build, inName, outName):
+    """The original BuildAndCatalog.convert, for reference
+
+    This filters the whole input, copies the filtered columns into a new
+    table and writes it.  Returns the number of bytes copied in memory.
+    """
+    inFile = pyfits.open(inName)
+    columns = build.filter(inFile[1].data)
+    inFile.close()
+    size = len(columns["ra"])
+    outHdu = pyfits.new_table(makeColDefs(build.schema), nrows=size)
+    outData = outHdu.data
+    for col in build.schema:
+        outData.field(col)[:] = columns[col]
+    outHdu.writeto(outName, clobber=True)
+    return sum(columns[col].nbytes for col in build.schema) + outData.itemsize*size
+
+
+def convertStream(build, inName, outName):
+    """BuildAndCatalog.convert with the filtered columns buffered into rows and written
+
+    Returns the number of bytes copied in memory.
+    """
+    writer = FitsTableWriter(outName, build.schema)
+    copied = 0
+    for select, columns in build.read(inName):
+        columns = dict((col, columns[col] if select is None else columns[col][select]) for col in build.schema)
+        copied += sum(columns[col].nbytes for col in build.schema)
+        copied += writer.dtype.itemsize*writer.append(columns)
+    writer.close()
+    return copied
+
+
+def convertMemmap(build, inName, outName):
+    """As BuildAndCatalog.convert: the selected rows are copied straight into the memory-mapped output
+
+    Returns the number of bytes copied in memory.
+    """
+    writer = MemmapTableWriter(outName, build.schema)
+    for select, columns in build.read(inName):
+        writer.append(columns, select)
+    writer.close()
+    return writer.copied
+
+
+def filterPs1Float64(data):
+    """The original ps1db.BuildPS1.filter, for reference
+
+    This works in float64, with full-length temporaries for each band.
+    """
+    mag = numpy.ndarray((5, len(data)))
+    err = numpy.ndarray((5, len(data)))
+
+    quality = data.field("o_qualityFlag")
+    extended = (quality & ps1db.QUALITY['EXT']) == 0
+
+    for i, f in enumerate(ps1db.FILTERS):
+        mean = data.field("o_" + f + "MeanPSFMag")
+        meanErr = data.field("o_" + f + "MeanPSFMagErr")
+        badMean = (mean == -999) | ((quality & ps1db.QUALITY['GOOD']) == 0) | (mean > ps1db.LIMITS_MEAN[f])
+
+        stack = data.field("o_" + f + "StackPSFMag")
+        stackErr = data.field("o_" + f + "StackPSFMagErr")
+        badStack = (stack == -999) | ((quality & ps1db.QUALITY['GOOD_STACK']) == 0) | (stack > ps1db.LIMITS_STACK[f])
+
+        mag[i,:] = numpy.where(badMean, numpy.where(extended | badStack, numpy.nan, stack), mean)
+        err[i,:] = numpy.where(badMean, numpy.where(extended | badStack, numpy.nan, stackErr), meanErr)
+
+    numBad = numpy.isnan(mag).sum(axis=0)
+    isBad = numBad > 3
+    isGood = numpy.logical_not(isBad)
+
+    return dict([("id", data.o_objID[isGood]),
+                 ("ra", data.o_ra[isGood]),
+                 ("dec", data.o_dec[isGood])] +
+                [(f, mag[i,isGood]) for i,f in enumerate(ps1db.FILTERS)] +
+                [(f + "_err", err[i,isGood]) for i,f in enumerate(ps1db.FILTERS)]
+                )
+
+
+def calculateRaDecOriginal(header, x, y):
+    """The original ps1md.Data.calculateRaDec, for reference
+
+    This only supports a diagonal PC matrix.  Returns arrays of ra, dec.
+    """
+    crval1 = header["CRVAL1"]
+    crval2 = header["CRVAL2"]
+    crpix1 = header["CRPIX1"]
+    crpix2 = header["CRPIX2"]
+    cdelt1 = header["CDELT1"]
+    cdelt2 = header["CDELT2"]
+    pc11 = header["PC001001"]
+    pc12 = header["PC001002"]
+    pc21 = header["PC002001"]
+    pc22 = header["PC002002"]
+    assert pc12 == 0.0 and pc21 == 0.0
+
+    # Deprojection from psCoord.c
+    xi = numpy.radians((x.astype(numpy.float64) - crpix1) * pc11 * cdelt1)
+    eta = numpy.radians((y.astype(numpy.float64) - crpix2) * pc22 * cdelt2)
+    r = numpy.hypot(xi, eta)
+    rho = numpy.sqrt(1.0 + xi*xi + eta*eta)
+    sinPhi = xi/r
+    cosPhi = -eta/r
+    sinTheta = 1.0/rho
+    cosTheta = r/rho
+    sinDp = numpy.sin(numpy.radians(crval2))
+    cosDp = numpy.cos(numpy.radians(crval2))
+    sinAlpha = cosTheta*sinPhi
+    cosAlpha = cosTheta*cosPhi*sinDp + sinTheta*cosDp
+
+    dec = numpy.degrees(numpy.arcsin(sinTheta*sinDp - cosTheta*cosPhi*cosDp))
+    ra = numpy.degrees(numpy.arctan2(sinAlpha, cosAlpha)) + crval1
+    return ra, dec
+
+
+def getSeparation(ra1, dec1, ra2, dec2):
+    """Return the angular separation (arcsec) between positions (degrees), for small separations"""
+    dRa = numpy.remainder(ra1 - ra2 + 180.0, 360.0) - 180.0
+    return 3600.0*numpy.hypot(dRa*numpy.cos(numpy.radians(dec1)), dec1 - dec2)
+
+
+def addLoop(data, inFits):
+    """The original ps1md.Data.add, for reference
+
+    This walks the detections in Python, so requires both catalogs to be sorted by IPP_IDET.
+    """
+    filterName = ps1md.getFilter(inFits)
+    inData = inFits[1].data
+    magArray = getattr(data, "mag_" + filterName)
+    errArray = getattr(data, "mag_" + filterName + "_err")
+    index = 0
+    for i, mag, err, flag in zip(inData.field("IPP_IDET").astype(numpy.int64),
+                                 inData.field("CAL_PSF_MAG").astype(numpy.float32),
+                                 inData.field("CAL_PSF_MAG_SIG").astype(numpy.float32),
+                                 inData.field("FLAGS").astype(numpy.int64),
+                                 ):
+        while index < data.num and data.id[index] < i:
+            index += 1
+        if index >= data.num:
+            break
+        if data.id[index] == i:
+            magArray[index] = mag
+            errArray[index] = err
+            data.flags[index] = numpy.bitwise_or(data.flags[index], flag)
+
+
+def benchmarkMdAdd(num=1000000, fraction=0.8, seed=0):
+    """Compare the vectorised ps1md.Data.add with the original loop
+
+    The template (i-band) skycell has 'num' detections; each other band detects
+    a random 'fraction' of them, plus num*(1 - fraction) that aren't in the template.
+    Returns a dict of timings (seconds) for each implementation.
+    """
+    rng = numpy.random.RandomState(seed)
+    template = makeMdSkycell(num, ps1md.TEMPLATE, seed=seed)
+    others = []
+    for i, f in enumerate(set(ps1md.FILTERS) - set(ps1md.TEMPLATE)):
+        ident = numpy.concatenate([numpy.where(rng.uniform(size=num) < fraction)[0],
+                                   num + numpy.arange(int(num*(1.0 - fraction)))])
+        others.append(makeMdSkycell(len(ident), f, ident=numpy.sort(ident), seed=seed + i + 1))
+
+    results = {}
+    outputs = {}
+    for name, add in (("loop", addLoop), ("vectorised", ps1md.Data.add)):
+        data = ps1md.Data(template)
+        elapsed = 0.0
+        for inFits in others:
+            elapsed += timeCall(add, data, inFits)[0]
+        results[name + " (sec)"] = elapsed
+        outputs[name] = data
+
+    # The vectorised version doesn't need sorted inputs
+    data = ps1md.Data(template)
+    results["shuffled (sec)"] = 0.0
+    for inFits in others:
+        inFits[1].data = inFits[1].data[rng.permutation(len(inFits[1].data))]
+        results["shuffled (sec)"] += timeCall(data.add, inFits)[0]
+    outputs["shuffled"] = data
+
+    for name in ["flags"] + ["mag_" + f for f in ps1md.FILTERS] + ["mag_" + f + "_err" for f in ps1md.FILTERS]:
+        expected = numpy.nan_to_num(getattr(outputs["loop"], name))
+        for key in ("vectorised", "shuffled"):
+            if not numpy.array_equal(numpy.nan_to_num(getattr(outputs[key], name)), expected):
+                raise RuntimeError("Data.add (%s) disagrees with the loop for %s" % (key, name))
+
+    return results
+
+
+def benchmarkConvert(num=1000000, seed=0):
+    """Compare ways of writing the converted catalog in BuildAndCatalog.convert
+
+    A synthetic PSPS catalog of 'num' rows is converted by BuildPS1 with the
+    original (pyfits.new_table) writer, by buffering the filtered columns into
+    rows, and with the memory-mapped writer.  Returns a dict of timings
+    (seconds) and of bytes copied per output row: the copies of the columns
+    made in memory (by filtering, and into the output rows) plus the bytes
+    passed to write().
+    """
+    tempDir = tempfile.mkdtemp()
+    try:
+        inName = os.path.join(tempDir, "psps.fits")
+        makePsps(num, seed=seed).writeto(inName)
+        build = ps1db.BuildPS1([inName], os.path.join(tempDir, "out"))
+        results = {}
+        outputs = {}
+        for name, convert in (("newTable", convertNewTable), ("stream", convertStream),
+                              ("memmap", convertMemmap)):
+            outName = os.path.join(tempDir, name + ".fits")
+            written = getBytesWritten()
+            elapsed, copied = timeCall(convert, build, inName, outName)
+            written = getBytesWritten() - written
+            outputs[name] = readTable(outName, build.schema)
+            rows = len(outputs[name]["ra"])
+            results[name + " (sec)"] = elapsed
+            results[name + " (bytes/row)"] = float(copied + written)/max(rows, 1)
+    finally:
+        shutil.rmtree(tempDir)
+
+    for name in ("stream", "memmap"):
+        for col in build.schema:
+            if not numpy.array_equal(numpy.nan_to_num(outputs[name][col]),
+                                     numpy.nan_to_num(outputs["newTable"][col])):
+                raise RuntimeError("Converted output (%s) disagrees with the original for %s" % (name, col))
+    return results
+
+
+def benchmarkPs1Filter(num=1000000, seed=0):
+    """Compare the float32 BuildPS1.select with the original float64 filter
+
+    Runs both on a synthetic PSPS catalog of 'num' rows, to which NaN
+    magnitudes and magnitudes at the limits have been added, and checks that
+    the output rows are identical (as written, i.e., in float32).  Returns a
+    dict of timings (seconds) and peak memory increases (MB).
+    """
+    rng = numpy.random.RandomState(seed)
+    data = makePsps(num, seed=seed)[1].data
+    for f in ps1db.FILTERS:
+        for kind, limits in (("Mean", ps1db.LIMITS_MEAN), ("Stack", ps1db.LIMITS_STACK)):
+            mag = data.field("o_%s%sPSFMag" % (f, kind))
+            mag[rng.uniform(size=num) < 0.01] = numpy.nan
+            mag[rng.uniform(size=num) < 0.01] = limits[f]
+
+    build = ps1db.BuildPS1([], "benchmark")
+    results = {}
+    outputs = {}
+    for name, func in (("float64", filterPs1Float64), ("float32", build.filter)):
+        elapsed, peak, outputs[name] = measurePeakMemory(func, data)
+        results[name + " (sec)"] = elapsed
+        results[name + " (MB)"] = peak
+
+    for col in build.schema:
+        expected = outputs["float64"][col].astype(makeDtype({col: build.schema[col]})[col].newbyteorder("="))
+        if not numpy.array_equal(numpy.nan_to_num(outputs["float32"][col]), numpy.nan_to_num(expected)):
+            raise RuntimeError("BuildPS1 filter disagrees with the original for %s" % (col,))
+    return results
+
+
+def benchmarkSelection(num=1000000, seed=0, chunkRows=100000,
+                       expression="all(CALIB_STATUS & PHOTOMETRIC) and STARNOTGAL and R < 15 and R_ERR < 0.1"):
+    """Compare evaluating a Selection term by term with evaluating the whole expression
+
+    The 'expression' is evaluated on a synthetic SDSS sweep of 'num' rows, in
+    chunks of 'chunkRows', both by the Selection (ordering the terms and
+    evaluating later terms only on the rows that remain) and by evaluating
+    every term on every row, and the selections are checked to be
+    identical.  Returns a dict of timings (seconds) and the rows selected.
+    """
+    data = makeSweep(num, seed=seed)[1].data
+    chunks = [data[start:start + chunkRows] for start in range(0, num, chunkRows)]
+    selection = Selection(expression, dict(PHOTOMETRIC=sdssSweep.PHOTOMETRIC))
+
+    def evaluateAll(chunk):
+        result = numpy.ones(len(chunk), dtype=bool)
+        for term in selection.terms:
+            result &= term.evaluate(dict((col, chunk.field(col)) for col in term.columns), len(chunk))
+        return result
+
+    results = {}
+    outputs = {}
+    for name, func in (("whole", evaluateAll), ("ordered", selection)):
+        results[name + " (sec)"], outputs[name] = timeCall(lambda: numpy.concatenate([func(c) for c in chunks]))
+    if not numpy.array_equal(outputs["ordered"], outputs["whole"]):
+        raise RuntimeError("Selection disagrees with evaluating the whole expression")
+    results["selected (rows)"] = int(outputs["ordered"].sum())
+    return results
+
+
+def benchmarkWcs(num=1000000, seed=0, threads=4, tolerance=1.0e-6):
+    """Compare the TanWcs deprojection with the original ps1md one
+
+    Deprojects 'num' random positions over a synthetic PS1-MD skycell with
+    the original code, and with TanWcs unchunked, chunked and with 'threads'
+    threads, checking that they agree within 'tolerance' arcsec.  The full PC
+    matrix is checked by rotating the skycell and its pixel positions.
+    Returns a dict of timings (seconds) and the largest differences (arcsec).
+    """
+    rng = numpy.random.RandomState(seed)
+    header = makeMdSkycell(0, ps1md.TEMPLATE)[0].header
+    x = rng.uniform(0, ps1md.SIZE, num).astype(numpy.float32)
+    y = rng.uniform(0, ps1md.SIZE, num).astype(numpy.float32)
+    wcs = TanWcs.fromHeader(header)
+
+    results = {}
+    results["original (sec)"], expected = timeCall(calculateRaDecOriginal, header, x, y)
+    for name, kwargs in (("whole", dict(chunkRows=0)), ("chunked", dict(chunkRows=100000)),
+                         ("threaded", dict(chunkRows=100000, threads=threads))):
+        results[name + " (sec)"], (ra, dec) = timeCall(wcs.pixelToSky, x, y, **kwargs)
+        results[name + " (arcsec)"] = getSeparation(ra, dec, *expected).max()
+
+    # Rotating the pixel offsets by R and the PC matrix by R^-1 should give the same positions
+    angle = numpy.radians(30.0)
+    rotation = numpy.array([[numpy.cos(angle), -numpy.sin(angle)], [numpy.sin(angle), numpy.cos(angle)]])
+    rotated = header.copy()
+    for i in (1, 2):
+        for j in (1, 2):
+            rotated["PC%03d%03d" % (i, j)] = numpy.dot(numpy.diag([header["PC001001"], header["PC002002"]]),
+                                                       rotation.T)[i - 1, j - 1]
+    offsets = numpy.dot(rotation, [x.astype(numpy.float64) - header["CRPIX1"],
+                                   y.astype(numpy.float64) - header["CRPIX2"]])
+    ra, dec = TanWcs.fromHeader(rotated).pixelToSky(offsets[0] + header["CRPIX1"], offsets[1] + header["CRPIX2"])
+    results["rotated (arcsec)"] = getSeparation(ra, dec, *expected).max()
+
+    for name in ("whole", "chunked", "threaded", "rotated"):
+        if not results[name + " (arcsec)"] <= tolerance:
+            raise RuntimeError("TanWcs (%s) disagrees with the original by %g arcsec" %
+                               (name, results[name + " (arcsec)"]))
+    return results
+
+
+def benchmarkBuild(build, inputs, results):
+    """Time the stages of a BuildAndCatalog on its inputs (list of (filename, rows))
+
+    The stages are: converting the first input, partitioning and gathering
+    all inputs into shards, and building the indices (with stub tools).
+    """
+    num = sum(rows for _, rows in inputs)
+    root = build.outputRoot
+    manifest = Manifest("%s_manifest.json" % root)
+    with quiet():
+        measureStage(results, "convert", inputs[0][1], build.convert, inputs[0][0], root + "_convert.fits")
+        os.unlink(root + "_convert.fits")
+        shardKeys = measureStage(results, "split", num, build.partitionAndGather, manifest)
+        measureStage(results, "index", num, build.generateAllIndexes, manifest, shardKeys)
+    if build.threads > 1:
+        results["workers (MB)"] = getResourcePeak()
+    results["shards (rows)"], results["shards (sha1)"] = getChecksum(glob.glob("%s_hp_*.fits" % root),
+                                                                     build.schema)
+    return results
+
+
+def benchmarkPs1Build(num=1000000, seed=0, threads=0, fileRows=1000000, nside=32):
+    """Time building PS1 reference catalogs from synthetic PSPS dumps
+
+    The 'num' sources are spread over the hsc_spring area in files of
+    'fileRows' rows.  Returns a dict of timings (seconds), throughputs
+    (rows/sec) and peak memory increases (MB) for each stage, and the number
+    of rows and a checksum of the shards.
+    """
+    tempDir = tempfile.mkdtemp()
+    try:
+        with stubTools(tempDir):
+            inputs = writeInputs(tempDir, "psps", getPspsColumns, num, fileRows, seed=seed, area=AREA)
+            build = ps1db.BuildPS1([filename for filename, _ in inputs], os.path.join(tempDir, "ps1"),
+                                   threads=threads, nside=nside)
+            return benchmarkBuild(build, inputs, {})
+    finally:
+        shutil.rmtree(tempDir)
+
+
+def benchmarkSdssBuild(num=1000000, seed=0, threads=0, fileRows=1000000, nside=32):
+    """Time selecting from and building SDSS reference catalogs from synthetic sweeps
+
+    As for benchmarkPs1Build, plus the "select" stage: the photometric
+    selection of sdss-select.py (BuildSdssRecal), streamed from all inputs into shards,
+    with the number of rows and a checksum of its shards.
+    """
+    tempDir = tempfile.mkdtemp()
+    try:
+        with stubTools(tempDir):
+            inputs = writeInputs(tempDir, "sweep", getSweepColumns, num, fileRows, seed=seed, area=AREA)
+            results = {}
+            recal = sdssSweep.BuildSdssRecal([filename for filename, _ in inputs], os.path.join(tempDir, "recal"),
+                                             threads=threads, nside=nside)
+            with quiet():
+                measureStage(results, "select", num, recal.streamShards,
+                             Manifest("%s_manifest.json" % recal.outputRoot))
+            results["selected (rows)"], results["selected (sha1)"] = \
+                getChecksum(glob.glob("%s_hp_*.fits" % recal.outputRoot), recal.schema)
+            build = sdssSweep.BuildSdss([filename for filename, _ in inputs], os.path.join(tempDir, "sdss"),
+                                        threads=threads, nside=nside)
+            return benchmarkBuild(build, inputs, results)
+    finally:
+        shutil.rmtree(tempDir)
+
+
+def benchmarkMdMerge(num=1000000, seed=0, threads=0, skycellRows=1000000, fraction=0.8):
+    """Time merging synthetic PS1-MD skycells
+
+    The 'num' template detections are divided into skycells of up to
+    'skycellRows'; each other band detects a random 'fraction' of them.
+    Returns a dict with the timing (seconds), throughput (template rows/sec)
+    and peak memory increase (MB), and the number of rows and a checksum of
+    the merged catalog.
+    """
+    rng = numpy.random.RandomState(seed)
+    tempDir = tempfile.mkdtemp()
+    try:
+        inputs = []
+        for i, start in enumerate(range(0, num, skycellRows)):
+            size = min(skycellRows, num - start)
+            for j, f in enumerate(ps1md.FILTERS):
+                ident = None
+                if f != ps1md.TEMPLATE:
+                    ident = numpy.where(rng.uniform(size=size) < fraction)[0]
+                filename = os.path.join(tempDir, "MD04.V3.skycell.%03d.sky.%s.cmf" % (i, f))
+                # The skycell size is recorded as NAXIS1,2 in the primary header, which pyfits disputes
+                makeMdSkycell(size, f, ident=ident, seed=seed + 10*i + j).writeto(filename, output_verify="ignore")
+                inputs.append(filename)
+        outName = os.path.join(tempDir, "md.fits")
+        results = {}
+        with quiet():
+            measureStage(results, "merge", num, ps1md.merge, outName, inputs, threads=threads)
+        if threads > 1:
+            results["workers (MB)"] = getResourcePeak()
+        results["merged (rows)"], results["merged (sha1)"] = getChecksum([outName], ps1md.SCHEMA)
+        return results
+    finally:
+        shutil.rmtree(tempDir)
+
+
+# Units of results for which smaller is better, and the differences too small to care about
+LOWER_IS_BETTER = {"sec": 0.05, "MB": 5.0, "bytes/row": 0.0, "arcsec": 0.0}
+# Units of results that aren't compared: throughputs follow from the timings
+NOT_COMPARED = ("rows/sec",)
+
+
+def getUnit(key):
+    """Return the unit of a result, from its key (e.g., "index (sec)")"""
+    m = re.search(r"\(([^)]*)\)$", key)
+    return m.group(1) if m else None
+
+
+def compareResults(results, baseline, tolerance=0.2):
+    """Compare benchmark results with a baseline, returning a list of regressions
+
+    Timings and memory use may be worse than the baseline by up to the
+    'tolerance' fraction (plus a little, for small values); anything else
+    (e.g., row counts and checksums of the outputs) must match exactly.
+    """
+    regressions = []
+    for key, expected in sorted(baseline.items()):
+        unit = getUnit(key)
+        if unit in NOT_COMPARED:
+            continue
+        if key not in results:
+            regressions.append("%s: missing (baseline %s)" % (key, expected))
+            continue
+        value = results[key]
+        if unit in LOWER_IS_BETTER:
+            worse = value > expected*(1.0 + tolerance) + LOWER_IS_BETTER[unit]
+        else:
+            worse = value != expected
+        if worse:
+            regressions.append("%s: %s (baseline %s)" % (key, value, expected))
+    return regressions
+
+
+def readBaselines(filename):
+    """Read stored baselines: a dict of benchmark name --> number of rows (as a string) --> results"""
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def writeBaselines(filename, baselines):
+    """Write baselines, atomically"""
+    tempName = filename + ".tmp"
+    with open(tempName, "w") as f:
+        json.dump(baselines, f, indent=1, sort_keys=True)
+    os.rename(tempName, filename)
+
+
+BENCHMARKS = {"mdAdd": benchmarkMdAdd,
+              "convert": benchmarkConvert,
+              "ps1Filter": benchmarkPs1Filter,
+              "wcs": benchmarkWcs,
+              "selection": benchmarkSelection,
+              "ps1Build": benchmarkPs1Build,
+              "sdssBuild": benchmarkSdssBuild,
+              "mdMerge": benchmarkMdMerge,
+              }
@@ -1,63 +1,39 @@
 import re
 import os
 import glob
-import multiprocessing
+import time
+import shutil
+import inspect
 from argparse import ArgumentParser
 
 import numpy
 import pyfits
 
+from .catalogIO import readChunks, openWriter, concatenateCatalogs, isParquet, selectUnique, selectRows, \
+    writeRows, getColumnNames
+from .healpix import HealpixPartitioner, AdaptivePartition, ShardWriter, radecToHealpix, splitByShard, \
+    getHistogram, splitUniqueId, getBrightest
+from .region import FOOTPRINTS, getFootprint, Polygon, Union
+from .selection import Selection, SPARSE
+from .scheduler import Scheduler
+from .executor import Executor
+from .workQueue import WorkQueue, QueueExecutor, QueueScheduler
+from .external import runCommand, CommandError
+from .manifest import Manifest, makeKey, removeArtifact
+from .runLog import RunLog, getFileSize
 
-__all__ = ["BuildAndCatalog",]
-
-# Support pickling of instance methods
-import copy_reg, types
-def unpickleInstanceMethod(obj, name):
-    """Unpickle an instance method
-
-    This has to be a named function rather than a lambda because
-    pickle needs to find it.
-    """
-    return getattr(obj, name)
-def pickleInstanceMethod(method):
-    """Pickle an instance method
-
-    The instance method is divided into the object and the
-    method name.
-    """
-    obj = method.__self__
-    name = method.__name__
-    return unpickleInstanceMethod, (obj, name)
-copy_reg.pickle(types.MethodType, pickleInstanceMethod)
-
-class _Caller(object):
-    def __init__(self, func):
-        self.func = func
-    def __call__(self, args):
-        return self.func(*args[0], **args[1])
-class MapFunc(object):
-    """Class to wrap the map() function with optional threading"""
-    def __init__(self, threads, func, maxtasksperchild=1):
-        self.func = func
-        self.args = []
-        if threads > 1:
-            self.pool = multiprocessing.Pool(threads, maxtasksperchild=maxtasksperchild)
-            self.map = self.pool.map
-        else:
-            self.map = map
-    def add(self, *args, **kwargs):
-        self.args.append((args, kwargs))
-    def run(self):
-        caller = _Caller(self.func)
-        return self.map(caller, self.args)
-
-def system(command):
-    print command
-    os.system(command)
 
+__all__ = ["BuildAndCatalog",]
 
 class BuildAndCatalog(object):
-    def __init__(self, inputList, outputRoot, threads=0, nside=32):
+    # Expression selecting input rows (see hsc.selection), and the constants it may use
+    SELECTION = None
+    CONSTANTS = {}
+
+    def __init__(self, inputList, outputRoot, threads=0, nside=32, useHpsplit=False, bufferRows=1000000,
+                 chunkRows=1000000, retries=1, failFast=False, intermediate="fits", footprint=None,
+                 dedupe=False, shardRows=0, minNside=None, maxNside=None, where=None, presort=False, cullNside=0,
+                 queue=None, workers=0, leaseTime=600.0, stream=False):
         """Constructor
 
         The schema needs to be set appropriately for the output.  It is a
@@ -66,70 +42,498 @@ class BuildAndCatalog(object):
 
         The build arguments needs to be set appropriately for the output.
         These are arguments to build-astrometry-index.
+
+        By default, the inputs are partitioned into healpixes as they are
+        converted (in the worker processes), buffering up to 'bufferRows'
+        rows per worker.  Set 'useHpsplit' to instead write a converted
+        catalog per input and split them with the external hpsplit.
+
+        The fragments are written to a directory per input,
+        <outputRoot>_part_<index>, with a file per healpix, and kept (and
+        recorded in the manifest) so that only the inputs that change need
+        be partitioned again.  With many inputs (e.g., the ~800 SDSS runs),
+        that's a great many small files.  With 'stream', there are none: the
+        workers return the selected rows of each input, split by healpix, and
+        they're appended straight to the shards, buffering up to 'bufferRows'
+        rows in all (see streamShards()).  This can't be used with hpsplit or
+        a queue.
+
+        Inputs are read (memory-mapped) and filtered 'chunkRows' rows at a
+        time, so memory use doesn't scale with the size of the input files;
+        a 'chunkRows' of zero reads each input in one go.  Inputs may be
+        FITS or Parquet (by extension); for Parquet, only the columns named by
+        getInputColumns() are read, and row groups rejected by keepRowGroup()
+        aren't read at all.
+
+        The healpix fragments are written as 'intermediate' ("fits" or
+        "parquet"); the shards given to build-astrometry-index are always
+        FITS.  hpsplit requires FITS.
+
+        If a 'footprint' (a region from hsc.region) is given, only sources
+        within it are kept.  Where the subclass names its input position
+        columns (getInputRaDec()), this is applied to each chunk before
+        select(), so sources outside are dropped before any other work.  With
+        'dedupe', rows with the same "id" are written once: duplicates are
+        dropped within each chunk and partitioning buffer, and again when
+        the shards are gathered, so overlapping inputs (e.g., PSPS dumps of
+        neighbouring areas) may be combined.
+
+        Input rows must pass the subclass's SELECTION and the expression
+        'where' (see hsc.selection; both may use the subclass's CONSTANTS),
+        which are applied to each chunk after the footprint and before
+        select().  Chunks with no rows passing aren't given to select(); if
+        few pass, only those are, and otherwise the rows that fail are
+        dropped along with those rejected by select().  The expressions
+        use input column names, which are checked against the first input
+        before anything is run.
+
+        With a non-zero 'shardRows', the shards are healpixes of different
+        nside, from 'minNside' (default: nside/4) to 'maxNside' (default:
+        nside*4), chosen so that each has no more than 'shardRows' rows
+        (where possible): sparse areas get large shards, and dense ones
+        (e.g., the deep fields and the Galactic plane) small ones, so that no
+        one index build is a straggler.  This needs an extra pass over the
+        inputs, counting the rows in each healpix at maxNside.  The shards are
+        named by unique id (see healpix.getUniqueId), and listed with their
+        healpix and nside in <outputRoot>_shards.json.
+
+        With 'presort', the shards are sorted by the column that
+        build-astrometry-index would sort on (its -S argument), which is then
+        dropped from the build arguments so that the tool doesn't sort them
+        again.  A non-zero 'cullNside' (which implies 'presort') also keeps
+        only the brightest sources (as many as the tool's -n) in each healpix
+        at that nside.  This is the cut the tool makes when it uniformizes
+        the catalog, so if 'cullNside' is a multiple of the nside it
+        uniformizes at (-U, by default set by the -P preset), it keeps
+        everything the tool would use, and the tool reads fewer rows.
+
+        External commands that fail are retried 'retries' times.  If they
+        still fail, the run stops (after finishing what's in progress if
+        'failFast', otherwise after running everything not depending on it).
+
+        With a 'queue' (a directory on a filesystem shared by all hosts),
+        tasks are run by the workers of an hsc.workQueue.WorkQueue instead
+        of a local pool: 'workers' are started locally, and more may be
+        started on any host with bin/queueWorker.py.  A task whose worker
+        hasn't renewed its lease for 'leaseTime' seconds is run again by
+        another worker.  The output must be on the shared filesystem too.
         """
         self.inputList = inputList
         self.outputRoot = outputRoot
         self.threads = threads
         self.nside = nside
+        self.useHpsplit = useHpsplit
+        self.bufferRows = bufferRows
+        self.chunkRows = chunkRows
+        self.retries = retries
+        self.failFast = failFast
+        if intermediate not in ("fits", "parquet"):
+            raise RuntimeError("Unrecognised intermediate format: %s" % (intermediate,))
+        if intermediate != "fits" and useHpsplit:
+            raise RuntimeError("hpsplit requires FITS intermediates")
+        self.intermediate = intermediate
+        self.footprint = footprint
+        self.dedupe = dedupe
+        if dedupe and useHpsplit:
+            raise RuntimeError("Can't dedupe with hpsplit")
+        self.shardRows = shardRows
+        self.minNside = minNside if minNside is not None else max(1, nside//4)
+        self.maxNside = maxNside if maxNside is not None else nside*4
+        if shardRows and useHpsplit:
+            raise RuntimeError("Can't partition adaptively with hpsplit")
+        self.adaptive = None # AdaptivePartition, when shardRows is set
+        self.cullNside = cullNside
+        self.presort = presort or cullNside > 0
+        if self.presort and useHpsplit:
+            raise RuntimeError("Can't sort shards with hpsplit")
+        expressions = [expr for expr in (self.SELECTION, where) if expr]
+        self.selection = None
+        if expressions:
+            self.selection = Selection(" and ".join("(%s)" % expr for expr in expressions), self.CONSTANTS)
+        self.stream = stream
+        if stream and useHpsplit:
+            raise RuntimeError("Can't stream into shards with hpsplit")
+        if stream and queue:
+            raise RuntimeError("Can't stream into shards from a queue's workers")
+        self.workQueue = WorkQueue(queue, leaseTime=leaseTime) if queue else None
+        self.workers = workers
+        if workers and not queue:
+            raise RuntimeError("Workers require a queue")
         filters = "grizy"
         self.schema = dict([("id", "K"), ("ra", "D"), ("dec", "D")] + [(f, "E") for f in filters] +
                            [(f + "_err", "E") for f in filters])
         self.buildArgs = "-S i -L 20 -E -M -j 0.2 -n 100 -r 1"
+        # Index scales (-P) to build.  Don't need 3 and 4: "-P 2 should work for
+        # images about 12 arcmin across" says build-astrometry-index
+        self.scales = [0, 1, 2]
 
     @classmethod
-    def parse(cls):
-        """Parse command-line arguments, returning a constructed BuildAndCatalog object."""
+    def makeParser(cls):
+        """Return the parser for command-line arguments
+
+        Subclasses may add their own arguments (and change the defaults).
+        """
         parser = ArgumentParser()
         parser.add_argument("input", nargs="*", help="Input files")
         parser.add_argument("-j", dest="threads", type=int, default=0, help="Number of threads")
         parser.add_argument("-o", "--output", required=True, help="Output root name")
         parser.add_argument("-s", "--nside", type=int, default=32, help="HEALPix nside (power of 2)")
+        parser.add_argument("--hpsplit", dest="useHpsplit", action="store_true", default=False,
+                            help="Split into healpixes with the external hpsplit")
+        parser.add_argument("--buffer", dest="bufferRows", type=int, default=1000000,
+                            help="Rows to buffer per worker when partitioning (in all, with --stream)")
+        parser.add_argument("--chunk", dest="chunkRows", type=int, default=1000000,
+                            help="Rows to read at a time (0 to read whole inputs)")
+        parser.add_argument("--retries", type=int, default=1, help="Times to retry failed external commands")
+        parser.add_argument("--intermediate", choices=("fits", "parquet"), default="fits",
+                            help="Format for intermediate files")
+        parser.add_argument("--fail-fast", dest="failFast", action="store_true", default=False,
+                            help="Don't start any more index builds after one fails")
+        parser.add_argument("--footprint", action="append", default=[], choices=sorted(FOOTPRINTS),
+                            help="Keep only sources in this survey footprint (may be repeated)")
+        parser.add_argument("--polygon", action="append", default=[], metavar="RA,DEC,RA,DEC,...",
+                            help="Keep only sources in this polygon (may be repeated)")
+        parser.add_argument("--dedupe", action="store_true", default=False,
+                            help="Write sources with the same id only once")
+        parser.add_argument("--adaptive", dest="shardRows", type=int, default=0, metavar="ROWS",
+                            help="Vary the nside of the shards to keep them under this many rows")
+        parser.add_argument("--min-nside", dest="minNside", type=int, help="Smallest nside for --adaptive")
+        parser.add_argument("--max-nside", dest="maxNside", type=int, help="Largest nside for --adaptive")
+        parser.add_argument("--where", metavar="EXPRESSION",
+                            help="Keep only input rows for which this is true; names are input columns "
+                            "(e.g., 'o_iMeanPSFMag < 20' for PS1)")
+        parser.add_argument("--presort", action="store_true", default=False,
+                            help="Sort the shards for build-astrometry-index, rather than having it sort them")
+        parser.add_argument("--cull-nside", dest="cullNside", type=int, default=0, metavar="NSIDE",
+                            help="Keep only the brightest sources in each healpix at this nside (implies --presort)")
+        parser.add_argument("--queue", metavar="DIR",
+                            help="Run tasks from a work queue in this shared directory (see bin/queueWorker.py)")
+        parser.add_argument("--workers", type=int, default=0, help="Number of local workers for --queue")
+        parser.add_argument("--lease", dest="leaseTime", type=float, default=600.0, metavar="SEC",
+                            help="Time after which a --queue task whose worker is silent is run again")
+        parser.add_argument("--stream", action="store_true", default=False,
+                            help="Append the selected rows straight to the shards, without per-input fragments")
+        return parser
+
+    @classmethod
+    def getInputList(cls, args, parser):
+        """Return the list of input files from the parsed command-line arguments"""
+        return args.input
+
+    @classmethod
+    def parse(cls):
+        """Parse command-line arguments, returning a constructed BuildAndCatalog object."""
+        parser = cls.makeParser()
         args = parser.parse_args()
-        return cls(args.input, args.output, threads=args.threads, nside=args.nside)
+        regions = [getFootprint(name) for name in args.footprint]
+        for polygon in args.polygon:
+            vertices = [float(value) for value in polygon.split(",")]
+            if len(vertices) % 2 != 0:
+                parser.error("Polygon vertices must be pairs of RA, Dec: %s" % (polygon,))
+            regions.append(Polygon(zip(vertices[::2], vertices[1::2])))
+        footprint = None
+        if regions:
+            footprint = regions[0] if len(regions) == 1 else Union(regions)
+        return cls(cls.getInputList(args, parser), args.output, threads=args.threads, nside=args.nside,
+                   useHpsplit=args.useHpsplit, bufferRows=args.bufferRows, chunkRows=args.chunkRows,
+                   retries=args.retries, failFast=args.failFast, intermediate=args.intermediate,
+                   footprint=footprint, dedupe=args.dedupe, shardRows=args.shardRows, minNside=args.minNside,
+                   maxNside=args.maxNside, where=args.where, presort=args.presort, cullNside=args.cullNside,
+                   queue=args.queue, workers=args.workers, leaseTime=args.leaseTime, stream=args.stream)
 
     def filter(self, data):
         """Filter the input data, returning the appropriate columns
 
-        The subclass should define this to return a dict with keys
-        being the column names and values being a numpy array of data.
+        The subclass should define this (or select()) to return a dict
+        with keys being the column names and values being a numpy array
+        of data.
         """
-        raise NotImplementedError("Not implemented for base class")
+        if type(self).select.im_func is BuildAndCatalog.select.im_func:
+            raise NotImplementedError("Not implemented for base class")
+        select, columns = self.select(data)
+        if select is None:
+            return columns
+        return dict((col, columns[col][select]) for col in self.schema)
 
-    def convert(self, inName, outName):
-        """Convert input data to the format to be processed by astrometry.net"""
-        if os.path.exists(outName):
-            print "Output file %s exists; not clobbering" % outName
+    def select(self, data):
+        """Select the input data, returning the selection and the columns for all rows
+
+        The selection is a boolean array (or None to keep all rows).  Defining
+        this instead of filter() saves copying the selected rows of each column
+        before they're written: the writer copies them straight into the output.
+        By default, this uses filter().
+        """
+        return None, self.filter(data)
+
+    def getInputColumns(self):
+        """Return the list of input columns used by select(), or None for all
+
+        Only these (and those used by the selection) are read from columnar
+        (Parquet) inputs.
+        """
+        return None
+
+    def getReadColumns(self):
+        """Return the list of input columns to read, or None for all"""
+        columns = self.getInputColumns()
+        if columns is None or self.selection is None:
+            return columns
+        return columns + [col for col in self.selection.columns if col not in columns]
+
+    def checkSelection(self):
+        """Raise if the selection uses columns that aren't in the (first) input
+
+        This catches mistakes (e.g., using output column names) before any
+        work starts, rather than in every worker.  FITS column names are
+        matched regardless of case, as pyfits does.
+        """
+        if self.selection is None or not self.inputList:
             return
-        inFile = pyfits.open(inName)
-        inData = inFile[1].data
-        print "Read %d rows from %s" % (len(inData), inName)
+        inName = self.inputList[0]
+        names = getColumnNames(inName)
+        if not isParquet(inName):
+            names = [name.lower() for name in names]
+        missing = [col for col in self.selection.columns if
+                   (col if isParquet(inName) else col.lower()) not in names]
+        if missing:
+            raise RuntimeError("Selection %r uses columns not in the input %s: %s; selections are on input "
+                               "columns, not output columns" % (self.selection.expression, inName,
+                                                               ", ".join(missing)))
 
-        # Filter the data and get the columns we want
-        columns = self.filter(inData)
+    def getInputRaDec(self):
+        """Return the names of the input ra and dec columns (degrees), or None if unknown
 
+        If known, the footprint is applied to the input before select();
+        otherwise, to the output of select().
+        """
+        return None
+
+    def keepRowGroup(self, stats):
+        """Might any rows in a block of the input pass select()?
+
+        'stats' is a dict of input column name --> (min, max) over the block
+        (a Parquet row group).  Return False only if no row can be selected,
+        and the block won't be read.  By default, all blocks are read.
+        """
+        return True
+
+    def getConfig(self):
+        """Return the configuration that determines the converted catalogs
+
+        This goes into the keys of the build manifest, so that changing the
+        schema or filtering (including the code of filter()) causes the
+        inputs to be reconverted.  Subclasses should add any parameters
+        used by their filter().
+        """
+        return dict(cls=type(self).__name__, schema=sorted(self.schema.items()),
+                    filter=inspect.getsource(type(self).filter), select=inspect.getsource(type(self).select),
+                    footprint=repr(self.footprint), dedupe=self.dedupe,
+                    selection=self.selection.expression if self.selection is not None else None,
+                    constants=sorted(self.selection.constants.items()) if self.selection is not None else None)
+
+    def read(self, inName, stats=None):
+        """Read and filter input data in chunks
+
+        This is a generator, yielding the selection and the schema columns
+        for each chunk (see select()).  FITS inputs are memory-mapped, and
+        Parquet inputs are read a row group at a time, so only the chunk
+        being filtered need be resident.
+
+        If provided, the 'stats' dict accumulates the number of rows read
+        ("rowsIn") and the time spent reading and filtering ("readTime" and
+        "filterTime"; sec).  Memory-mapped FITS is read as it's used, so for
+        FITS most of the reading is counted as filtering.
+        """
+        if stats is None:
+            stats = {}
+        for key in ("rowsIn", "readTime", "filterTime"):
+            stats.setdefault(key, 0)
         if not "ra" in self.schema or not "dec" in self.schema:
             raise RuntimeError("Don't have 'ra' and 'dec' columns in schema")
+        if self.dedupe and not "id" in self.schema:
+            raise RuntimeError("Don't have 'id' column in schema to dedupe")
+
+        inputRaDec = self.getInputRaDec() if self.footprint is not None else None
+        readColumns = self.getReadColumns()
+        # Rows failing the selection may be masked rather than removed only if select() keeps all rows
+        canMask = type(self).select.im_func is not BuildAndCatalog.select.im_func
+        chunks = readChunks(inName, self.chunkRows, columns=readColumns,
+                            keepRowGroup=self.keepRowGroup, verbose=True)
+        while True:
+            start = time.time()
+            inData = next(chunks, None)
+            if inData is None:
+                break
+            stats["rowsIn"] += len(inData)
+            stats["readTime"] += time.time() - start
+            start = time.time()
+            if inputRaDec is not None:
+                inside = self.footprint.contains(inData.field(inputRaDec[0]), inData.field(inputRaDec[1]))
+                if not numpy.any(inside):
+                    stats["filterTime"] += time.time() - start
+                    continue
+                if not numpy.all(inside):
+                    inData = inData[inside]
+            passed = None
+            if self.selection is not None:
+                passed = self.selection(inData)
+                numPassed = numpy.count_nonzero(passed)
+                if numPassed == 0:
+                    stats["filterTime"] += time.time() - start
+                    continue
+                if numPassed == len(passed):
+                    passed = None
+                elif numPassed < SPARSE*len(passed) or not canMask:
+                    # Copying the few rows that passed is cheaper than having select() work on them all
+                    inData = selectRows(inData, passed, readColumns)
+                    passed = None
 
-        size = None
-        for col in self.schema:
-            if not col in columns:
-                raise RuntimeError("Schema column %s was not present after filtering" % col)
-            if size is None:
-                size = len(columns[col])
-            elif len(columns[col]) != size:
-                raise RuntimeError("Size mismatch for column %s: %d vs %d" % (col, len(columns[col], size)))
+            # Filter the data and get the columns we want
+            select, columns = self.select(inData)
 
-        # Write it all out
-        schema = pyfits.ColDefs([pyfits.Column(name=col, format=self.schema[col]) for col in self.schema])
-        outHdu = pyfits.new_table(schema, nrows=size)
-        outData = outHdu.data
+            size = None
+            for col in self.schema:
+                if not col in columns:
+                    raise RuntimeError("Schema column %s was not present after filtering" % col)
+                if size is None:
+                    size = len(columns[col])
+                elif len(columns[col]) != size:
+                    raise RuntimeError("Size mismatch for column %s: %d vs %d" % (col, len(columns[col]), size))
+            if select is not None and len(select) != size:
+                raise RuntimeError("Size mismatch for selection: %d vs %d" % (len(select), size))
+            if passed is not None:
+                select = passed if select is None else select & passed
+            if self.footprint is not None and inputRaDec is None:
+                inside = self.footprint.contains(columns["ra"], columns["dec"])
+                select = inside if select is None else select & inside
+            if self.dedupe:
+                select = selectUnique(columns["id"], select)
+            stats["filterTime"] += time.time() - start
+            yield select, columns
 
-        for col in self.schema:
-            outData.field(col)[:] = columns[col]
+    def convert(self, inName, outName):
+        """Convert input data to the format to be processed by astrometry.net
+
+        Output is written to a temporary file as each chunk is filtered,
+        and renamed when complete.  The output is Parquet if outName has a
+        Parquet extension; otherwise FITS, with the selected rows copied
+        directly into the memory-mapped output.
 
-        outHdu.writeto(outName, clobber=True)
+        Returns a dict of statistics (see read()), with the number of rows
+        written ("rowsOut") and the time spent writing ("writeTime").
+        """
+        if os.path.exists(outName):
+            print "Output file %s exists; not clobbering" % outName
+            return None
+        tempName = outName + ".tmp"
+        stats = dict(writeTime=0.0)
+        writer = openWriter(tempName, self.schema, parquet=isParquet(outName))
+        for select, columns in self.read(inName, stats):
+            start = time.time()
+            writer.append(columns, select)
+            stats["writeTime"] += time.time() - start
+        start = time.time()
+        stats["rowsOut"] = size = writer.close()
+        stats["writeTime"] += time.time() - start
+        os.rename(tempName, outName)
         print "Wrote %d rows as %s" % (size, outName)
-        inFile.close()
+        return stats
+
+    def partition(self, inName, outDir):
+        """Convert input data, partitioning into healpix fragments in outDir
+
+        The fragments are written into a temporary directory that is renamed
+        when complete, so an interrupted partition is redone on the next run.
+        Returns a dict of statistics, as for convert().
+        """
+        if os.path.exists(outDir):
+            print "Output directory %s exists; not clobbering" % outDir
+            return None
+        tempDir = outDir + ".tmp"
+        if os.path.exists(tempDir):
+            shutil.rmtree(tempDir)
+        os.makedirs(tempDir)
+
+        partitioner = HealpixPartitioner(tempDir, self.schema, self.nside, self.bufferRows,
+                                         extension=".parquet" if self.intermediate == "parquet" else ".fits",
+                                         unique="id" if self.dedupe else None, partition=self.adaptive)
+        stats = dict(writeTime=0.0)
+        for select, columns in self.read(inName, stats):
+            start = time.time()
+            partitioner.add(columns, select)
+            stats["writeTime"] += time.time() - start
+        start = time.time()
+        counts = partitioner.close()
+        stats["writeTime"] += time.time() - start
+        stats["rowsOut"] = sum(counts.values())
+        os.rename(tempDir, outDir)
+        print "Wrote %d rows in %d healpixes to %s" % (stats["rowsOut"], len(counts), outDir)
+        return stats
+
+    def split(self, inName):
+        """Read and filter an input, returning the selected rows split by shard
+
+        This is run by the workers when streaming (see streamShards()): the
+        rows are returned, as a list of dicts of shard id --> columns (one for
+        each chunk read), to be written by the parent.  Also returns a dict of
+        statistics, as for convert().
+        """
+        stats = {}
+        chunks = []
+        for select, columns in self.read(inName, stats):
+            rows = numpy.flatnonzero(select) if select is not None else None
+            ra, dec = (columns["ra"], columns["dec"]) if rows is None else (columns["ra"][rows], columns["dec"][rows])
+            shard = radecToHealpix(ra, dec, self.nside) if self.adaptive is None else self.adaptive.getShard(ra, dec)
+            chunks.append(splitByShard(columns, self.schema, shard, rows))
+        stats["rowsOut"] = sum(len(columns["ra"]) for pieces in chunks for columns in pieces.values())
+        return chunks, stats
+
+    def count(self, inName, outName):
+        """Count the selected input rows in each healpix at maxNside, saving the histogram as outName (.npy)
+
+        Returns a dict of statistics, as for convert().
+        """
+        counts = numpy.zeros(12*self.maxNside**2, dtype=numpy.int64)
+        stats = {}
+        for select, columns in self.read(inName, stats):
+            ra, dec = (columns["ra"], columns["dec"]) if select is None else \
+                (columns["ra"][select], columns["dec"][select])
+            counts += getHistogram(ra, dec, self.maxNside)
+        tempName = outName + ".tmp"
+        with open(tempName, "wb") as f:
+            numpy.save(f, counts)
+        os.rename(tempName, outName)
+        stats["rowsOut"] = int(counts.sum())
+        print "Counted %d rows in %d healpixes as %s" % (stats["rowsOut"], numpy.count_nonzero(counts), outName)
+        return stats
+
+    def gather(self, inList, outName):
+        """Gather the fragments for a single healpix into the shard outName (FITS)
+
+        With 'presort', the fragments are gathered into a temporary file, and
+        the rows (those kept, if culling) are written from it in order.
+        Returns a dict of statistics, as for convert().
+        """
+        unique = "id" if self.dedupe else None
+        if not self.presort:
+            size = concatenateCatalogs(inList, outName, self.schema, unique=unique)
+            print "Wrote %d rows as %s" % (size, outName)
+            return dict(rowsOut=size)
+
+        config = self.getSortConfig()
+        tempName = outName + ".tmp"
+        try:
+            rowsIn = concatenateCatalogs(inList, tempName, self.schema, unique=unique)
+            with pyfits.open(tempName, memmap=True) as inFile:
+                data = inFile[1].data
+                rows = getBrightest(data.field("ra"), data.field("dec"), data.field(config["column"]),
+                                    config["cullNside"], config["cullRows"])
+                del data
+            size = writeRows(tempName, outName, self.schema, rows)
+        finally:
+            removeArtifact(tempName)
+        print "Wrote %d of %d rows, sorted by %s, as %s" % (size, rowsIn, config["column"], outName)
+        return dict(rowsIn=rowsIn, rowsOut=size)
 
     def hpsplit(self, inputList):
         """Split the files into healpixes
@@ -138,55 +542,465 @@ class BuildAndCatalog(object):
         """
         out = "%s_hp_%%i.fits" % self.outputRoot
         args = "-r ra -d dec -n %d" % self.nside
-        system("hpsplit -o " + out + " " + args + " " + " ".join(inputList))
+        return runCommand("hpsplit -o " + out + " " + args + " " + " ".join(inputList), retries=self.retries)
 
-    def generateIndexes(self, inName, index, healpix=None):
-        """Generate astrometry.net indices
+    def getShardHealpix(self, shardId):
+        """Return the healpix and nside of a shard, identified as in its filename"""
+        if self.shardRows:
+            return splitUniqueId(shardId)
+        return shardId, self.nside
 
-        Only a single instance of this should be run per input;
-        inputs are usually divided into healpixes.
+    def getBuildArg(self, flag):
+        """Return the value of an argument (e.g., "-S") in the build arguments, or None if it's not there"""
+        args = self.buildArgs.split()
+        return args[args.index(flag) + 1] if flag in args[:-1] else None
+
+    def getSortConfig(self):
+        """Return the parameters for sorting and culling the shards (with 'presort')
+
+        The sort column and the number of sources to keep in each healpix
+        (when culling) are those build-astrometry-index would use: its -S
+        and -n arguments.
         """
+        column = self.getBuildArg("-S")
+        if column is None or column not in self.schema:
+            raise RuntimeError("Can't sort shards: no sort column (-S) in the schema for build arguments '%s'" %
+                               (self.buildArgs,))
+        if "-f" in self.buildArgs.split():
+            raise RuntimeError("Can't sort shards in descending order (-f)")
+        cullRows = int(self.getBuildArg("-n") or 10) if self.cullNside else 0 # 10 is the tool's default
+        return dict(column=column, cullNside=self.cullNside, cullRows=cullRows)
+
+    def getIndexCommand(self, inName, index, scale, healpix=None, nside=None):
+        """Return the command to generate an astrometry.net index, and the index filename
+
+        Scale 0 is built from the input catalog; the other scales are built
+        from the scale 0 index, so must be run after it.  The healpix is at
+        'nside' (default: that of the catalog).
+        """
+        if nside is None:
+            nside = self.nside
         outName = "%s_and_%d" % (self.outputRoot, index)
+        indexName = "%s_%d.fits" % (outName, scale)
         args = self.buildArgs[:] # Copy, so we're not overwriting when we append
+        if self.presort:
+            # The shards are already sorted; the tool takes its input as sorted without -S
+            args = re.sub(r"(^|\s)-S\s+\S+", "", args).strip()
         if healpix is not None:
             args += " -H %d" % healpix
-        if self.nside is not None:
-            args += " -s %d" % self.nside
-        if not os.path.exists(outName + "_0.fits"):
-            system("build-astrometry-index -i " + inName + " -o " + outName + "_0.fits -I " + str(index) + "0 -P 0 " + args)
-        if not os.path.exists(outName + "_1.fits"):
-            system("build-astrometry-index -1 " + outName + "_0.fits -o " + outName + "_1.fits -I " + str(index) + "1 -P 1 " + args)
-        if not os.path.exists(outName + "_2.fits"):
-            system("build-astrometry-index -1 " + outName + "_0.fits -o " + outName + "_2.fits -I " + str(index) + "2 -P 2 " + args)
-        if False:
-            # Don't need these: "-P 2  should work for images about 12 arcmin across" says build-astrometry-index
-            system("build-astrometry-index -1 " + outName + "_0.fits -o " + outName + "_3.fits -I " + str(index) + "3 -P 3 " + args)
-            system("build-astrometry-index -1 " + outName + "_0.fits -o " + outName + "_4.fits -I " + str(index) + "4 -P 4 " + args)
+        if nside is not None:
+            args += " -s %d" % nside
+        if scale == 0:
+            source = "-i " + inName
+        else:
+            source = "-1 " + outName + "_0.fits"
+        command = "build-astrometry-index %s -o %s -I %d%d -P %d %s" % (source, indexName, index, scale, scale, args)
+        return command, indexName
+
+    def generateIndex(self, inName, index, scale, healpix=None):
+        """Generate a single astrometry.net index
+
+        Returns the CommandResult, or None if the index already exists.
+        """
+        command, indexName = self.getIndexCommand(inName, index, scale, healpix=healpix)
+        if os.path.exists(indexName):
+            return None
+        try:
+            return runCommand(command, retries=self.retries)
+        except CommandError:
+            # Don't leave a partial index to be picked up by the next run
+            if os.path.exists(indexName):
+                os.unlink(indexName)
+            raise
+
+    def generateIndexes(self, inName, index, healpix=None):
+        """Generate astrometry.net indices at all scales
+
+        Only a single instance of this should be run per input;
+        inputs are usually divided into healpixes.
+        """
+        for scale in self.scales:
+            self.generateIndex(inName, index, scale, healpix=healpix)
 
     def run(self):
         """Create astrometry.net indices
 
-        Supports multiple 'threads' (though they're actually processes).
+        Supports multiple 'threads' (though they're actually processes):
+        a pool of workers is started for each stage of python processing,
+        and then closed before the external commands are run.
+
+        Artifacts are recorded in a manifest, <outputRoot>_manifest.json, and
+        only those whose inputs or parameters have changed (or are missing or
+        truncated) are rebuilt.
+
+        Each task is logged (time, rows, bytes and memory) to
+        <outputRoot>_runlog.jsonl, and a summary of the stages and the
+        critical path is printed at the end.
+
+        With a work queue, the queue is reset, the local workers are started
+        and, when done, the queue is closed so that the workers exit.
+        """
+        self.checkSelection()
+        manifest = Manifest("%s_manifest.json" % self.outputRoot)
+        log = RunLog("%s_runlog.jsonl" % self.outputRoot)
+        if self.workQueue is not None:
+            self.workQueue.reset()
+            self.workQueue.startWorkers(self.workers)
+        try:
+            if self.useHpsplit:
+                shardKeys = self.convertAndSplit(manifest, log)
+            elif self.stream:
+                shardKeys = self.streamShards(manifest, log)
+            else:
+                shardKeys = self.partitionAndGather(manifest, log)
+            self.generateAllIndexes(manifest, shardKeys, log)
+        finally:
+            if self.workQueue is not None:
+                self.workQueue.close()
+            log.summarize()
+
+    def makeExecutor(self, chunkSize=None):
+        """Return an executor for the python tasks: a local pool, or the work queue
+
+        'chunkSize' is the number of tasks sent to a local worker at a time
+        (see Executor).
         """
+        if self.workQueue is not None:
+            return QueueExecutor(self.workQueue, self)
+        return Executor(self.threads, self, chunkSize=chunkSize)
+
+    def makeScheduler(self):
+        """Return a scheduler for the external commands: local, or the work queue"""
+        if self.workQueue is not None:
+            return QueueScheduler(self.workQueue, self, retries=self.retries, failFast=self.failFast)
+        return Scheduler(self.threads, retries=self.retries, failFast=self.failFast)
+
+    def convertAndSplit(self, manifest, log=None):
+        """Convert each input, and split them into healpixes with hpsplit
+
+        Tasks are recorded in the RunLog 'log', if provided.  Returns a dict
+        mapping healpix --> manifest key for its shard.
+        """
+        if log is None:
+            log = RunLog()
+        config = self.getConfig()
         catList = []
-        mapSubset = MapFunc(self.threads, self.convert)
+        catKeys = []
+        built = []
         for i, inName in enumerate(self.inputList):
             catName = "%s_in_%d.fits" % (self.outputRoot, i)
+            key = makeKey(manifest.hashFile(inName), config)
             catList.append(catName)
-            if not os.path.exists(catName):
-                mapSubset.add(inName, catName)
-        mapSubset.run()
-        del mapSubset
+            catKeys.append(key)
+            if not manifest.isCurrent(catName, key):
+                removeArtifact(catName)
+                built.append((inName, catName, key))
+        with self.makeExecutor() as executor:
+            self.runStage(executor, "convert", built, manifest, log)
+
+        # hpsplit works on all the inputs at once, so every shard depends on all of them
+        key = makeKey(catKeys, self.nside)
+        shardList = glob.glob("%s_hp_*.fits" % self.outputRoot)
+        if not shardList or not all(manifest.isCurrent(shardName, key) for shardName in shardList):
+            for shardName in shardList:
+                manifest.forget(shardName)
+                removeArtifact(shardName)
+            with log.stage("split"):
+                result = self.hpsplit(catList)
+            shardList = glob.glob("%s_hp_*.fits" % self.outputRoot)
+            log.add("split", "hpsplit", end=time.time(), wall=result.wall, cpu=result.cpu,
+                    maxrss=result.maxrss/1024.0, bytesIn=getFileSize(catList), bytesOut=getFileSize(shardList))
+            for shardName in shardList:
+                manifest.record(shardName, key)
+            manifest.save()
+
+        shardKeys = {}
+        for shardName in shardList:
+            m = re.search(r"%s_hp_(\d+)\.fits" % self.outputRoot, shardName)
+            assert m, "Unable to match filename"
+            shardKeys[int(m.group(1))] = key
+        return shardKeys
+
+    def partitionAndGather(self, manifest, log=None):
+        """Split the inputs into healpixes without hpsplit
 
-        self.hpsplit(catList)
+        Each input is converted and partitioned into fragments by a worker,
+        and then the fragments for each healpix are gathered in parallel.
+        Only the shards with fragments from changed inputs are regathered.
+        With 'shardRows', the inputs are first counted to choose the shards
+        (see makePartition()).
 
-        mapIndexes = MapFunc(self.threads, self.generateIndexes)
-        for inName in glob.glob("%s_hp_*.fits" % self.outputRoot):
-            m = re.search(r"%s_hp_(\d+)\.fits" % self.outputRoot, inName)
+        Tasks are recorded in the RunLog 'log', if provided.  Returns a dict
+        mapping shard id (the healpix, or the unique id of an adaptive
+        partition's healpix) --> manifest key for its shard.
+        """
+        if log is None:
+            log = RunLog()
+        config = self.getConfig()
+        partList = []
+        partKeys = []
+        built = []
+        partition = self.choosePartition(manifest, log)
+        for i, inName in enumerate(self.inputList):
+            partDir = "%s_part_%d" % (self.outputRoot, i)
+            key = makeKey(manifest.hashFile(inName), config, partition)
+            partList.append(partDir)
+            partKeys.append(key)
+            if not manifest.isCurrent(partDir, key):
+                removeArtifact(partDir)
+                built.append((inName, partDir, key))
+        with self.makeExecutor() as executor:
+            self.runStage(executor, "partition", built, manifest, log)
+            shardKeys = self.gatherShards(executor, partList, partKeys, manifest, log)
+        return shardKeys
+
+    def streamShards(self, manifest, log=None):
+        """Split the inputs into healpixes, streaming the selected rows into the shards
+
+        Each input is read and filtered by a worker, which returns the rows
+        split by shard (see split()).  Only this process writes the shards:
+        it appends the rows of each input in turn (holding any that arrive
+        early until those of the inputs before them are written), so the
+        shards are the same however many workers there are.  Rows are
+        streamed into <outputRoot>_stream_<id>.fits and renamed when all are
+        written; with 'dedupe' or 'presort', they're rewritten as the shards
+        instead, in parallel (see gather()).
+
+        There are no per-input files, so every shard depends on every input,
+        and all are read again if any changes.  The indices are keyed on the
+        contents of their shards, so only those whose rows change are
+        rebuilt.  With 'shardRows', the inputs are first counted to choose
+        the shards (see makePartition()).
+
+        Tasks are recorded in the RunLog 'log', if provided.  Returns a dict
+        mapping shard id --> manifest key for its shard, as for
+        partitionAndGather().
+        """
+        if log is None:
+            log = RunLog()
+        partition = self.choosePartition(manifest, log)
+        key = makeKey([manifest.hashFile(inName) for inName in self.inputList], self.getConfig(), partition)
+        if self.presort:
+            key = makeKey(key, self.getSortConfig())
+        shardList = glob.glob("%s_hp_*.fits" % self.outputRoot)
+        if not shardList or not all(manifest.isCurrent(shardName, key) for shardName in shardList):
+            for shardName in shardList:
+                manifest.forget(shardName)
+                removeArtifact(shardName)
+            streamTemplate = "%s_stream_%%d.fits" % self.outputRoot
+            for streamName in glob.glob(streamTemplate.replace("%d", "*")): # From an interrupted run
+                removeArtifact(streamName)
+            # One task at a time per worker, so few inputs are held waiting for their turn to be written
+            with self.makeExecutor(chunkSize=1) as executor:
+                counts = self.writeStreams(executor, streamTemplate, log)
+                self.removeOldShards(manifest, counts)
+                built = []
+                for shardId in sorted(counts):
+                    streamName = streamTemplate % shardId
+                    shardName = "%s_hp_%d.fits" % (self.outputRoot, shardId)
+                    if self.dedupe or self.presort:
+                        built.append(([streamName], shardName, key))
+                    else:
+                        os.rename(streamName, shardName)
+                        manifest.record(shardName, key)
+                built.sort(key=lambda b: getFileSize(b[0]), reverse=True)
+                self.runStage(executor, "gather", built, manifest, log)
+            for inList, _, _ in built:
+                removeArtifact(inList[0])
+            shardList = glob.glob("%s_hp_*.fits" % self.outputRoot)
+
+        shardKeys = {}
+        for shardName in shardList:
+            m = re.search(r"%s_hp_(\d+)\.fits" % self.outputRoot, shardName)
             assert m, "Unable to match filename"
-            healpix = int(m.group(1))
-            mapIndexes.add(inName, healpix, healpix=healpix)
-        mapIndexes.run()
+            shardKeys[int(m.group(1))] = makeKey(manifest.hashFile(shardName))
+        manifest.save()
+        return shardKeys
+
+    def writeStreams(self, executor, template, log):
+        """Split the inputs in the workers, appending their rows to the files named 'template' % shard id
+
+        The rows are written in the order of the inputs.  Returns a dict of
+        shard id --> number of rows written.
+        """
+        writer = ShardWriter(template, self.schema, self.bufferRows)
+        waiting = {}
+        nextIndex = 0
+        with log.stage("split"):
+            for index, ((chunks, stats), usage) in executor.imap("split", [(inName,) for inName in self.inputList],
+                                                                 measure=True):
+                inName = self.inputList[index]
+                usage.update(stats)
+                log.add("split", os.path.basename(inName), bytesIn=getFileSize(inName), **usage)
+                waiting[index] = chunks
+                while nextIndex in waiting:
+                    for pieces in waiting.pop(nextIndex):
+                        writer.add(pieces)
+                    nextIndex += 1
+            counts = writer.close()
+        print "Streamed %d rows from %d inputs into %d shards" % (sum(counts.values()), len(self.inputList),
+                                                                   len(counts))
+        return counts
+
+    def choosePartition(self, manifest, log):
+        """Choose the shards, returning the configuration of the partition for the manifest keys
+
+        With 'shardRows', this is an adaptive partition (see makePartition());
+        otherwise, the healpixes at 'nside'.
+        """
+        self.adaptive = None
+        if self.shardRows:
+            # Workers must be started after the partition is chosen, so they get it
+            with self.makeExecutor() as executor:
+                self.adaptive = self.makePartition(executor, manifest, log)
+        else:
+            removeArtifact("%s_shards.json" % self.outputRoot) # From an adaptive run
+        return self.adaptive.getConfig() if self.adaptive is not None else self.nside
+
+    def makePartition(self, executor, manifest, log):
+        """Choose the shards for an adaptive partition, from the histograms of the inputs
+
+        The histogram of each input is saved, and only recounted if the input
+        or configuration changes.  The partition is written as
+        <outputRoot>_shards.json.
+        """
+        config = self.getConfig()
+        countList = []
+        built = []
+        for i, inName in enumerate(self.inputList):
+            countName = "%s_count_%d.npy" % (self.outputRoot, i)
+            key = makeKey(manifest.hashFile(inName), config, self.maxNside)
+            countList.append(countName)
+            if not manifest.isCurrent(countName, key):
+                removeArtifact(countName)
+                built.append((inName, countName, key))
+        self.runStage(executor, "count", built, manifest, log)
+
+        counts = numpy.zeros(12*self.maxNside**2, dtype=numpy.int64)
+        for countName in countList:
+            counts += numpy.load(countName)
+        partition = AdaptivePartition.fromHistogram(counts, self.minNside, self.maxNside, self.shardRows)
+        partition.write("%s_shards.json" % self.outputRoot)
+        rows = [r for _, r in partition.shards]
+        print "Partitioned %d rows into %d shards of nside %d to %d, with up to %d rows" % \
+            (counts.sum(), len(rows), self.minNside, self.maxNside, max(rows) if rows else 0)
+        return partition
+
+    def runStage(self, executor, method, built, manifest, log):
+        """Run a method for each (input, output, key) in 'built', recording outputs as they're done
+
+        Each task is recorded in the RunLog 'log', under the name of its
+        output, with its resource use, the sizes of its input and output,
+        and the statistics returned by the method.  The manifest is saved
+        when everything is done, or on failure.
+        """
+        try:
+            with log.stage(method):
+                for index, (stats, usage) in executor.imap(method, [(inName, outName) for
+                                                                    inName, outName, _ in built], measure=True):
+                    inName, outName, key = built[index]
+                    manifest.record(outName, key)
+                    usage.update(stats if stats is not None else {})
+                    log.add(method, os.path.basename(outName), bytesIn=getFileSize(inName),
+                            bytesOut=getFileSize(outName), **usage)
+        finally:
+            manifest.save()
+
+    def gatherShards(self, executor, partList, partKeys, manifest, log):
+        """Gather the fragments in the partition directories into a shard per healpix
+
+        Returns a dict mapping shard id --> manifest key for its shard.
+        """
+        fragments = {}
+        for partDir, partKey in zip(partList, partKeys):
+            for fragName in glob.glob(os.path.join(partDir, "hp_*_*.*")):
+                m = re.search(r"hp_(\d+)_\d+\.\w+$", fragName)
+                assert m, "Unable to match filename"
+                fragments.setdefault(int(m.group(1)), []).append((fragName, partKey))
+
+        shardKeys = {}
+        built = []
+        for shardId, fragList in sorted(fragments.items()):
+            fragList.sort()
+            shardName = "%s_hp_%d.fits" % (self.outputRoot, shardId)
+            key = makeKey([(os.path.basename(fragName), partKey) for fragName, partKey in fragList])
+            if self.presort:
+                key = makeKey(key, self.getSortConfig())
+            shardKeys[shardId] = key
+            if not manifest.isCurrent(shardName, key):
+                removeArtifact(shardName)
+                built.append(([fragName for fragName, _ in fragList], shardName, key))
+        # Largest first, so the big ones aren't left to the end
+        built.sort(key=lambda b: getFileSize(b[0]), reverse=True)
+        self.removeOldShards(manifest, shardKeys)
+        self.runStage(executor, "gather", built, manifest, log)
+        return shardKeys
+
+    def removeOldShards(self, manifest, shardIds):
+        """Remove shards (and their indices) not in 'shardIds', so they aren't mistaken for current ones
+
+        These are left by an earlier partition.
+        """
+        for oldName in glob.glob("%s_hp_*.fits" % self.outputRoot) + glob.glob("%s_and_*_*.fits" % self.outputRoot):
+            m = re.search(r"_(?:hp|and)_(\d+)(?:_\d+)?\.fits$", oldName)
+            if m and int(m.group(1)) not in shardIds:
+                manifest.forget(oldName)
+                removeArtifact(oldName)
+
+    def generateAllIndexes(self, manifest, shardKeys, log=None):
+        """Generate the indices for each healpix shard
+
+        Each index scale is a separate task, started as soon as its scale 0
+        parent is done.  The largest shards are started first.  Tasks are
+        recorded in the RunLog 'log', if provided.
+        """
+        if log is None:
+            log = RunLog()
+        scheduler = self.makeScheduler()
+        keys = {}
+        sources = {}
+        shardNames = dict((shardId, "%s_hp_%d.fits" % (self.outputRoot, shardId)) for shardId in shardKeys)
+        for shardId in sorted(shardKeys, key=lambda i: (-getFileSize(shardNames[i]), i)):
+            inName = shardNames[shardId]
+            healpix, nside = self.getShardHealpix(shardId)
+            parent = "and_%d_0" % shardId
+            for scale in self.scales:
+                command, indexName = self.getIndexCommand(inName, shardId, scale, healpix=healpix, nside=nside)
+                name = "and_%d_%d" % (shardId, scale)
+                keys[name] = (indexName, makeKey(shardKeys[shardId], command) if scale == 0 else
+                              makeKey(keys[parent][1], command))
+                sources[name] = inName if scale == 0 else keys[parent][0]
+                if manifest.isCurrent(*keys[name]):
+                    continue
+                manifest.forget(indexName)
+                removeArtifact(indexName)
+                depends = [parent] if scale != 0 and parent in scheduler.tasks else []
+                scheduler.addCommand(name, command, depends=depends, outputs=[indexName])
+        try:
+            with log.stage("index"):
+                scheduler.run()
+        finally:
+            # Record whatever succeeded, even if something else failed
+            done = [scheduler.tasks[name] for name in scheduler.order if scheduler.tasks[name].error is None and
+                    scheduler.tasks[name].result is not None]
+            for task in done:
+                manifest.record(*keys[task.name])
+            manifest.save()
+            for name in scheduler.order:
+                task = scheduler.tasks[name]
+                if task.end is None:
+                    continue
+                values = dict(start=task.end - task.elapsed, end=task.end, wall=task.elapsed,
+                              depends=sorted(task.depends), bytesIn=getFileSize(sources[name]),
+                              bytesOut=getFileSize(keys[name][0]), error=task.error)
+                if task.result is not None:
+                    values.update(cpu=task.result.cpu, maxrss=task.result.maxrss/1024.0,
+                                  attempts=task.result.attempts)
+                log.add("index", name, **values)
+
+        if done:
+            print "build-astrometry-index: %d runs, %.1f sec CPU, %.0f MB max RSS" % \
+                (len(done), sum(t.result.cpu for t in done), max(t.result.maxrss for t in done)/1024.0)
 
     @classmethod
     def parseAndRun(cls):
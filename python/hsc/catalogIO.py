@@ -0,0 +1,316 @@
+"""
+Read and write catalogs as FITS binary tables or Parquet files
+
+The format is chosen by the filename extension.  Catalogs are read in chunks
+of rows and written by appending chunks, so neither need be held in memory.
+
+Parquet is columnar, so only the columns that are needed are read (FITS rows
+must be read whole), and each row group carries the minimum and maximum of
+its columns, so row groups that can't pass a cut can be skipped without being
+read at all.  Parquet requires pyarrow.
+"""
+
+import os
+from collections import OrderedDict
+
+import numpy
+import pyfits
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .fitsTable import MemmapTableWriter
+
+__all__ = ["ColumnTable", "isParquet", "readChunks", "getSchema", "getColumnNames", "openWriter", "writeCatalog",
+           "concatenateCatalogs", "convertCatalog", "ParquetTableWriter", "selectUnique", "selectRows",
+           "writeRows",]
+
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+
+# Arrow types for the FITS binary table formats we write
+ARROW_TYPES = {'L': "bool_", 'B': "uint8", 'I': "int16", 'J': "int32", 'K': "int64", 'E': "float32",
+               'D': "float64",}
+
+
+def isParquet(filename):
+    """Is this a Parquet file (by its extension)?"""
+    return os.path.splitext(filename)[1].lower() in PARQUET_EXTENSIONS
+
+
+def requirePyarrow():
+    if pyarrow is None:
+        raise RuntimeError("pyarrow is required for Parquet catalogs")
+
+
+class ColumnTable(object):
+    """Columns read from a Parquet file, looking enough like a pyfits table for filter()
+
+    Columns are available as field(name) or as attributes.
+    """
+    def __init__(self, columns):
+        self.columns = columns
+
+    @property
+    def names(self):
+        return list(self.columns)
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def field(self, name):
+        return self.columns[name]
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__["columns"][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, index):
+        return ColumnTable(dict((name, array[index]) for name, array in self.columns.items()))
+
+
+def selectRows(data, select, columns=None):
+    """Return the selected rows of a table (pyfits or ColumnTable)
+
+    If 'columns' is not None, only those are copied (as a ColumnTable).
+    """
+    if columns is None:
+        return data[select]
+    return ColumnTable(dict((name, data.field(name)[select]) for name in columns))
+
+
+def getStatistics(rowGroup):
+    """Return the statistics of a Parquet row group: a dict of column name --> (min, max)"""
+    stats = {}
+    for i in range(rowGroup.num_columns):
+        column = rowGroup.column(i)
+        if column.statistics is not None and column.statistics.has_min_max:
+            stats[column.path_in_schema] = (column.statistics.min, column.statistics.max)
+    return stats
+
+
+def toNumpy(column):
+    """Convert an Arrow column to a numpy array"""
+    chunks = [chunk.to_numpy(zero_copy_only=False) for chunk in column.chunks]
+    return chunks[0] if len(chunks) == 1 else numpy.concatenate(chunks)
+
+
+def readFitsChunks(filename, chunkRows, verbose=False):
+    """Read a FITS binary table in chunks, memory-mapped"""
+    inFile = pyfits.open(filename, memmap=True)
+    data = inFile[1].data
+    num = len(data)
+    chunkRows = chunkRows if chunkRows > 0 else max(num, 1)
+    if verbose:
+        print "Read %d rows from %s" % (num, filename)
+    for start in range(0, num, chunkRows):
+        yield data[start:start + chunkRows]
+    del data
+    inFile.close()
+
+
+def readParquetChunks(filename, chunkRows, columns=None, keepRowGroup=None, verbose=False):
+    """Read a Parquet file in chunks, skipping row groups rejected by keepRowGroup"""
+    requirePyarrow()
+    inFile = pyarrow.parquet.ParquetFile(filename)
+    metadata = inFile.metadata
+    if verbose:
+        print "Read %d rows from %s" % (metadata.num_rows, filename)
+    skipped = 0
+    for i in range(metadata.num_row_groups):
+        rowGroup = metadata.row_group(i)
+        if keepRowGroup is not None and not keepRowGroup(getStatistics(rowGroup)):
+            skipped += rowGroup.num_rows
+            continue
+        table = inFile.read_row_group(i, columns=columns)
+        data = ColumnTable(dict((name, toNumpy(table.column(name))) for name in table.schema.names))
+        num = len(data)
+        step = chunkRows if chunkRows > 0 else max(num, 1)
+        for start in range(0, num, step):
+            yield data[start:start + step] if step < num else data
+    if skipped > 0 and verbose:
+        print "Skipped %d rows in %s that can't pass the cuts" % (skipped, filename)
+
+
+def readChunks(filename, chunkRows=0, columns=None, keepRowGroup=None, verbose=False):
+    """Read a catalog in chunks of up to 'chunkRows' rows (zero for all at once)
+
+    This is a generator, yielding a table for each chunk.  For Parquet,
+    only the 'columns' listed (if not None) are read, and row groups are
+    skipped if 'keepRowGroup' (if not None), given the statistics for the
+    row group (a dict of column name --> (min, max)), returns False.
+    """
+    if isParquet(filename):
+        return readParquetChunks(filename, chunkRows, columns=columns, keepRowGroup=keepRowGroup, verbose=verbose)
+    return readFitsChunks(filename, chunkRows, verbose=verbose)
+
+
+def getColumnNames(filename):
+    """Return the names of all the columns of a catalog, of whatever type"""
+    if isParquet(filename):
+        requirePyarrow()
+        return [field.name for field in pyarrow.parquet.read_schema(filename)]
+    with pyfits.open(filename) as inFile:
+        return list(inFile[1].columns.names)
+
+
+def getSchema(filename, columns=None):
+    """Return the schema (dict of column name --> FITS format) of a catalog
+
+    Only the 'columns' listed (if not None) are included.  Columns of types
+    we can't write (e.g., strings and arrays) are omitted.
+    """
+    schema = OrderedDict()
+    if isParquet(filename):
+        requirePyarrow()
+        types = [(getattr(pyarrow, name)(), fmt) for fmt, name in ARROW_TYPES.items()]
+        for field in pyarrow.parquet.read_schema(filename):
+            formats = [fmt for dataType, fmt in types if field.type.equals(dataType)]
+            if formats:
+                schema[field.name] = formats[0]
+    else:
+        with pyfits.open(filename) as inFile:
+            for column in inFile[1].columns:
+                fmt = str(column.format).lstrip("1")
+                if fmt in ARROW_TYPES:
+                    schema[column.name] = fmt
+    if columns is not None:
+        missing = set(columns) - set(schema)
+        if missing:
+            raise RuntimeError("Columns not present in %s: %s" % (filename, sorted(missing)))
+        schema = OrderedDict((col, schema[col]) for col in columns)
+    return schema
+
+
+class ParquetTableWriter(object):
+    """Write a Parquet file incrementally, with a row group for each append
+
+    The interface is that of fitsTable.MemmapTableWriter.
+    """
+    def __init__(self, filename, schema):
+        requirePyarrow()
+        self.filename = filename
+        self.schema = schema
+        fields = []
+        for col in schema:
+            if schema[col] not in ARROW_TYPES:
+                raise RuntimeError("Unsupported format for Parquet column %s: %s" % (col, schema[col]))
+            fields.append(pyarrow.field(col, getattr(pyarrow, ARROW_TYPES[schema[col]])()))
+        self.arrowSchema = pyarrow.schema(fields)
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.arrowSchema)
+        self.num = 0
+
+    def append(self, columns, select=None):
+        """Append rows (dict of column name --> array); returns the number of rows appended
+
+        'select' is an optional boolean mask or index array selecting the rows of the columns to write.
+        """
+        arrays = []
+        for field in self.arrowSchema:
+            column = numpy.asarray(columns[field.name])
+            if select is not None:
+                column = column[select]
+            arrays.append(pyarrow.array(column.astype(field.type.to_pandas_dtype(), copy=False), type=field.type))
+        sizes = set(len(array) for array in arrays)
+        if len(sizes) != 1:
+            raise RuntimeError("Column sizes are inconsistent: %s" % sorted(sizes))
+        size = sizes.pop()
+        if size > 0:
+            self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.arrowSchema))
+        self.num += size
+        return size
+
+    def close(self):
+        """Close the file; returns the number of rows written"""
+        self.writer.close()
+        return self.num
+
+
+def openWriter(filename, schema, parquet=None):
+    """Return a writer for a catalog, with methods append(columns, select=None) and close()
+
+    The format is chosen by the filename extension unless 'parquet' is set.
+    """
+    if parquet if parquet is not None else isParquet(filename):
+        return ParquetTableWriter(filename, schema)
+    return MemmapTableWriter(filename, schema)
+
+
+def writeCatalog(filename, schema, columns):
+    """Write columns (dict of column name --> array) as a catalog; returns the number of rows written"""
+    writer = openWriter(filename, schema)
+    writer.append(columns)
+    return writer.close()
+
+
+def selectUnique(values, select=None):
+    """Return a boolean selection of the first row with each value, among the rows selected (if not None)"""
+    values = numpy.asarray(values)
+    rows = numpy.flatnonzero(select) if select is not None else numpy.arange(len(values))
+    first = numpy.unique(values[rows], return_index=True)[1]
+    result = numpy.zeros(len(values), dtype=bool)
+    result[rows[first]] = True
+    return result
+
+
+def concatenateCatalogs(inList, outName, schema, unique=None):
+    """Concatenate catalogs sharing a schema into a single catalog
+
+    The inputs may be of either format.  If 'unique' names a column, only
+    the first row with each value of that column is written (the column is
+    read first, to find them).  Returns the number of rows written.
+    """
+    keep = None
+    if unique is not None:
+        values = []
+        for inName in inList:
+            chunks = [numpy.asarray(data.field(unique)) for data in readChunks(inName, columns=[unique])]
+            values.append(numpy.concatenate(chunks) if chunks else numpy.empty(0, dtype=numpy.int64))
+        sizes = [len(v) for v in values]
+        keep = numpy.split(selectUnique(numpy.concatenate(values)), numpy.cumsum(sizes)[:-1])
+        del values
+    writer = openWriter(outName, schema)
+    for i, inName in enumerate(inList):
+        start = 0
+        for data in readChunks(inName, columns=list(schema)):
+            select = keep[i][start:start + len(data)] if keep is not None else None
+            start += len(data)
+            writer.append(dict((col, data.field(col)) for col in schema), select)
+    return writer.close()
+
+
+def writeRows(inName, outName, schema, rows, chunkRows=1000000):
+    """Write the listed rows (indices, in the order given) of a FITS catalog as a new catalog
+
+    The input is memory-mapped, and the rows are written 'chunkRows' at a
+    time.  Returns the number of rows written.
+    """
+    writer = openWriter(outName, schema)
+    with pyfits.open(inName, memmap=True) as inFile:
+        data = inFile[1].data
+        columns = {}
+        for start in range(0, len(rows), chunkRows):
+            index = rows[start:start + chunkRows]
+            for col in schema:
+                columns[col] = data.field(col)[index]
+            writer.append(columns)
+        del data, columns
+    return writer.close()
+
+
+def convertCatalog(inName, outName, columns=None, chunkRows=100000):
+    """Convert a catalog between formats (e.g., FITS input to Parquet)
+
+    Only the 'columns' listed (if not None) are included.  Each chunk of
+    'chunkRows' rows becomes a Parquet row group, which is the granularity
+    at which rows can be skipped when reading.  Returns the number of rows.
+    """
+    schema = getSchema(inName, columns)
+    writer = openWriter(outName, schema)
+    for data in readChunks(inName, chunkRows, columns=list(schema)):
+        writer.append(dict((col, data.field(col)) for col in schema))
+    return writer.close()
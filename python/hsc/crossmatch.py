@@ -0,0 +1,282 @@
+"""
+Positional cross-match of two catalogs
+
+Both catalogs are divided into healpixes in the astrometry.net numbering,
+at the same nside as the BuildAndCatalog shards (so a set of shards,
+'<root>_hp_<healpix>.fits', can be used as is; any other catalog is
+partitioned first).  Each healpix of the first catalog is then matched in a
+separate task: the sources of the second catalog in that healpix and in any
+neighbouring healpix within the match radius go into a k-d tree of unit
+vectors, and the nearest within the radius is found for each source.
+
+The output, '<root>_hp_<healpix>.fits' for each healpix of the first
+catalog, has the position of the first catalog, the separation (arcsec), and
+the columns of both catalogs prefixed by their names (e.g., 'ps1_g' and
+'sdss_g'), so it can be fed to BuildAndCatalog or matched again.  Several
+sources in the first catalog may match the same source in the second.
+"""
+
+import re
+import os
+import glob
+import shutil
+from collections import OrderedDict
+from argparse import ArgumentParser
+
+import numpy
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+from .catalogIO import readChunks, getSchema, writeCatalog
+from .healpix import radecToHealpix, HealpixPartitioner
+from .region import radecToVector
+from .executor import Executor
+
+__all__ = ["CrossMatch", "getNeighbours",]
+
+
+def requireScipy():
+    if cKDTree is None:
+        raise RuntimeError("scipy is required for cross-matching")
+
+
+# Directions (radians, east of north) in which to look for neighbouring healpixes
+NEIGHBOUR_ANGLES = numpy.radians(numpy.arange(0.0, 360.0, 45.0))
+
+
+def getNeighbours(ra, dec, radius, nside):
+    """Return the healpixes within 'radius' (arcsec) of any of the positions (degrees)
+
+    Each position is offset by the radius along great circles in eight
+    directions, which is enough to find the healpixes overlapping the match
+    circle unless the radius is comparable to the healpix size.
+    """
+    ra = numpy.radians(numpy.asarray(ra, dtype=numpy.float64))
+    dec = numpy.radians(numpy.asarray(dec, dtype=numpy.float64))
+    radius = numpy.radians(radius/3600.0)
+    sinRa, cosRa = numpy.sin(ra), numpy.cos(ra)
+    sinDec, cosDec = numpy.sin(dec), numpy.cos(dec)
+    neighbours = set(numpy.unique(radecToHealpix(numpy.degrees(ra), numpy.degrees(dec), nside)).tolist())
+    for angle in NEIGHBOUR_ANGLES:
+        # Offset along the great circle through the position at this angle
+        north = numpy.cos(angle)*numpy.sin(radius)
+        east = numpy.sin(angle)*numpy.sin(radius)
+        x = numpy.cos(radius)*cosDec*cosRa - north*sinDec*cosRa - east*sinRa
+        y = numpy.cos(radius)*cosDec*sinRa - north*sinDec*sinRa + east*cosRa
+        z = numpy.cos(radius)*sinDec + north*cosDec
+        offsetRa = numpy.degrees(numpy.arctan2(y, x))
+        offsetDec = numpy.degrees(numpy.arcsin(numpy.clip(z, -1.0, 1.0)))
+        neighbours.update(numpy.unique(radecToHealpix(offsetRa, offsetDec, nside)).tolist())
+    return neighbours
+
+
+def readColumns(fileList, schema):
+    """Read and concatenate the schema columns of catalogs, returning a dict of column name --> array"""
+    pieces = dict((col, []) for col in schema)
+    for filename in fileList:
+        for data in readChunks(filename, columns=list(schema)):
+            for col in schema:
+                pieces[col].append(numpy.asarray(data.field(col)))
+    return dict((col, numpy.concatenate(pieces[col]) if pieces[col] else numpy.empty(0)) for col in schema)
+
+
+def getMissingValue(fmt):
+    """Return the value for a column of this FITS format when there's no match"""
+    if fmt in ("E", "D"):
+        return numpy.nan
+    if fmt == "L":
+        return False
+    return -1
+
+
+class CrossMatch(object):
+    """Match the sources of one catalog to the nearest in another within a radius
+
+    Each catalog is either the root name of a set of healpix shards (as
+    written by BuildAndCatalog with the same 'nside') or a catalog file with
+    'ra' and 'dec' columns, which is partitioned into '<outputRoot>_<name>_part'.
+    The 'names' of the catalogs prefix their columns in the output.  The
+    'radius' is in arcsec.  Unless 'keepUnmatched', sources in the first
+    catalog without a match aren't written.
+    """
+    def __init__(self, inputs, names, outputRoot, radius=1.0, nside=32, threads=0, bufferRows=1000000,
+                 keepUnmatched=False):
+        if len(inputs) != 2 or len(names) != 2:
+            raise RuntimeError("Need two catalogs and two names: %s, %s" % (inputs, names))
+        if names[0] == names[1]:
+            raise RuntimeError("Catalog names must differ: %s" % (names,))
+        requireScipy()
+        self.inputs = inputs
+        self.names = names
+        self.outputRoot = outputRoot
+        self.radius = radius
+        self.nside = nside
+        self.threads = threads
+        self.bufferRows = bufferRows
+        self.keepUnmatched = keepUnmatched
+        self.schemas = [None, None]
+        self.shards = [None, None]
+
+    @classmethod
+    def parse(cls):
+        """Parse command-line arguments, returning a constructed CrossMatch object."""
+        parser = ArgumentParser()
+        parser.add_argument("first", help="First catalog: shard root name or catalog file")
+        parser.add_argument("second", help="Second catalog: shard root name or catalog file")
+        parser.add_argument("-n", "--names", nargs=2, default=["a", "b"], help="Names of the catalogs")
+        parser.add_argument("-o", "--output", required=True, help="Output root name")
+        parser.add_argument("-r", "--radius", type=float, default=1.0, help="Match radius (arcsec)")
+        parser.add_argument("-s", "--nside", type=int, default=32, help="HEALPix nside (power of 2)")
+        parser.add_argument("-j", dest="threads", type=int, default=0, help="Number of threads")
+        parser.add_argument("--buffer", dest="bufferRows", type=int, default=1000000,
+                            help="Rows to buffer when partitioning")
+        parser.add_argument("--unmatched", dest="keepUnmatched", action="store_true", default=False,
+                            help="Write sources in the first catalog without a match")
+        args = parser.parse_args()
+        return cls([args.first, args.second], args.names, args.output, radius=args.radius, nside=args.nside,
+                   threads=args.threads, bufferRows=args.bufferRows, keepUnmatched=args.keepUnmatched)
+
+    def findShards(self, root):
+        """Return a dict of healpix --> list of files for a set of shards, or None if there are none"""
+        shards = {}
+        for shardName in glob.glob("%s_hp_*.fits" % root):
+            m = re.search(r"_hp_(\d+)\.fits$", shardName)
+            if m:
+                shards[int(m.group(1))] = [shardName]
+        if not shards:
+            return None
+        if os.path.exists("%s_shards.json" % root):
+            raise RuntimeError("Shards %s_hp_*.fits are of different nside (adaptive); use the catalogs" % (root,))
+        if max(shards) >= 12*self.nside**2:
+            raise RuntimeError("Shards %s_hp_*.fits weren't made with nside=%d" % (root, self.nside))
+        return shards
+
+    def partition(self, inName, outDir):
+        """Partition a catalog into healpix fragments in outDir"""
+        if os.path.exists(outDir):
+            print "Output directory %s exists; not clobbering" % outDir
+            return
+        tempDir = outDir + ".tmp"
+        if os.path.exists(tempDir):
+            shutil.rmtree(tempDir)
+        os.makedirs(tempDir)
+        schema = getSchema(inName)
+        partitioner = HealpixPartitioner(tempDir, schema, self.nside, self.bufferRows)
+        for data in readChunks(inName, self.bufferRows, columns=list(schema)):
+            partitioner.add(dict((col, data.field(col)) for col in schema))
+        counts = partitioner.close()
+        os.rename(tempDir, outDir)
+        print "Wrote %d rows in %d healpixes to %s" % (sum(counts.values()), len(counts), outDir)
+
+    def findFragments(self, partDir):
+        """Return a dict of healpix --> list of fragments in a partition directory"""
+        shards = {}
+        for fragName in glob.glob(os.path.join(partDir, "hp_*_*.fits")):
+            m = re.search(r"hp_(\d+)_\d+\.fits$", fragName)
+            assert m, "Unable to match filename"
+            shards.setdefault(int(m.group(1)), []).append(fragName)
+        return dict((healpix, sorted(fragList)) for healpix, fragList in shards.items())
+
+    def getOutputSchema(self):
+        """Return the schema of the output: position, separation and the prefixed columns of both catalogs"""
+        schema = OrderedDict([("ra", "D"), ("dec", "D"), ("separation", "E")])
+        for name, inSchema in zip(self.names, self.schemas):
+            for col, fmt in inSchema.items():
+                schema["%s_%s" % (name, col)] = fmt
+        return schema
+
+    def matchHealpix(self, healpix, outName):
+        """Match the sources of the first catalog in a healpix, writing outName
+
+        Returns the number of sources read and the number matched.
+        """
+        first = readColumns(self.shards[0][healpix], self.schemas[0])
+        num = len(first["ra"])
+        if numpy.any(radecToHealpix(first["ra"], first["dec"], self.nside) != healpix):
+            raise RuntimeError("Sources in %s aren't in healpix %d at nside=%d" %
+                               (self.shards[0][healpix], healpix, self.nside))
+
+        neighbours = getNeighbours(first["ra"], first["dec"], self.radius, self.nside) if num > 0 else set()
+        second = readColumns(sum((self.shards[1][hp] for hp in sorted(neighbours) if hp in self.shards[1]), []),
+                             self.schemas[1])
+
+        # Chord length between unit vectors separated by the radius
+        chord = 2.0*numpy.sin(0.5*numpy.radians(self.radius/3600.0))
+        if num > 0 and len(second["ra"]) > 0:
+            tree = cKDTree(radecToVector(second["ra"], second["dec"]), balanced_tree=False, compact_nodes=False)
+            distance, index = tree.query(radecToVector(first["ra"], first["dec"]), distance_upper_bound=chord)
+            matched = numpy.isfinite(distance)
+        else:
+            distance = numpy.full(num, numpy.inf)
+            index = numpy.zeros(num, dtype=int)
+            matched = numpy.zeros(num, dtype=bool)
+        numMatched = int(matched.sum())
+
+        rows = numpy.arange(num) if self.keepUnmatched else numpy.flatnonzero(matched)
+        schema = self.getOutputSchema()
+        columns = {"ra": first["ra"][rows], "dec": first["dec"][rows]}
+        separation = numpy.full(len(rows), numpy.nan, dtype=numpy.float32)
+        isMatched = matched[rows]
+        separation[isMatched] = 3600.0*numpy.degrees(2.0*numpy.arcsin(0.5*distance[rows][isMatched]))
+        columns["separation"] = separation
+        for col in self.schemas[0]:
+            columns["%s_%s" % (self.names[0], col)] = first[col][rows]
+        matchIndex = index[rows][isMatched]
+        for col, fmt in self.schemas[1].items():
+            outCol = "%s_%s" % (self.names[1], col)
+            values = numpy.empty(len(rows), dtype=second[col].dtype)
+            values.fill(getMissingValue(fmt))
+            values[isMatched] = second[col][matchIndex]
+            columns[outCol] = values
+
+        tempName = outName + ".tmp"
+        writeCatalog(tempName, schema, columns)
+        os.rename(tempName, outName)
+        print "Matched %d of %d sources in healpix %d" % (numMatched, num, healpix)
+        return num, numMatched
+
+    def run(self):
+        """Cross-match the catalogs
+
+        Catalog files are partitioned (in parallel), and then the healpixes
+        are matched in parallel.  Outputs that exist are not rebuilt.
+        """
+        toPartition = []
+        for i, (source, name) in enumerate(zip(self.inputs, self.names)):
+            self.shards[i] = self.findShards(source)
+            if self.shards[i] is None:
+                if not os.path.isfile(source):
+                    raise RuntimeError("No shards %s_hp_*.fits or catalog file %s" % (source, source))
+                toPartition.append((source, "%s_%s_part" % (self.outputRoot, name)))
+        with Executor(self.threads, self) as executor:
+            executor.map("partition", toPartition)
+
+        for i, source in enumerate(self.inputs):
+            if self.shards[i] is None:
+                self.shards[i] = self.findFragments("%s_%s_part" % (self.outputRoot, self.names[i]))
+                self.schemas[i] = getSchema(source)
+            else:
+                self.schemas[i] = getSchema(next(iter(self.shards[i].values()))[0])
+            if "ra" not in self.schemas[i] or "dec" not in self.schemas[i]:
+                raise RuntimeError("Don't have 'ra' and 'dec' columns in %s" % (source,))
+
+        matchArgs = []
+        for healpix in sorted(self.shards[0]):
+            outName = "%s_hp_%d.fits" % (self.outputRoot, healpix)
+            if os.path.exists(outName):
+                print "Output file %s exists; not clobbering" % outName
+                continue
+            matchArgs.append((healpix, outName))
+        # Workers are started now, so they inherit the shards and schemas
+        with Executor(self.threads, self) as executor:
+            results = executor.map("matchHealpix", matchArgs)
+        if results:
+            print "Matched %d of %d sources in %d healpixes within %.2f arcsec" % \
+                (sum(r[1] for r in results), sum(r[0] for r in results), len(results), self.radius)
+
+    @classmethod
+    def parseAndRun(cls):
+        return cls.parse().run()
@@ -0,0 +1,121 @@
+"""
+Run tasks in a pool of long-lived worker processes
+
+The pool is started once, and each worker is given the 'target' object (e.g.,
+the BuildAndCatalog) when it starts (on Unix, it's simply inherited by fork).
+Tasks then name a method of the target, so only the task arguments are sent
+to the workers, rather than pickling the target for every task.
+"""
+
+import sys
+import time
+import traceback
+import multiprocessing
+
+from .runLog import measureCall
+
+__all__ = ["Executor",]
+
+# The target object in a worker process
+_target = None
+
+
+def initWorker(target):
+    global _target
+    _target = target
+
+
+def getFunction(target, func):
+    """Return the function to call: a method of the target if 'func' is a name"""
+    return getattr(target, func) if isinstance(func, basestring) else func
+
+
+def callTask(task):
+    """Call a task in a worker, returning its index and the result
+
+    If the task is to be measured, the result is a tuple of the result and
+    the resource use (see runLog.measureCall).  Exceptions are converted to
+    RuntimeError carrying the worker's traceback, which would otherwise be
+    lost.
+    """
+    index, func, args, measure = task
+    try:
+        if measure:
+            return index, measureCall(getFunction(_target, func), args, reset=True)
+        return index, getFunction(_target, func)(*args)
+    except Exception:
+        raise RuntimeError("Task %s%s failed:\n%s" % (func if isinstance(func, basestring) else func.__name__,
+                                                      args, "".join(traceback.format_exception(*sys.exc_info()))))
+
+
+class Executor(object):
+    """Map functions over lists of arguments, in a pool of long-lived workers
+
+    Tasks are methods of 'target' (named by string) or picklable functions
+    (e.g., defined at module level).  With 'threads' <= 1, tasks are run in
+    this process.  Tasks are sent to the workers 'chunkSize' at a time (by
+    default, enough for about four chunks per worker), and progress is
+    reported every 'interval' seconds.
+
+    Use as a context manager (or call close()) so the pool is shut down when
+    done: starting processes (e.g., external commands) while the pool's
+    threads are running can deadlock.
+    """
+    def __init__(self, threads, target=None, chunkSize=None, interval=30.0):
+        self.threads = threads
+        self.target = target
+        self.chunkSize = chunkSize
+        self.interval = interval
+        self.pool = None
+        if threads > 1:
+            self.pool = multiprocessing.Pool(threads, initializer=initWorker, initargs=(target,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Shut down the pool, waiting for the workers to exit"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def imap(self, func, argList, measure=False):
+        """Call func(*args) for each args in argList, yielding (index, result) as each completes
+
+        The index is the position of the args in argList; results arrive in
+        the order they complete.  If 'measure', each result is a tuple of the
+        result and a dict of the task's resource use (see runLog.measureCall).
+        """
+        argList = list(argList)
+        tasks = [(i, func, tuple(args), measure) for i, args in enumerate(argList)]
+        name = func if isinstance(func, basestring) else func.__name__
+        if self.pool is not None:
+            chunkSize = self.chunkSize if self.chunkSize else max(1, len(tasks)//(4*self.threads))
+            results = self.pool.imap_unordered(callTask, tasks, chunkSize)
+        else:
+            function = getFunction(self.target, func)
+            results = ((i, measureCall(function, args) if measure else function(*args)) for
+                       i, _, args, _ in tasks)
+
+        start = time.time()
+        last = start
+        for num, (index, result) in enumerate(results, 1):
+            now = time.time()
+            if now - last >= self.interval and num < len(tasks):
+                print "%s: %d/%d tasks done after %.1f sec" % (name, num, len(tasks), now - start)
+                last = now
+            yield index, result
+        if tasks:
+            print "%s: %d tasks done in %.1f sec" % (name, len(tasks), time.time() - start)
+
+    def map(self, func, argList, measure=False):
+        """Call func(*args) for each args in argList, returning the list of results in order"""
+        argList = list(argList)
+        results = [None]*len(argList)
+        for index, result in self.imap(func, argList, measure=measure):
+            results[index] = result
+        return results
@@ -0,0 +1,194 @@
+"""
+Run external tools (hpsplit, build-astrometry-index), checking for failure
+
+Commands are launched directly (no shell), and the exit status, stderr, CPU
+time and peak memory of each invocation are recorded.  Failures are retried
+and then raised, rather than being silently ignored as with os.system.
+"""
+
+import os
+import time
+import shlex
+import tempfile
+import subprocess
+
+__all__ = ["CommandResult", "CommandError", "runCommand", "CommandPool",]
+
+
+class CommandResult(object):
+    """Result of running an external command"""
+    def __init__(self, command, returncode, stderr, wall, cpu, maxrss, attempts):
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr
+        self.wall = wall # Wall-clock time (sec)
+        self.cpu = cpu # User + system CPU time (sec)
+        self.maxrss = maxrss # Peak resident set size (kB)
+        self.attempts = attempts
+
+    def __str__(self):
+        return "%s: exit %d, %.1f sec wall, %.1f sec CPU, %.0f MB max RSS" % (
+            self.command.split()[0], self.returncode, self.wall, self.cpu, self.maxrss/1024.0)
+
+
+class CommandError(RuntimeError):
+    """An external command failed"""
+    def __init__(self, result):
+        self.result = result
+        RuntimeError.__init__(self, "Command failed after %d attempts with exit status %d: %s\n%s" %
+                              (result.attempts, result.returncode, result.command, result.stderr[-2000:]))
+
+
+def getStatus(status):
+    """Convert a wait status into a return code as used by subprocess"""
+    return os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+
+def splitCommand(command):
+    """Split a command string (as by the shell, but without any expansion) into arguments"""
+    return shlex.split(command) if isinstance(command, basestring) else list(command)
+
+
+def runOnce(args):
+    """Run a command once, returning the exit status, stderr, wall time, CPU time and peak RSS
+
+    We wait for the child with os.wait4, so we get the resource usage of that
+    child alone.
+    """
+    start = time.time()
+    try:
+        proc = subprocess.Popen(args, stderr=subprocess.PIPE)
+    except OSError as exc:
+        # e.g., command not found
+        return 127, str(exc), 0.0, 0.0, 0
+    stderr = proc.stderr.read()
+    proc.stderr.close()
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = getStatus(status) # We've reaped it, so Popen mustn't try
+    return proc.returncode, stderr, time.time() - start, usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+
+def runCommand(command, retries=0, check=True):
+    """Run an external command, returning a CommandResult
+
+    The command may be a string (split as by the shell, but without
+    any shell expansion) or a list of arguments.  A failed command is
+    retried up to 'retries' times; if it still fails, CommandError is
+    raised if 'check' is set.
+    """
+    args = splitCommand(command)
+    command = " ".join(args)
+    print command
+    wall = 0.0
+    cpu = 0.0
+    maxrss = 0
+    for attempt in range(1, retries + 2):
+        returncode, stderr, attemptWall, attemptCpu, attemptRss = runOnce(args)
+        wall += attemptWall
+        cpu += attemptCpu
+        maxrss = max(maxrss, attemptRss)
+        if returncode == 0:
+            break
+        print "Attempt %d of %d failed with exit status %d: %s" % (attempt, retries + 1, returncode, command)
+
+    result = CommandResult(command, returncode, stderr, wall, cpu, maxrss, attempt)
+    print result
+    if check and returncode != 0:
+        raise CommandError(result)
+    return result
+
+
+class RunningCommand(object):
+    """State of a command being run by a CommandPool"""
+    def __init__(self, args):
+        self.args = args
+        self.command = " ".join(args)
+        self.attempt = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.maxrss = 0
+        self.proc = None
+        self.stderr = None
+        self.start = None
+
+
+class CommandPool(object):
+    """Run external commands concurrently from a single thread
+
+    Forking from threads can deadlock under python 2, and forking a python
+    process just to wait on a command is wasteful, so each command is started
+    directly and polled for completion with os.wait4.  stderr goes to a
+    temporary file so that a chatty command can't block on a full pipe.
+    The caller is responsible for bounding the number of commands running.
+    """
+    def __init__(self, retries=0, interval=0.05):
+        self.retries = retries
+        self.interval = interval # Polling interval (sec)
+        self.running = {}
+
+    def __len__(self):
+        return len(self.running)
+
+    def start(self, key, command):
+        """Start a command, identified by 'key'"""
+        running = RunningCommand(splitCommand(command))
+        print running.command
+        self.running[key] = running
+        self.launch(running)
+
+    def launch(self, running):
+        running.attempt += 1
+        running.stderr = tempfile.TemporaryFile()
+        running.start = time.time()
+        try:
+            running.proc = subprocess.Popen(running.args, stderr=running.stderr)
+        except OSError as exc:
+            running.proc = None
+            running.stderr.write(str(exc))
+
+    def stop(self, key):
+        """Kill a command, and forget it"""
+        running = self.running.pop(key)
+        if running.proc is not None:
+            running.proc.kill()
+            running.proc.wait()
+        running.stderr.close()
+
+    def poll(self, wait=False):
+        """Return a list of (key, CommandResult) for commands that have finished
+
+        Failed commands are restarted until they've been retried 'retries' times.
+        If 'wait', we block until at least one command finishes.
+        """
+        while True:
+            finished = []
+            for key, running in self.running.items():
+                if running.proc is None:
+                    returncode, cpu, maxrss = 127, 0.0, 0
+                else:
+                    pid, status, usage = os.wait4(running.proc.pid, os.WNOHANG)
+                    if pid == 0:
+                        continue
+                    running.proc.returncode = returncode = getStatus(status)
+                    cpu, maxrss = usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+                running.wall += time.time() - running.start
+                running.cpu += cpu
+                running.maxrss = max(running.maxrss, maxrss)
+                running.stderr.seek(0)
+                stderr = running.stderr.read()
+                running.stderr.close()
+
+                if returncode != 0 and running.attempt <= self.retries:
+                    print "Attempt %d of %d failed with exit status %d: %s" % \
+                        (running.attempt, self.retries + 1, returncode, running.command)
+                    self.launch(running)
+                    continue
+
+                del self.running[key]
+                result = CommandResult(running.command, returncode, stderr, running.wall, running.cpu,
+                                       running.maxrss, running.attempt)
+                print result
+                finished.append((key, result))
+            if finished or not wait or not self.running:
+                return finished
+            time.sleep(self.interval)
@@ -0,0 +1,220 @@
+"""Helpers for reading and writing FITS binary tables"""
+
+import re
+
+import numpy
+import pyfits
+
+__all__ = ["makeColDefs", "makeDtype", "makeHeader", "writeTable", "readTable", "concatenateTables",
+           "FitsTableWriter", "MemmapTableWriter",]
+
+
+def makeColDefs(schema):
+    """Return the pyfits column definitions for a schema (dict of column name --> FITS format)"""
+    return pyfits.ColDefs([pyfits.Column(name=col, format=schema[col]) for col in schema])
+
+
+def writeTable(filename, schema, columns):
+    """Write columns (dict of column name --> array) as a FITS binary table
+
+    Returns the number of rows written.
+    """
+    sizes = set(len(columns[col]) for col in schema)
+    if len(sizes) != 1:
+        raise RuntimeError("Column sizes are inconsistent: %s" % sorted(sizes))
+    size = sizes.pop()
+    outHdu = pyfits.new_table(makeColDefs(schema), nrows=size)
+    outData = outHdu.data
+    for col in schema:
+        outData.field(col)[:] = columns[col]
+    outHdu.writeto(filename, clobber=True)
+    return size
+
+
+def readTable(filename, schema):
+    """Read the schema columns from a FITS binary table, returning a dict of column name --> array"""
+    inFile = pyfits.open(filename)
+    data = inFile[1].data
+    columns = dict((col, numpy.array(data.field(col))) for col in schema)
+    inFile.close()
+    return columns
+
+
+def concatenateTables(inList, outName, schema):
+    """Concatenate FITS binary tables sharing a schema into a single table
+
+    Returns the number of rows written.
+    """
+    pieces = [readTable(inName, schema) for inName in inList]
+    columns = dict((col, numpy.concatenate([p[col] for p in pieces])) for col in schema)
+    return writeTable(outName, schema, columns)
+
+
+# Numpy types for the FITS binary table formats we write
+FORMATS = {'L': "i1", 'B': "u1", 'I': ">i2", 'J': ">i4", 'K': ">i8", 'E': ">f4", 'D': ">f8",}
+
+
+def makeDtype(schema):
+    """Return the numpy dtype of a row of a FITS binary table with this schema
+
+    The column order matches that of makeColDefs.
+    """
+    fields = []
+    for col in schema:
+        m = re.match(r"^(\d*)([A-Z])$", schema[col])
+        if not m or m.group(2) not in FORMATS:
+            raise RuntimeError("Unsupported FITS format for column %s: %s" % (col, schema[col]))
+        repeat = int(m.group(1)) if m.group(1) else 1
+        fields.append((col, FORMATS[m.group(2)], (repeat,)) if repeat > 1 else (col, FORMATS[m.group(2)]))
+    return numpy.dtype(fields)
+
+
+def makeHeader(schema, nrows=0):
+    """Return the header of a FITS binary table extension with this schema and number of rows
+
+    This is computed directly from the schema, without creating a table.
+    """
+    dtype = makeDtype(schema)
+    header = pyfits.Header()
+    header["XTENSION"] = "BINTABLE"
+    header["BITPIX"] = 8
+    header["NAXIS"] = 2
+    header["NAXIS1"] = dtype.itemsize
+    header["NAXIS2"] = nrows
+    header["PCOUNT"] = 0
+    header["GCOUNT"] = 1
+    header["TFIELDS"] = len(dtype.names)
+    for i, col in enumerate(dtype.names):
+        header["TTYPE%d" % (i + 1)] = col
+        header["TFORM%d" % (i + 1)] = schema[col]
+    return header
+
+
+def setColumn(target, column, schema, col):
+    """Set a column of rows, converting logicals to the FITS representation"""
+    if schema[col].endswith("L"):
+        target[...] = numpy.where(column, ord("T"), ord("F"))
+    else:
+        target[...] = column
+
+
+class FitsTableWriter(object):
+    """Write a FITS binary table incrementally
+
+    Rows are appended as they are produced, so the whole table never has to
+    be held in memory.  NAXIS2 is fixed up when the writer is closed.
+    """
+    def __init__(self, filename, schema):
+        self.filename = filename
+        self.schema = schema
+        self.dtype = makeDtype(schema)
+        self.header = makeHeader(schema)
+        self.num = 0
+        self.file = open(filename, "wb")
+        self.file.write(pyfits.PrimaryHDU().header.tostring())
+        self.headerOffset = self.file.tell()
+        self.file.write(self.header.tostring())
+
+    def append(self, columns):
+        """Append rows (dict of column name --> array); returns the number of rows appended"""
+        sizes = set(len(columns[col]) for col in self.schema)
+        if len(sizes) != 1:
+            raise RuntimeError("Column sizes are inconsistent: %s" % sorted(sizes))
+        size = sizes.pop()
+        rows = numpy.empty(size, dtype=self.dtype)
+        for col in self.schema:
+            setColumn(rows[col], columns[col], self.schema, col)
+        rows.tofile(self.file)
+        self.num += size
+        return size
+
+    def close(self):
+        """Pad the data, fix up the header and close; returns the number of rows written"""
+        dataSize = self.num*self.dtype.itemsize
+        if dataSize % 2880 != 0:
+            self.file.write("\0"*(2880 - dataSize % 2880))
+        self.header["NAXIS2"] = self.num
+        self.file.seek(self.headerOffset)
+        self.file.write(self.header.tostring())
+        self.file.close()
+        return self.num
+
+
+class MemmapTableWriter(object):
+    """Write a FITS binary table incrementally through a memory map
+
+    The file is extended for each block of rows appended, and the columns
+    are written (converted to big-endian as they go) straight into the
+    memory-mapped rows, so there's no intermediate row buffer or write().
+    If a selection (boolean mask or indices) is provided, only the selected
+    rows are written, so the caller needn't make filtered copies of the
+    columns first.  'copied' counts the bytes copied in doing so.
+
+    With 'resume', rows are appended to the table in an existing file,
+    written (and closed) by a writer with the same schema.
+    """
+    def __init__(self, filename, schema, resume=False):
+        self.filename = filename
+        self.schema = schema
+        self.dtype = makeDtype(schema)
+        self.header = makeHeader(schema)
+        self.num = 0
+        self.copied = 0
+        primary = pyfits.PrimaryHDU().header.tostring()
+        self.headerOffset = len(primary)
+        self.dataOffset = self.headerOffset + len(self.header.tostring())
+        if resume:
+            self.file = open(filename, "r+b")
+            self.file.seek(self.headerOffset)
+            header = pyfits.Header.fromstring(self.file.read(self.dataOffset - self.headerOffset))
+            if header.get("NAXIS1") != self.dtype.itemsize or header.get("TFIELDS") != len(self.dtype.names):
+                raise RuntimeError("Table in %s doesn't match the schema" % (filename,))
+            self.num = header["NAXIS2"]
+            return
+        self.file = open(filename, "w+b")
+        self.file.write(primary)
+        self.file.write(self.header.tostring())
+
+    def append(self, columns, select=None):
+        """Append rows (dict of column name --> array); returns the number of rows appended
+
+        'select' is an optional boolean mask or index array selecting the rows of the columns to write.
+        """
+        sizes = set(len(columns[col]) for col in self.schema)
+        if len(sizes) != 1:
+            raise RuntimeError("Column sizes are inconsistent: %s" % sorted(sizes))
+        size = sizes.pop()
+        if select is not None:
+            select = numpy.asarray(select)
+            if select.dtype == bool:
+                if len(select) != size:
+                    raise RuntimeError("Selection size mismatch: %d vs %d" % (len(select), size))
+                select = numpy.flatnonzero(select)
+            size = len(select)
+        if size == 0:
+            return 0
+
+        start = self.dataOffset + self.num*self.dtype.itemsize
+        self.file.truncate(start + size*self.dtype.itemsize)
+        rows = numpy.memmap(self.file, dtype=self.dtype, mode="r+", offset=start, shape=(size,))
+        for col in self.schema:
+            column = columns[col]
+            if select is not None:
+                column = column.take(select)
+                self.copied += column.nbytes
+            setColumn(rows[col], column, self.schema, col)
+            self.copied += rows[col].nbytes
+        rows.flush()
+        del rows
+        self.num += size
+        return size
+
+    def close(self):
+        """Pad the data, fix up the header and close; returns the number of rows written"""
+        dataSize = self.num*self.dtype.itemsize
+        self.file.truncate(self.dataOffset + dataSize + (-dataSize % 2880))
+        self.header["NAXIS2"] = self.num
+        self.file.seek(self.headerOffset)
+        self.file.write(self.header.tostring())
+        self.file.close()
+        return self.num
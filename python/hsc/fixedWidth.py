@@ -0,0 +1,185 @@
+"""
+Read fixed-width text tables into numpy arrays, in chunks
+
+This reads the tables handled by asciitable's FixedWidthTwoLine reader: a
+line of column names, and a line of dashes (optionally separated by the
+delimiter) marking the extent of each column, with the data following.
+Rather than splitting each line into Python strings, the data lines are
+read through a memory map as a 2-D array of bytes, and each column's bytes
+are converted straight to the requested type.  The lines must all be the
+same length for this; if they aren't (e.g., trailing spaces have been
+stripped), the lines are read and padded instead, which is slower.
+"""
+
+import mmap
+from collections import OrderedDict
+
+import numpy
+
+__all__ = ["getColumnExtents", "readFixedWidth",]
+
+
+def getColumnExtents(line, delimiter="|"):
+    """Return a list of the (start, end) of each column, from the position line
+
+    The columns are the runs of characters between delimiters, as for
+    asciitable's FixedWidth reader.
+    """
+    extents = []
+    start = 0
+    for value in line.rstrip("\r\n").split(delimiter):
+        if value:
+            extents.append((start, start + len(value)))
+            start += len(value) + 1
+        else:
+            start += 1
+    return extents
+
+
+def readHeader(inFile, headerLine, positionLine, dataStart):
+    """Return the header line, the position line and the byte offset of the data
+
+    Line numbers count only non-blank lines, as for asciitable.
+    """
+    lines = {}
+    num = 0
+    offset = 0
+    while num < dataStart:
+        line = inFile.readline()
+        if not line:
+            raise RuntimeError("Table ended before the data (line %d)" % dataStart)
+        offset += len(line)
+        if line.strip():
+            lines[num] = line
+            num += 1
+    # Skip blank lines before the data
+    while True:
+        line = inFile.readline()
+        if line.strip() or not line:
+            break
+        offset += len(line)
+    return lines[headerLine], lines[positionLine], offset
+
+
+def getDataEnd(inFile, dataEnd, size):
+    """Return the byte offset of the end of the data
+
+    'dataEnd' is None (to read to the end) or negative: the number of
+    trailing non-blank lines to ignore.
+    """
+    if dataEnd is None:
+        return size
+    if dataEnd >= 0:
+        raise RuntimeError("Only a negative (or no) end of data is supported: %s" % (dataEnd,))
+    step = 65536
+    while True:
+        # Read enough of the end of the file to hold the lines to drop
+        start = max(0, size - step)
+        inFile.seek(start)
+        lines = inFile.read(size - start).splitlines(True)
+        if start > 0:
+            lines = lines[1:] # May be partial
+        nonBlank = [i for i, line in enumerate(lines) if line.strip()]
+        if len(nonBlank) >= -dataEnd or start == 0:
+            break
+        step *= 2
+    if len(nonBlank) < -dataEnd:
+        raise RuntimeError("Table has fewer than %d lines to drop from the end" % -dataEnd)
+    return size - sum(len(line) for line in lines[nonBlank[dataEnd]:])
+
+
+def parseColumn(chars, dtype):
+    """Convert a column of text (2-D array of bytes: rows x characters) to 'dtype'
+
+    Blank values are NaN for floating-point types, and an error otherwise.
+    """
+    dtype = numpy.dtype(dtype)
+    blank = numpy.all((chars == ord(" ")) | (chars == 0), axis=1)
+    field = numpy.ascontiguousarray(chars).view("S%d" % chars.shape[1]).ravel()
+    if numpy.any(blank):
+        if dtype.kind != "f":
+            raise RuntimeError("Blank values in an integer column")
+        values = numpy.empty(len(field), dtype=dtype)
+        values[blank] = numpy.nan
+        values[~blank] = field[~blank].astype(dtype)
+        return values
+    return parseField(field, dtype)
+
+
+def parseField(field, dtype):
+    """Convert an array of strings (numpy 'S'), none blank, to 'dtype'"""
+    if dtype.kind == "f":
+        return field.astype(dtype)
+    if dtype.kind == "b":
+        return parseField(field, numpy.dtype(numpy.int64)) != 0
+    # Parsing as floating-point is faster, and exact for integers up to 2**53
+    values = field.astype(numpy.float64)
+    if len(values) > 0 and numpy.abs(values).max() >= 2**53:
+        return field.astype(dtype)
+    return values.astype(dtype)
+
+
+def readFixedWidth(filename, dtypes, chunkRows=1000000, delimiter="|", headerLine=0, positionLine=1,
+                   dataStart=2, dataEnd=None):
+    """Read a fixed-width table in chunks
+
+    This is a generator, yielding a dict of column name --> array for each
+    chunk of up to 'chunkRows' rows.  Only the columns in 'dtypes' (a dict
+    or list of pairs of column name --> numpy type) are read.  The other
+    arguments are as for asciitable's FixedWidthTwoLine reader: the line
+    numbers (counting only non-blank lines) of the names, the column
+    positions and the start of the data, and the number of lines at the end
+    that aren't data (as a negative number).
+    """
+    dtypes = OrderedDict(dtypes)
+    with open(filename, "rb") as inFile:
+        header, position, offset = readHeader(inFile, headerLine, positionLine, dataStart)
+        extents = getColumnExtents(position, delimiter)
+        names = [header[start:end].strip() for start, end in extents]
+        missing = [col for col in dtypes if col not in names]
+        if missing:
+            raise RuntimeError("Columns %s not in %s (have %s)" % (missing, filename, names))
+        columns = [(col, extents[names.index(col)]) for col in dtypes]
+        inFile.seek(0, 2)
+        end = getDataEnd(inFile, dataEnd, inFile.tell())
+        if end <= offset:
+            return
+        inFile.seek(offset)
+        length = len(inFile.readline())
+        width = max(stop for _, (_, stop) in columns)
+
+        fixed = (end - offset) % length == 0 and length > width
+        if fixed:
+            mapped = mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_READ)
+            records = numpy.frombuffer(mapped, dtype=numpy.uint8, count=end - offset,
+                                       offset=offset).reshape(-1, length)
+            fixed = numpy.all(records[:, -1] == ord("\n"))
+        if fixed:
+            chunks = (records[start:start + chunkRows] for start in range(0, len(records), chunkRows))
+        else:
+            inFile.seek(offset)
+            chunks = readPadded(inFile, end - offset, width, chunkRows)
+
+        for chunk in chunks:
+            yield dict((col, parseColumn(chunk[:, start:stop], dtypes[col])) for col, (start, stop) in columns)
+
+
+def readPadded(inFile, size, width, chunkRows):
+    """Read 'size' bytes of lines in chunks, yielding each as a 2-D array of bytes padded to 'width'
+
+    Blank lines are skipped.
+    """
+    read = 0
+    lines = []
+    for line in inFile:
+        read += len(line)
+        if line.strip():
+            lines.append(line.rstrip("\r\n"))
+        if len(lines) >= chunkRows or read >= size:
+            if lines:
+                yield numpy.array(lines, dtype="S%d" % width).view(numpy.uint8).reshape(-1, width)
+            lines = []
+        if read >= size:
+            break
+    if lines:
+        yield numpy.array(lines, dtype="S%d" % width).view(numpy.uint8).reshape(-1, width)
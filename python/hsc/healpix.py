@@ -0,0 +1,423 @@
+"""
+HEALPix pixelisation in the astrometry.net numbering scheme
+
+astrometry.net (hpsplit, build-astrometry-index -H/-s) doesn't use the RING or NESTED
+schemes, but numbers the pixels as 'bighp*nside**2 + x*nside + y', where 'bighp' is
+one of the 12 base healpixes and (x, y) is the position within it (x increasing to the
+north-east, y to the north-west).  This is a vectorised port of xyztohp() in
+astrometry.net's util/healpix.c, so that we can partition catalogs ourselves and still
+feed the right '-H' values to build-astrometry-index.  healpixToRaDec is the inverse,
+a port of hp_to_xyz().
+
+The numbering is hierarchical: the four children of pixel (bighp, x, y) at nside
+are (bighp, 2x + i, 2y + j) at 2*nside.  An AdaptivePartition uses this to cover the
+sky with pixels of different nside, to even out the number of rows in each.  Pixels
+of different nside are identified by the unique id 4*nside**2 + healpix.
+"""
+
+import os
+import json
+
+import numpy
+
+from .catalogIO import writeCatalog, selectUnique
+from .fitsTable import MemmapTableWriter
+
+__all__ = ["radecToHealpix", "healpixToRaDec", "getParentHealpix", "getPixelRadius", "getUniqueId",
+           "splitUniqueId", "getHistogram", "getBrightest", "splitByShard", "AdaptivePartition",
+           "HealpixPartitioner", "ShardWriter",]
+
+
+def radecToHealpix(ra, dec, nside):
+    """Return the astrometry.net healpix index for each ra,dec (degrees)"""
+    ra = numpy.radians(numpy.asarray(ra, dtype=numpy.float64))
+    dec = numpy.radians(numpy.asarray(dec, dtype=numpy.float64))
+    cosDec = numpy.cos(dec)
+    vx = cosDec*numpy.cos(ra)
+    vy = cosDec*numpy.sin(ra)
+    vz = numpy.sin(dec)
+
+    halfpi = 0.5*numpy.pi
+    phi = numpy.arctan2(vy, vx)
+    phi = numpy.where(phi < 0.0, phi + 2.0*numpy.pi, phi)
+    phiT = numpy.fmod(phi, halfpi)
+    offset = numpy.round((phi - phiT)/halfpi).astype(numpy.int64) % 4
+
+    bighp = numpy.empty(phi.shape, dtype=numpy.int64)
+    x = numpy.empty(phi.shape, dtype=numpy.float64)
+    y = numpy.empty(phi.shape, dtype=numpy.float64)
+
+    # Polar caps
+    polar = numpy.abs(vz) >= 2.0/3.0
+    if numpy.any(polar):
+        north = vz[polar] > 0
+        vzAbs = numpy.abs(vz[polar])
+        pt = phiT[polar]
+        kx = numpy.sqrt(numpy.clip((1.0 - vzAbs)*3.0*(nside*(2.0*pt - numpy.pi)/numpy.pi)**2, 0.0, None))
+        ky = numpy.sqrt(numpy.clip((1.0 - vzAbs)*3.0*(nside*2.0*pt/numpy.pi)**2, 0.0, None))
+        x[polar] = numpy.where(north, nside - kx, ky)
+        y[polar] = numpy.where(north, nside - ky, kx)
+        bighp[polar] = numpy.where(north, offset[polar], 8 + offset[polar])
+
+    # Equatorial belt (which may still land in a polar base healpix)
+    equatorial = numpy.logical_not(polar)
+    if numpy.any(equatorial):
+        zUnits = (vz[equatorial] + 2.0/3.0)/(4.0/3.0)
+        phiUnits = phiT[equatorial]/halfpi
+        xx = (zUnits + phiUnits)*nside
+        yy = (zUnits - phiUnits + 1.0)*nside
+        off = offset[equatorial]
+        east = xx >= nside
+        west = yy >= nside
+        bighp[equatorial] = numpy.where(east,
+                                        numpy.where(west, off, (off + 1) % 4 + 4),
+                                        numpy.where(west, off + 4, 8 + off))
+        x[equatorial] = numpy.where(east, xx - nside, xx)
+        y[equatorial] = numpy.where(west, yy - nside, yy)
+
+    x = numpy.clip(numpy.floor(x), 0, nside - 1).astype(numpy.int64)
+    y = numpy.clip(numpy.floor(y), 0, nside - 1).astype(numpy.int64)
+    return (bighp*nside + x)*nside + y
+
+
+def healpixToRaDec(healpix, nside, dx=0.5, dy=0.5):
+    """Return the ra,dec (degrees) of a position within each astrometry.net healpix
+
+    The position is (dx, dy) in units of the pixel within the pixel: the
+    default is the centre.
+    """
+    healpix = numpy.asarray(healpix, dtype=numpy.int64)
+    bighp = healpix//(nside*nside)
+    x = (healpix//nside) % nside + dx
+    y = healpix % nside + dy
+
+    phi = numpy.empty(healpix.shape, dtype=numpy.float64)
+    z = numpy.empty(healpix.shape, dtype=numpy.float64)
+
+    north = bighp <= 3
+    south = bighp >= 8
+    polar = numpy.logical_or(numpy.logical_and(north, x + y > nside), numpy.logical_and(south, x + y < nside))
+
+    # Equatorial region of each base healpix
+    equatorial = numpy.logical_not(polar)
+    if numpy.any(equatorial):
+        bh = bighp[equatorial]
+        xx = x[equatorial]/float(nside)
+        yy = y[equatorial]/float(nside)
+        zOffset = numpy.where(bh <= 3, 0.0, numpy.where(bh <= 7, -1.0, -2.0))
+        phiOffset = numpy.where(numpy.logical_and(bh >= 4, bh <= 7), 0.0, 1.0)
+        z[equatorial] = 2.0/3.0*(xx + yy + zOffset)
+        phi[equatorial] = 0.25*numpy.pi*(xx - yy + phiOffset + 2*(bh % 4))
+
+    # Polar caps
+    if numpy.any(polar):
+        bh = bighp[polar]
+        isSouth = bh >= 8
+        xx = numpy.where(isSouth, nside - y[polar], x[polar])
+        yy = numpy.where(isSouth, nside - x[polar], y[polar])
+        dxx = nside - xx
+        dyy = nside - yy
+        denominator = 2.0*(dxx + dyy)
+        phiT = numpy.where(denominator > 0, numpy.pi*dyy/numpy.where(denominator > 0, denominator, 1.0), 0.0)
+        lower = phiT < 0.25*numpy.pi
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            zz = numpy.where(lower, 1.0 - (numpy.pi*dxx/((2.0*phiT - numpy.pi)*nside))**2/3.0,
+                             1.0 - (numpy.pi*dyy/(2.0*phiT*nside))**2/3.0)
+        z[polar] = numpy.where(isSouth, -zz, zz)
+        phi[polar] = 0.5*numpy.pi*(bh % 4) + phiT
+
+    ra = numpy.degrees(phi) % 360.0
+    dec = numpy.degrees(numpy.arcsin(numpy.clip(z, -1.0, 1.0)))
+    return ra, dec
+
+
+def getParentHealpix(healpix, nside, parentNside):
+    """Return the healpix at 'parentNside' containing each healpix at 'nside'
+
+    The numbering is hierarchical: the parent is in the same base healpix,
+    at x and y divided by nside/parentNside, which must be an integer.
+    """
+    if nside % parentNside != 0:
+        raise RuntimeError("nside %d is not a multiple of %d" % (nside, parentNside))
+    factor = nside//parentNside
+    healpix = numpy.asarray(healpix, dtype=numpy.int64)
+    bighp = healpix//(nside*nside)
+    x = (healpix//nside) % nside
+    y = healpix % nside
+    return (bighp*parentNside + x//factor)*parentNside + y//factor
+
+
+def getPixelRadius(nside):
+    """Return an upper limit on the distance (degrees) from a healpix centre to any point in the healpix
+
+    The greatest distance, to a corner, approaches 61.25 deg/nside.
+    """
+    return 64.0/nside
+
+
+def getUniqueId(healpix, nside):
+    """Return the unique id of a healpix, distinct from any healpix at another nside (a power of 2)
+
+    The healpixes at nside are 0..12*nside**2 - 1, so the ids are 4*nside**2..16*nside**2 - 1.
+    """
+    return 4*nside*nside + healpix
+
+
+def splitUniqueId(uniqueId):
+    """Return the healpix and nside for a unique id"""
+    nside = 1 << ((uniqueId//4).bit_length() - 1)//2
+    return uniqueId - 4*nside*nside, nside
+
+
+def getHistogram(ra, dec, nside):
+    """Return the number of positions in each healpix"""
+    return numpy.bincount(radecToHealpix(ra, dec, nside), minlength=12*nside*nside)
+
+
+def getChildren(healpix, nside):
+    """Return the four healpixes at 2*nside within each healpix at nside"""
+    healpix = numpy.asarray(healpix, dtype=numpy.int64)
+    bighp = healpix//(nside*nside)
+    x = (healpix//nside) % nside
+    y = healpix % nside
+    children = [(bighp*2*nside + 2*x + i)*2*nside + 2*y + j for i in (0, 1) for j in (0, 1)]
+    return numpy.concatenate(children)
+
+
+def getBrightest(ra, dec, mag, nside, num):
+    """Return the indices of the 'num' brightest (lowest mag) positions in each healpix, sorted by mag
+
+    This is the selection made by build-astrometry-index when it uniformizes
+    a catalog (keeping the brightest '-n' stars in each healpix at its '-U'
+    nside), done with sorts rather than a loop over healpixes.  NaN
+    magnitudes count as faintest.  If 'num' is zero, all are kept.
+    """
+    order = numpy.argsort(mag, kind="mergesort")
+    if num <= 0 or len(order) == 0:
+        return order
+    healpix = radecToHealpix(numpy.asarray(ra)[order], numpy.asarray(dec)[order], nside)
+    byHealpix = numpy.argsort(healpix, kind="mergesort") # Stable, so still by mag within each healpix
+    healpix = healpix[byHealpix]
+    starts = numpy.flatnonzero(numpy.concatenate([[True], healpix[1:] != healpix[:-1]]))
+    rank = numpy.arange(len(healpix)) - numpy.repeat(starts, numpy.diff(numpy.append(starts, len(healpix))))
+    keep = numpy.zeros(len(order), dtype=bool)
+    keep[byHealpix[rank < num]] = True
+    return order[keep]
+
+
+def splitByShard(columns, schema, shard, rows=None):
+    """Split rows by shard, returning a dict of shard --> columns (dict of column name --> array)
+
+    'shard' is the shard (e.g., healpix) of each row, or of each of the
+    'rows' (indices) if provided.  Rows keep their order within each shard.
+    """
+    order = numpy.argsort(shard, kind="mergesort")
+    shards, starts = numpy.unique(shard[order], return_index=True)
+    stops = numpy.append(starts[1:], len(order))
+    pieces = {}
+    for s, start, stop in zip(shards, starts, stops):
+        indices = order[start:stop] if rows is None else rows[order[start:stop]]
+        pieces[int(s)] = dict((col, columns[col][indices]) for col in schema)
+    return pieces
+
+
+class AdaptivePartition(object):
+    """Division of the sky into healpixes of different nside
+
+    'shards' is a list of (unique id, rows) for the healpixes (see
+    getUniqueId), with nside between 'minNside' and 'maxNside', which don't
+    overlap.  Positions are assigned to shards by their healpix at maxNside.
+    """
+    def __init__(self, shards, minNside, maxNside):
+        self.shards = [(int(uniqueId), int(rows)) for uniqueId, rows in shards]
+        self.minNside = minNside
+        self.maxNside = maxNside
+        self.lookup = None
+
+    @classmethod
+    def fromHistogram(cls, counts, minNside, maxNside, maxRows):
+        """Divide the sky so that no shard has more than 'maxRows' rows, unless at maxNside
+
+        'counts' is the number of rows in each healpix at maxNside.  Starting
+        with the non-empty healpixes at minNside, each one with too many rows
+        is split into its (non-empty) children, so sparse areas are covered
+        by large shards and dense areas by small ones.
+        """
+        if minNside > maxNside or maxNside % minNside != 0:
+            raise RuntimeError("Bad nside range for adaptive partition: %d to %d" % (minNside, maxNside))
+        levels = {maxNside: numpy.asarray(counts, dtype=numpy.int64)}
+        nside = maxNside
+        while nside > minNside:
+            nside //= 2
+            levels[nside] = levels[2*nside].reshape(12, nside, 2, nside, 2).sum(axis=4).sum(axis=2).ravel()
+
+        shards = []
+        pixels = numpy.flatnonzero(levels[minNside])
+        nside = minNside
+        while len(pixels) > 0:
+            rows = levels[nside][pixels]
+            split = rows > maxRows if nside < maxNside else numpy.zeros(len(pixels), dtype=bool)
+            keep = numpy.logical_not(split)
+            shards += zip(getUniqueId(pixels[keep], nside).tolist(), rows[keep].tolist())
+            pixels = getChildren(pixels[split], nside)
+            nside *= 2
+            pixels = pixels[levels[nside][pixels] > 0] if len(pixels) > 0 else pixels
+        return cls(shards, minNside, maxNside)
+
+    def getShard(self, ra, dec):
+        """Return the unique id of the shard for each ra,dec (degrees)
+
+        Raises if a position isn't in any shard.
+        """
+        if self.lookup is None:
+            self.lookup = numpy.empty(12*self.maxNside**2, dtype=numpy.int64)
+            self.lookup[:] = -1
+            for uniqueId, _ in self.shards:
+                healpix, nside = splitUniqueId(uniqueId)
+                factor = self.maxNside//nside
+                bighp = healpix//(nside*nside)
+                x = (healpix//nside) % nside*factor + numpy.arange(factor)
+                y = healpix % nside*factor + numpy.arange(factor)
+                self.lookup[((bighp*self.maxNside + x[:, numpy.newaxis])*self.maxNside + y).ravel()] = uniqueId
+        shard = self.lookup[radecToHealpix(ra, dec, self.maxNside)]
+        if numpy.any(shard < 0):
+            raise RuntimeError("%d positions aren't in any shard of the adaptive partition" % (shard < 0).sum())
+        return shard
+
+    def getHealpixes(self):
+        """Return a dict mapping unique id --> (healpix, nside) for each shard"""
+        return dict((uniqueId, splitUniqueId(uniqueId)) for uniqueId, _ in self.shards)
+
+    def getConfig(self):
+        """Return what determines the assignment of positions to shards"""
+        return sorted(uniqueId for uniqueId, _ in self.shards)
+
+    def write(self, filename):
+        """Write the partition as JSON, atomically
+
+        Each shard is listed with its unique id, healpix, nside and rows, so
+        the files named by id can be related to the -H/-s given to
+        build-astrometry-index.
+        """
+        tempName = filename + ".tmp"
+        with open(tempName, "w") as f:
+            json.dump(dict(minNside=self.minNside, maxNside=self.maxNside,
+                           shards=[dict(id=uniqueId, healpix=splitUniqueId(uniqueId)[0],
+                                        nside=splitUniqueId(uniqueId)[1], rows=rows) for
+                                   uniqueId, rows in self.shards]), f, indent=1)
+        os.rename(tempName, filename)
+
+    @classmethod
+    def read(cls, filename):
+        with open(filename) as f:
+            contents = json.load(f)
+        return cls([(shard["id"], shard["rows"]) for shard in contents["shards"]], contents["minNside"],
+                   contents["maxNside"])
+
+
+class HealpixPartitioner(object):
+    """Bucket catalog rows by healpix, spilling to disk when the buffers get large
+
+    Rows added are sorted into per-healpix buffers.  Once more than 'bufferRows'
+    rows are buffered, every buffer is written out as a fragment 'hp_<healpix>_<n><extension>'
+    in 'outDir' and memory is released.  Only one file is open at a time, so we don't
+    need a file handle per healpix as hpsplit does.
+
+    If 'unique' names a column, rows buffered for a healpix with a value of
+    that column already buffered are dropped when the buffers are written.
+
+    If an AdaptivePartition is provided as 'partition', rows are bucketed by
+    its shards (and the fragments named by their unique ids) instead.
+    """
+    def __init__(self, outDir, schema, nside, bufferRows=1000000, extension=".fits", unique=None,
+                 partition=None):
+        self.outDir = outDir
+        self.extension = extension
+        self.schema = schema
+        self.nside = nside
+        self.bufferRows = bufferRows
+        self.unique = unique
+        self.partition = partition
+        self.buffers = {}
+        self.numBuffered = 0
+        self.numFlushed = 0
+        self.counts = {}
+
+    def add(self, columns, select=None):
+        """Add rows (a dict of column name --> array, as returned by filter())
+
+        If provided, 'select' is a boolean array selecting the rows to add
+        (as returned by select()); they are copied only into the buffers.
+        """
+        rows = numpy.flatnonzero(select) if select is not None else None
+        ra, dec = (columns["ra"], columns["dec"]) if rows is None else (columns["ra"][rows], columns["dec"][rows])
+        healpix = (radecToHealpix(ra, dec, self.nside) if self.partition is None else
+                   self.partition.getShard(ra, dec))
+        for hp, piece in splitByShard(columns, self.schema, healpix, rows).items():
+            self.buffers.setdefault(hp, []).append(piece)
+        self.numBuffered += len(healpix)
+        if self.numBuffered >= self.bufferRows:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows as fragments"""
+        for hp, pieces in self.buffers.items():
+            columns = dict((col, numpy.concatenate([p[col] for p in pieces])) for col in self.schema)
+            if self.unique is not None:
+                keep = selectUnique(columns[self.unique])
+                if not numpy.all(keep):
+                    columns = dict((col, columns[col][keep]) for col in self.schema)
+            fragName = os.path.join(self.outDir, "hp_%d_%d%s" % (hp, self.numFlushed, self.extension))
+            writeCatalog(fragName, self.schema, columns)
+            self.counts[hp] = self.counts.get(hp, 0) + len(columns["ra"])
+        self.buffers = {}
+        self.numBuffered = 0
+        self.numFlushed += 1
+
+    def close(self):
+        """Flush remaining rows, returning a dict of healpix --> number of rows written"""
+        if self.buffers:
+            self.flush()
+        return self.counts
+
+
+class ShardWriter(object):
+    """Append rows to a FITS table per shard, as they're streamed in
+
+    Rows added for each shard (e.g., healpix) are buffered.  Once more than
+    'bufferRows' rows are buffered, each buffer is appended to its shard,
+    named 'template' % shard, and memory is released.  As for the
+    HealpixPartitioner, only one file is open at a time; but each shard is
+    a single file, however many times rows are added to it.
+    """
+    def __init__(self, template, schema, bufferRows=1000000):
+        self.template = template
+        self.schema = schema
+        self.bufferRows = bufferRows
+        self.buffers = {}
+        self.numBuffered = 0
+        self.counts = {}
+
+    def add(self, pieces):
+        """Add rows: a dict of shard --> columns (dict of column name --> array), as from splitByShard"""
+        for shard, columns in pieces.items():
+            self.buffers.setdefault(shard, []).append(columns)
+            self.numBuffered += len(columns["ra"])
+        if self.numBuffered >= self.bufferRows:
+            self.flush()
+
+    def flush(self):
+        """Append the buffered rows to the shards"""
+        for shard, pieces in self.buffers.items():
+            writer = MemmapTableWriter(self.template % shard, self.schema, resume=shard in self.counts)
+            for columns in pieces:
+                writer.append(columns)
+            self.counts[shard] = writer.close()
+        self.buffers = {}
+        self.numBuffered = 0
+
+    def close(self):
+        """Flush remaining rows, returning a dict of shard --> number of rows written"""
+        if self.buffers:
+            self.flush()
+        return self.counts
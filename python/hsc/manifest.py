@@ -0,0 +1,93 @@
+"""
+Build manifest for incremental rebuilds
+
+Each artifact of a build (converted catalog, healpix shard, index) is recorded
+with a key: a hash of everything it was made from (the contents of its inputs,
+the keys of the artifacts it was made from, and the parameters and arguments
+used), along with its size.  An artifact is only reused if its key matches and
+it is still the size it was when recorded, so changing a parameter or an input
+causes exactly the affected artifacts to be rebuilt, and truncated files from
+a crashed run are not picked up.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+
+__all__ = ["Manifest", "makeKey", "removeArtifact",]
+
+
+def makeKey(*parts):
+    """Return a key (hash) for the parts, which must be serialisable as JSON"""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+
+def getSize(path):
+    """Return the size of a file, or the total size of files in a directory"""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def removeArtifact(path):
+    """Remove a file or directory, if it exists"""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.unlink(path)
+
+
+class Manifest(object):
+    """Keys of the artifacts of a build, persisted as JSON
+
+    Content hashes of input files are cached against their size and
+    modification time, so large inputs are only read when they change.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        if os.path.exists(filename):
+            with open(filename) as f:
+                contents = json.load(f)
+        else:
+            contents = {}
+        self.artifacts = contents.get("artifacts", {})
+        self.files = contents.get("files", {})
+
+    def hashFile(self, filename, blockSize=1 << 24):
+        """Return a hash of the contents of a file"""
+        stat = os.stat(filename)
+        path = os.path.abspath(filename)
+        cached = self.files.get(path)
+        if cached is not None and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime:
+            return cached["hash"]
+        sha = hashlib.sha1()
+        with open(filename, "rb") as f:
+            while True:
+                block = f.read(blockSize)
+                if not block:
+                    break
+                sha.update(block)
+        self.files[path] = dict(size=stat.st_size, mtime=stat.st_mtime, hash=sha.hexdigest())
+        return self.files[path]["hash"]
+
+    def isCurrent(self, artifact, key):
+        """Is the artifact present, intact and built with this key?"""
+        record = self.artifacts.get(artifact)
+        return record is not None and record["key"] == key and os.path.exists(artifact) and \
+            getSize(artifact) == record["size"]
+
+    def record(self, artifact, key):
+        """Record that the artifact has been built with this key"""
+        self.artifacts[artifact] = dict(key=key, size=getSize(artifact))
+
+    def forget(self, artifact):
+        """Forget about the artifact (e.g., because it's about to be rebuilt)"""
+        self.artifacts.pop(artifact, None)
+
+    def save(self):
+        """Write the manifest, atomically"""
+        tempName = self.filename + ".tmp"
+        with open(tempName, "w") as f:
+            json.dump(dict(artifacts=self.artifacts, files=self.files), f, indent=1, sort_keys=True)
+        os.rename(tempName, self.filename)
@@ -27,8 +27,15 @@ The hsc_fall and hsc_spring areas are too large to retrieve everything in one go
 parts.  This is simply accomplished by adding a WHERE clause on the modulus of the object id (
 e.g., "o.objID % 3 == 1").  For a 10 GB limit on PV1.2, it was necessary to divide hsc_fall and hsc_spring
 into three.
+
+Alternatively, the areas can be cut here rather than in the query: the --footprint option (e.g.,
+"--footprint hsc_fall") keeps only sources in the named area (or use --polygon for any other), which is
+applied to each chunk of input before anything else is done, and --dedupe drops repeated objIDs, so
+dumps of overlapping areas can be combined without requerying.
 """
 
+import numpy
+
 from .buildAndCatalog import BuildAndCatalog
 
 FILTERS = "grizy"
@@ -56,32 +63,93 @@ LIMITS_STACK = {'g': 21.5,
                 }
 
 class BuildPS1(BuildAndCatalog):
-    def filter(self, data):
-        mag = numpy.ndarray((5, len(data)))
-        err = numpy.ndarray((5, len(data)))
+    # Without GOOD or GOOD_STACK, none of a source's magnitudes can be used (see select())
+    SELECTION = "o_qualityFlag & (GOOD | GOOD_STACK)"
+    CONSTANTS = QUALITY
+
+    def getConfig(self):
+        config = super(BuildPS1, self).getConfig()
+        config.update(quality=QUALITY, limitsMean=LIMITS_MEAN, limitsStack=LIMITS_STACK)
+        return config
+
+    def getInputColumns(self):
+        return (["o_objID", "o_ra", "o_dec", "o_qualityFlag"] +
+                ["o_%s%sPSFMag%s" % (f, kind, err) for f in FILTERS for kind in ("Mean", "Stack")
+                 for err in ("", "Err")])
+
+    def getInputRaDec(self):
+        return "o_ra", "o_dec"
+
+    def keepRowGroup(self, stats):
+        """Might any sources in a row group with these statistics be selected?
+
+        A source needs the GOOD or GOOD_STACK quality bit (so a quality flag
+        of at least GOOD), and at least two bands with a mean or stack
+        magnitude within the limits.
+        """
+        def hasBelow(col, limit):
+            if col not in stats:
+                return True
+            low = stats[col][0]
+            return low is None or low != low or low <= limit # NaN: unknown
+
+        if "o_qualityFlag" in stats and stats["o_qualityFlag"][1] < min(QUALITY['GOOD'], QUALITY['GOOD_STACK']):
+            return False
+        numPossible = sum(1 for f in FILTERS if hasBelow("o_" + f + "MeanPSFMag", LIMITS_MEAN[f]) or
+                          hasBelow("o_" + f + "StackPSFMag", LIMITS_STACK[f]))
+        return numPossible >= 2
+
+    def select(self, data):
+        """Select good sources, and choose between the mean and stack magnitudes
+
+        The magnitudes are worked on in place in float32 (as they are output),
+        and the masks are built in place with the quality cuts evaluated once
+        rather than per band, to keep the temporaries for a chunk to a few
+        boolean arrays.  Each (strided, big-endian) input column is read only
+        once, into contiguous native arrays.
+        """
+        num = len(data)
+        mag = numpy.empty((5, num), dtype=numpy.float32)
+        err = numpy.empty((5, num), dtype=numpy.float32)
 
         quality = data.field("o_qualityFlag")
         extended = (quality & QUALITY['EXT']) == 0
-
+        notGoodMean = (quality & QUALITY['GOOD']) == 0
+        notGoodStack = (quality & QUALITY['GOOD_STACK']) == 0
+        notGoodStack |= extended # Stack magnitudes are only used if not "extended"
+        del quality, extended
+
+        numBad = numpy.zeros(num, dtype=numpy.uint8)
+        stack = numpy.empty(num, dtype=numpy.float32)
+        badMean = numpy.empty(num, dtype=bool)
+        badStack = numpy.empty(num, dtype=bool)
+        scratch = numpy.empty(num, dtype=bool)
         for i, f in enumerate(FILTERS):
-            mean = data.field("o_" + f + "MeanPSFMag")
-            meanErr = data.field("o_" + f + "MeanPSFMagErr")
-            badMean = (mean == -999) | ((quality & QUALITY['GOOD']) == 0) | (mean > LIMITS_MEAN[f])
-
-            stack = data.field("o_" + f + "StackPSFMag")
-            stackErr = data.field("o_" + f + "StackPSFMagErr")
-            badStack = (stack == -999) | ((quality & QUALITY['GOOD_STACK']) == 0) | (stack > LIMITS_STACK[f])
-
-            mag[i,:] = numpy.where(badMean, numpy.where(extended | badStack, numpy.nan, stack), mean)
-            err[i,:] = numpy.where(badMean, numpy.where(extended | badStack, numpy.nan, stackErr), meanErr)
-
-        numBad = numpy.isnan(mag).sum(axis=0)
-        isBad = numBad > 3
-        isGood = numpy.logical_not(isBad)
-
-        return dict([("id", data.o_objID[isGood]),
-                     ("ra", data.o_ra[isGood]),
-                     ("dec", data.o_dec[isGood])] +
-                    [(f, mag[i,isGood]) for i,f in enumerate(FILTERS)] +
-                    [(f + "_err", err[i,isGood]) for i,f in enumerate(FILTERS)]
-                    )
+            mean = mag[i]
+            numpy.copyto(mean, data.field("o_" + f + "MeanPSFMag"))
+            numpy.copyto(err[i], data.field("o_" + f + "MeanPSFMagErr"))
+            numpy.equal(mean, -999, out=badMean)
+            badMean |= notGoodMean
+            badMean |= numpy.greater(mean, LIMITS_MEAN[f], out=scratch)
+
+            numpy.copyto(stack, data.field("o_" + f + "StackPSFMag"))
+            numpy.equal(stack, -999, out=badStack)
+            badStack |= notGoodStack
+            badStack |= numpy.greater(stack, LIMITS_STACK[f], out=scratch)
+            badStack &= badMean # Now: no good mean or stack
+
+            # Use the mean if it's good, else the stack if that's good, else NaN
+            numpy.copyto(mag[i], stack, where=badMean)
+            numpy.copyto(err[i], data.field("o_" + f + "StackPSFMagErr"), where=badMean)
+            numpy.copyto(mag[i], numpy.nan, where=badStack)
+            numpy.copyto(err[i], numpy.nan, where=badStack)
+            numBad += numpy.isnan(mag[i], out=scratch)
+
+        isGood = numBad <= 3
+
+        return isGood, dict([("id", data.o_objID),
+                             ("ra", data.o_ra),
+                             ("dec", data.o_dec)] +
+                            [(f, mag[i]) for i,f in enumerate(FILTERS)] +
+                            [(f + "_err", err[i]) for i,f in enumerate(FILTERS)]
+                            )
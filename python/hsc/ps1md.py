@@ -0,0 +1,216 @@
+"""
+Merge Pan-STARRS Medium Deep (MD04) skycell catalogs into a single catalog
+
+Sources are selected from the template (i-band) catalog for each skycell and
+the other bands are matched by IPP_IDET.
+"""
+
+import re
+import os
+from collections import OrderedDict
+
+import numpy
+import pyfits
+
+from .fitsTable import writeTable, FitsTableWriter
+from .wcs import TanWcs
+from .executor import Executor
+from .manifest import Manifest, makeKey, removeArtifact
+
+# http://svn.pan-starrs.ifa.hawaii.edu/trac/ipp/wiki/MD.GR0#MD.V3Tessellation
+SIZE = 6400 # Skycell size
+BORDER = 320 # Skycell overlap
+FILTERS = "grizy"
+TEMPLATE = "i" # Template filter name
+
+MASK = ["SOURCE.MASK." + s for s in ("BADPSF", "DEFECT", "CR_LIMIT", )]
+
+# Output columns: name --> FITS format
+SCHEMA = OrderedDict([("id", "K"), ("skycell", "J"), ("ra", "D"), ("dec", "D"), ("starnotgal", "L")] +
+                     [(name, "E") for name in FILTERS] + [(name + "_err", "E") for name in FILTERS])
+
+__all__ = ["Data", "scanInputs", "processSkycell", "merge",]
+
+def getFilterFromHeader(header):
+    return header["FPA.FILTER"].replace(".00000", "")
+
+def getFilter(inFits):
+    return getFilterFromHeader(inFits[0].header)
+
+def getSkycell(filename):
+    m = re.search(r"MD04\.V3\.skycell\.(...)\.sky", filename)
+    assert m, "Unable to match"
+    return m.groups()[0]
+
+def emptyArray(num, dtype=numpy.float32):
+    array = numpy.empty(num, dtype=numpy.float32)
+    array[:] = numpy.NAN
+    return array
+
+def getStarGal(data):
+    return (-2.5*numpy.log10(data.field("KRON_FLUX")) - data.field("PSF_INST_MAG")) > 0.0
+
+class Data(object):
+    def __init__(self, inFits):
+        filterName = getFilter(inFits)
+        data = inFits[1].data
+        self.maskVal = int(sum(inFits[1].header[h] for h in MASK))
+        self.size = (inFits[0].header["NAXIS1"], inFits[0].header["NAXIS2"])
+        self.id = data.field("IPP_IDET").astype(numpy.int64)
+        self.num = len(self.id)
+        self.x = data.field("X_PSF").astype(numpy.float32)
+        self.y = data.field("Y_PSF").astype(numpy.float32)
+        self.ra = None
+        self.dec = None
+        self.flags = data.field("FLAGS").astype(numpy.int64)
+        setattr(self, "mag_" + filterName, data.field("CAL_PSF_MAG").astype(numpy.float32))
+        setattr(self, "mag_" + filterName + "_err", data.field("CAL_PSF_MAG_SIG").astype(numpy.float32))
+        self.stargal = getStarGal(data)
+        for f in set(FILTERS) - set(filterName):
+            setattr(self, "mag_" + f, emptyArray(self.num))
+            setattr(self, "mag_" + f + "_err", emptyArray(self.num))
+        self.calculateRaDec(inFits)
+
+    def calculateRaDec(self, inFits):
+        self.ra, self.dec = TanWcs.fromHeader(inFits[0].header).pixelToSky(self.x, self.y)
+
+    def add(self, inFits):
+        """Add measurements in another band, matching on IPP_IDET
+
+        Neither our sources nor the inputs need be sorted by IPP_IDET.
+        If an IPP_IDET appears more than once in our sources, only the
+        first is updated.
+        """
+        filterName = getFilter(inFits)
+        data = inFits[1].data
+        if self.num == 0:
+            return
+        ident = data.field("IPP_IDET").astype(numpy.int64)
+        order = numpy.argsort(self.id, kind="mergesort")
+        sortedId = self.id[order]
+        index = numpy.searchsorted(sortedId, ident).clip(0, self.num - 1)
+        matched = sortedId[index] == ident
+        target = order[index[matched]]
+
+        getattr(self, "mag_" + filterName)[target] = data.field("CAL_PSF_MAG")[matched]
+        getattr(self, "mag_" + filterName + "_err")[target] = data.field("CAL_PSF_MAG_SIG")[matched]
+        numpy.bitwise_or.at(self.flags, target, data.field("FLAGS").astype(numpy.int64)[matched])
+
+    def tossBad(self, border=BORDER):
+        indices = numpy.where((self.x > border) & (self.x < self.size[0] - border) &
+                              (self.y > border) & (self.y < self.size[1] - border) &
+                              numpy.logical_not(numpy.bitwise_and(self.flags, self.maskVal)) &
+                              numpy.logical_not(numpy.isnan(getattr(self, "mag_" + TEMPLATE))))
+        for name in ["id", "x", "y", "ra", "dec", "flags", "stargal",] + ["mag_" + f for f in FILTERS] + ["mag_" + f + "_err" for f in FILTERS]:
+            setattr(self, name, getattr(self, name)[indices])
+        self.num = len(self.id)
+
+
+def scanInputs(inList):
+    """Group the inputs by skycell, reading only the primary headers
+
+    Returns a dict mapping skycell --> (template filename, list of other filenames).
+    """
+    templates = {}
+    others = {}
+    for inName in inList:
+        filterName = getFilterFromHeader(pyfits.getheader(inName, 0))
+        skycell = getSkycell(inName)
+        print inName, skycell, filterName
+        if filterName == TEMPLATE:
+            templates[skycell] = inName
+        else:
+            others.setdefault(skycell, []).append(inName)
+
+    for skycell in set(others) - set(templates):
+        print "No %s-band template for skycell %s; ignoring %d inputs" % (TEMPLATE, skycell, len(others[skycell]))
+    return dict((skycell, (templates[skycell], others.get(skycell, []))) for skycell in templates)
+
+def getSkycellName(outName, skycell):
+    return "%s_skycell_%s.fits" % (outName.replace(".fits", ""), skycell)
+
+def writeSkycell(data, skycell, outName):
+    """Write the merged sources for a skycell
+
+    The file is renamed into place when complete, so its existence means it's good.
+    """
+    columns = dict([("skycell", numpy.ones(data.num, dtype=numpy.int32) * int(skycell)),
+                    ("ra", data.ra),
+                    ("dec", data.dec),
+                    ("starnotgal", data.stargal),
+                    ] +
+                   [(f, getattr(data, "mag_" + f)) for f in FILTERS] +
+                   [(f + "_err", getattr(data, "mag_" + f + "_err")) for f in FILTERS])
+    writeTable(outName + ".tmp", OrderedDict((name, SCHEMA[name]) for name in SCHEMA if name != "id"), columns)
+    os.rename(outName + ".tmp", outName)
+
+def processSkycell(skycell, templateName, otherList, outName):
+    """Merge the bands for a single skycell, writing the result
+
+    Returns the number of sources written.
+    """
+    inFile = pyfits.open(templateName)
+    data = Data(inFile)
+    inFile.close()
+    for inName in otherList:
+        inFile = pyfits.open(inName)
+        data.add(inFile)
+        inFile.close()
+    data.tossBad()
+    writeSkycell(data, skycell, outName)
+    print "Wrote %d sources for skycell %s as %s" % (data.num, skycell, outName)
+    return data.num
+
+
+def merge(outName, inList, threads=0, keepSkycells=False):
+    """Merge skycell catalogs
+
+    Each skycell is processed independently (in a pool of 'threads' processes
+    if 'threads' > 1) and written to its own file.  These are then combined
+    into 'outName'.
+
+    The skycell files are recorded in a manifest (<outName>_manifest.json)
+    with a key from the contents of their inputs, so that an interrupted
+    merge can be resumed, and a skycell whose inputs have changed (or whose
+    file is incomplete) is merged again.  Once the output is written, the
+    skycell files are removed, unless 'keepSkycells'.
+    """
+    manifest = Manifest("%s_manifest.json" % outName.replace(".fits", ""))
+    skycellList = sorted(scanInputs(inList).items())
+    skycellNames = dict((skycell, getSkycellName(outName, skycell)) for skycell, _ in skycellList)
+    argList = []
+    keys = []
+    for skycell, (templateName, otherList) in skycellList:
+        key = makeKey(manifest.hashFile(templateName), [manifest.hashFile(inName) for inName in otherList])
+        if manifest.isCurrent(skycellNames[skycell], key):
+            continue
+        manifest.forget(skycellNames[skycell])
+        removeArtifact(skycellNames[skycell])
+        argList.append((skycell, templateName, otherList, skycellNames[skycell]))
+        keys.append(key)
+    try:
+        with Executor(threads) as executor:
+            for index, _ in executor.imap(processSkycell, argList):
+                manifest.record(argList[index][3], keys[index])
+    finally:
+        manifest.save()
+
+    # Stream each skycell's sources into the output in turn, numbering as we go
+    writer = FitsTableWriter(outName + ".tmp", SCHEMA)
+    num = 0
+    for skycell, _ in skycellList:
+        inFile = pyfits.open(skycellNames[skycell])
+        inData = inFile[1].data
+        columns = dict((name, inData.field(name)) for name in SCHEMA if name != "id")
+        columns["id"] = numpy.arange(num, num + len(inData), dtype=numpy.int64)
+        num += writer.append(columns)
+        inFile.close()
+    writer.close()
+    os.rename(outName + ".tmp", outName)
+    print "Wrote %d sources as %s" % (num, outName)
+
+    if not keepSkycells:
+        for skycell, _ in skycellList:
+            manifest.forget(skycellNames[skycell])
+            removeArtifact(skycellNames[skycell])
+        manifest.save()
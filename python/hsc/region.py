@@ -0,0 +1,209 @@
+"""
+Regions of the sky: cones, RA/Dec boxes, spherical polygons and unions of them
+
+Each region tests arrays of positions with contains(ra, dec), and provides
+a bounding cone (centre and radius) that is used to choose the healpixes that
+might hold sources in the region.
+
+The survey footprints used to select PS1 sources (see ps1db) are available
+by name from getFootprint().
+"""
+
+import numpy
+
+__all__ = ["Cone", "Box", "Polygon", "Union", "getFootprint", "radecToVector", "getSeparation",]
+
+
+def radecToVector(ra, dec):
+    """Return an Nx3 array of unit vectors for ra,dec (degrees)"""
+    ra = numpy.radians(numpy.asarray(ra, dtype=numpy.float64))
+    dec = numpy.radians(numpy.asarray(dec, dtype=numpy.float64))
+    cosDec = numpy.cos(dec)
+    return numpy.column_stack((cosDec*numpy.cos(ra), cosDec*numpy.sin(ra), numpy.sin(dec)))
+
+
+def vectorToRaDec(vector):
+    """Return ra,dec (degrees) for a unit vector"""
+    ra = numpy.degrees(numpy.arctan2(vector[1], vector[0])) % 360.0
+    dec = numpy.degrees(numpy.arcsin(numpy.clip(vector[2], -1.0, 1.0)))
+    return ra, dec
+
+
+def getSeparation(ra, dec, raCentre, decCentre):
+    """Return the angular separation (degrees) of positions from a centre (all degrees)"""
+    vectors = radecToVector(ra, dec)
+    return numpy.degrees(numpy.arccos(numpy.clip(vectors.dot(radecToVector(raCentre, decCentre)[0]),
+                                                 -1.0, 1.0)))
+
+
+def getBoundingCone(vectors, margin=0.0):
+    """Return a cone (ra, dec, radius; degrees) containing the unit vectors, expanded by 'margin' (degrees)"""
+    centre = vectors.sum(axis=0)
+    norm = numpy.sqrt(centre.dot(centre))
+    if norm < 1.0e-12:
+        return 0.0, 90.0, 180.0
+    centre /= norm
+    radius = numpy.degrees(numpy.arccos(numpy.clip(vectors.dot(centre), -1.0, 1.0))).max()
+    ra, dec = vectorToRaDec(centre)
+    return ra, dec, min(radius + margin, 180.0)
+
+
+class Cone(object):
+    """Positions within 'radius' of (ra, dec); all in degrees"""
+    def __init__(self, ra, dec, radius):
+        self.ra = ra
+        self.dec = dec
+        self.radius = radius
+        self.centre = radecToVector(ra, dec)[0]
+        self.cosRadius = numpy.cos(numpy.radians(radius))
+
+    def __repr__(self):
+        return "Cone(%r, %r, %r)" % (self.ra, self.dec, self.radius)
+
+    def contains(self, ra, dec):
+        return radecToVector(ra, dec).dot(self.centre) >= self.cosRadius
+
+    def getBoundingCone(self):
+        return self.ra, self.dec, self.radius
+
+
+class Box(object):
+    """Positions within ranges of RA and Dec (degrees)
+
+    If raMin > raMax, the box wraps through RA=0.
+    """
+    def __init__(self, raMin, raMax, decMin, decMax):
+        if decMin > decMax:
+            raise RuntimeError("Bad Dec range for box: %f > %f" % (decMin, decMax))
+        self.raMin = raMin % 360.0
+        self.width = raMax - raMin if raMax >= raMin else raMax - raMin + 360.0
+        self.decMin = decMin
+        self.decMax = decMax
+
+    def __repr__(self):
+        return "Box(%r, %r, %r, %r)" % (self.raMin, self.raMin + self.width, self.decMin, self.decMax)
+
+    def contains(self, ra, dec):
+        ra = numpy.asarray(ra)
+        dec = numpy.asarray(dec)
+        inRa = numpy.remainder(ra - self.raMin, 360.0) <= self.width
+        if self.width >= 360.0:
+            inRa = numpy.ones(ra.shape, dtype=bool)
+        return inRa & (dec >= self.decMin) & (dec <= self.decMax)
+
+    def getBoundingCone(self, num=90):
+        """Return a cone containing the box
+
+        The box edges are sampled with 'num' points each; the cone is expanded
+        by half the sample spacing, which is as far as the edge can stray from
+        the samples.
+        """
+        ra = self.raMin + numpy.linspace(0.0, self.width, num)
+        dec = numpy.linspace(self.decMin, self.decMax, num)
+        raEdge = numpy.concatenate([ra, ra, numpy.repeat(ra[[0, -1]], num)])
+        decEdge = numpy.concatenate([numpy.repeat([self.decMin, self.decMax], num), dec, dec])
+        margin = 0.5*max(self.width, self.decMax - self.decMin)/(num - 1)
+        return getBoundingCone(radecToVector(raEdge, decEdge), margin)
+
+
+class Polygon(object):
+    """Positions within a spherical polygon, with great-circle edges
+
+    The vertices are a list of (ra, dec) in degrees, in either direction
+    around the polygon.  The polygon needn't be convex, but must lie within
+    a hemisphere.  Points are tested in the gnomonic projection about the
+    bounding cone's centre, in which the edges are straight lines.
+    """
+    def __init__(self, vertices):
+        if len(vertices) < 3:
+            raise RuntimeError("Polygon needs at least three vertices: %s" % (vertices,))
+        self.vertices = [(float(ra), float(dec)) for ra, dec in vertices]
+        vectors = radecToVector([v[0] for v in self.vertices], [v[1] for v in self.vertices])
+        self.cone = getBoundingCone(vectors)
+        if self.cone[2] >= 90.0:
+            raise RuntimeError("Polygon doesn't fit within a hemisphere: %s" % (vertices,))
+        self.centre = radecToVector(self.cone[0], self.cone[1])[0]
+        # Basis for the projection: east and north at the centre
+        east = numpy.cross([0.0, 0.0, 1.0], self.centre)
+        if east.dot(east) < 1.0e-24:
+            east = numpy.array([0.0, 1.0, 0.0])
+        self.east = east/numpy.sqrt(east.dot(east))
+        self.north = numpy.cross(self.centre, self.east)
+        self.xVertex, self.yVertex = self.project(vectors)
+
+    def __repr__(self):
+        return "Polygon(%r)" % (self.vertices,)
+
+    def project(self, vectors):
+        """Gnomonic projection of unit vectors about the centre"""
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            scale = 1.0/vectors.dot(self.centre)
+        return vectors.dot(self.east)*scale, vectors.dot(self.north)*scale
+
+    def contains(self, ra, dec):
+        vectors = radecToVector(ra, dec)
+        front = vectors.dot(self.centre) > 0
+        x, y = self.project(vectors)
+        # Even-odd rule: count the edges crossed by a ray in +x
+        inside = numpy.zeros(len(vectors), dtype=bool)
+        num = len(self.xVertex)
+        for i in range(num):
+            x1, y1 = self.xVertex[i], self.yVertex[i]
+            x2, y2 = self.xVertex[(i + 1) % num], self.yVertex[(i + 1) % num]
+            if y1 == y2:
+                continue
+            crosses = (y1 > y) != (y2 > y)
+            xCross = x1 + (y - y1)*(x2 - x1)/(y2 - y1)
+            inside ^= crosses & (x < xCross)
+        return inside & front
+
+    def getBoundingCone(self):
+        return self.cone
+
+
+class Union(object):
+    """Positions within any of a list of regions"""
+    def __init__(self, regions):
+        if not regions:
+            raise RuntimeError("Union needs at least one region")
+        self.regions = list(regions)
+
+    def __repr__(self):
+        return "Union(%r)" % (self.regions,)
+
+    def contains(self, ra, dec):
+        result = self.regions[0].contains(ra, dec)
+        for region in self.regions[1:]:
+            result |= region.contains(ra, dec)
+        return result
+
+    def getBoundingCone(self):
+        cones = [region.getBoundingCone() for region in self.regions]
+        if len(cones) == 1:
+            return cones[0]
+        vectors = radecToVector([c[0] for c in cones], [c[1] for c in cones])
+        centre = vectors.sum(axis=0)
+        norm = numpy.sqrt(centre.dot(centre))
+        if norm < 1.0e-12:
+            return 0.0, 90.0, 180.0
+        centre /= norm
+        radius = max(numpy.degrees(numpy.arccos(numpy.clip(v.dot(centre), -1.0, 1.0))) + c[2] for
+                     v, c in zip(vectors, cones))
+        ra, dec = vectorToRaDec(centre)
+        return ra, dec, min(radius, 180.0)
+
+
+# HSC survey areas, as in the PSPS queries in the ps1db docstring
+FOOTPRINTS = {"hsc_fall": Union([Box(22*15 - 0.5, (2 + 40/60.0)*15 + 0.5, -1.5, 7.5),
+                                 Box((1 + 50/60.0)*15 - 0.5, (2 + 40/60.0)*15 + 0.5, -7.5, -0.5)]),
+              "hsc_spring": Box(8.5*15 - 0.5, 15*15 + 0.5, -2.5, 5.5),
+              "hsc_north": Box((13 + 20/60.0)*15 - 0.5, (16 + 40/60.0)*15 + 0.5, 42, 44.5),
+              "elaisn1": Cone((16 + 10/60.0)*15, 54, 2.5),
+              }
+
+
+def getFootprint(name):
+    """Return the region for a named survey footprint"""
+    if name not in FOOTPRINTS:
+        raise RuntimeError("Unknown footprint %s: known are %s" % (name, ", ".join(sorted(FOOTPRINTS))))
+    return FOOTPRINTS[name]
@@ -0,0 +1,203 @@
+"""
+Instrumentation of the stages of a run: a JSON-lines log of tasks and a summary
+
+Each task (converting an input, gathering a shard, building an index) is
+recorded with its wall and CPU time, rows and bytes in and out, and peak
+memory, as a line of JSON appended to the log file as soon as it finishes,
+so the log of an interrupted run is still useful.  At the end of the run,
+a summary gives the totals for each stage, the slowest task in each, and
+the critical path: the chain of tasks that determined the elapsed time.
+"""
+
+import os
+import json
+import time
+import resource
+from collections import OrderedDict
+from contextlib import contextmanager
+
+__all__ = ["RunLog", "measureCall", "getFileSize", "getMemoryStatus",]
+
+
+def getMemoryStatus(key):
+    """Return a memory statistic (kB) from /proc/self/status"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(key + ":"):
+                return int(line.split()[1])
+    raise RuntimeError("No %s in /proc/self/status" % key)
+
+
+def resetPeakMemory():
+    """Reset the peak resident set size of this process (Linux only); returns whether it worked"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except IOError:
+        return False
+
+
+def getPeakMemory():
+    """Return the peak resident set size (MB) of this process"""
+    try:
+        return getMemoryStatus("VmHWM")/1024.0
+    except (IOError, RuntimeError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+
+def getCpuTime():
+    """Return the user + system CPU time (sec) of this process"""
+    times = os.times()
+    return times[0] + times[1]
+
+
+def measureCall(func, args, reset=False):
+    """Call func(*args), returning the result and a dict of resource use
+
+    The resource use has the 'start' and 'end' (Unix time), 'wall' and
+    'cpu' time (sec), peak memory ('maxrss'; MB) and 'pid'.  The peak
+    memory is that of the call alone if 'reset' (which should be used
+    only in a worker, where nothing else cares about the process's peak);
+    otherwise, it's the peak of the process so far.
+    """
+    if reset:
+        resetPeakMemory()
+    cpu = getCpuTime()
+    start = time.time()
+    result = func(*args)
+    end = time.time()
+    return result, dict(start=start, end=end, wall=end - start, cpu=getCpuTime() - cpu,
+                        maxrss=getPeakMemory(), pid=os.getpid())
+
+
+def getFileSize(names):
+    """Return the total size (bytes) of a file, a directory's files, or a list of them
+
+    Missing files count as zero.
+    """
+    if isinstance(names, basestring):
+        names = [names]
+    size = 0
+    for name in names:
+        if os.path.isdir(name):
+            size += sum(os.path.getsize(os.path.join(name, fn)) for fn in os.listdir(name))
+        elif os.path.exists(name):
+            size += os.path.getsize(name)
+    return size
+
+
+def getSum(records, key):
+    """Return the sum of a value over the records that have it, or None if none do"""
+    values = [r[key] for r in records if r.get(key) is not None]
+    return sum(values) if values else None
+
+
+class RunLog(object):
+    """Log of the tasks in a run
+
+    Each record is a dict with the 'stage' and 'task' names, and some of:
+    'start' and 'end' (Unix time), 'wall' and 'cpu' (sec), 'maxrss' (MB),
+    'rowsIn', 'rowsOut', 'bytesIn', 'bytesOut', 'error', and 'depends', the
+    tasks in the same stage that had to finish before it started.  Stages
+    are taken to run one after another, in the order they're first seen.
+
+    Records are appended to 'filename' (if not None) as lines of JSON.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.run = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.records = []
+        self.stages = OrderedDict() # Stage name --> [start, end]
+
+    def add(self, stage, task, **values):
+        """Record a task"""
+        record = OrderedDict([("run", self.run), ("stage", stage), ("task", task)])
+        record.update(sorted(values.items()))
+        self.records.append(record)
+        if stage not in self.stages:
+            self.stages[stage] = [record.get("start"), record.get("end")]
+        if self.filename is not None:
+            with open(self.filename, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage, including the work between its tasks (e.g., scheduling)"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages[name] = [start, time.time()]
+
+    def getStageRecords(self, stage):
+        return [r for r in self.records if r["stage"] == stage]
+
+    def getCriticalPath(self):
+        """Return the list of records on the critical path
+
+        Within a stage, this is the longest chain (by wall time) of tasks
+        and their dependencies; the stages are run one after another, so the
+        critical path of the run goes through each of them.
+        """
+        path = []
+        for stage in self.stages:
+            records = dict((r["task"], r) for r in self.getStageRecords(stage) if r.get("wall") is not None)
+            longest = {}
+
+            def getLongest(name):
+                if name not in longest:
+                    depends = [getLongest(dep) for dep in records[name].get("depends", []) if dep in records]
+                    best = max(depends, key=lambda chain: chain[0]) if depends else (0.0, [])
+                    longest[name] = (best[0] + records[name]["wall"], best[1] + [records[name]])
+                return longest[name]
+
+            chains = [getLongest(name) for name in records]
+            if chains:
+                path += max(chains, key=lambda chain: chain[0])[1]
+        return path
+
+    def summarize(self):
+        """Print a summary of each stage and the critical path"""
+        if not self.records:
+            return
+        print "Run summary:"
+        total = 0.0
+        for stage, (start, end) in self.stages.items():
+            records = self.getStageRecords(stage)
+            done = [r for r in records if r.get("wall") is not None]
+            elapsed = end - start if start is not None and end is not None else 0.0
+            total += elapsed
+            wall = sum(r["wall"] for r in done)
+            cpu = sum(r.get("cpu") or 0.0 for r in done)
+            print "  %s: %d tasks in %.1f sec; %.1f sec wall (%.1f at once), %.1f sec CPU (%.0f%%) in tasks" % \
+                (stage, len(records), elapsed, wall, wall/elapsed if elapsed > 0 else 0.0, cpu,
+                 100.0*cpu/wall if wall > 0 else 0.0)
+            rowsIn, rowsOut = getSum(records, "rowsIn"), getSum(records, "rowsOut")
+            bytesIn, bytesOut = getSum(records, "bytesIn"), getSum(records, "bytesOut")
+            if rowsIn is not None or rowsOut is not None:
+                print "    rows: %s in, %s out" % ("?" if rowsIn is None else rowsIn,
+                                                   "?" if rowsOut is None else rowsOut)
+            if bytesIn is not None or bytesOut is not None:
+                print "    data: %.1f MB in, %.1f MB out" % ((bytesIn or 0)/1024.0**2, (bytesOut or 0)/1024.0**2)
+            phases = [(key, getSum(records, key)) for key in ("readTime", "filterTime", "writeTime")]
+            if any(value is not None for _, value in phases):
+                print "    " + ", ".join("%s %.1f sec" % (key[:-len("Time")], value) for key, value in phases if
+                                         value is not None)
+            maxrss = [r["maxrss"] for r in done if r.get("maxrss") is not None]
+            if maxrss:
+                print "    peak memory: %.0f MB" % max(maxrss)
+            if done:
+                slowest = max(done, key=lambda r: r["wall"])
+                print "    slowest: %s, %.1f sec (%.0f%% of the stage)" % \
+                    (slowest["task"], slowest["wall"], 100.0*slowest["wall"]/elapsed if elapsed > 0 else 0.0)
+            failed = [r["task"] for r in records if r.get("error") is not None]
+            if failed:
+                print "    failed: %s" % ", ".join(failed)
+
+        path = self.getCriticalPath()
+        if path:
+            length = sum(r["wall"] for r in path)
+            print "Critical path: %.1f sec of %.1f sec elapsed" % (length, total)
+            for r in path:
+                print "    %-10s %-30s %10.1f sec" % (r["stage"], r["task"], r["wall"])
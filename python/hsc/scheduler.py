@@ -0,0 +1,230 @@
+"""
+Run tasks with dependencies in parallel
+
+A task is started as soon as all the tasks it depends upon have finished,
+rather than waiting for a whole stage to complete, so the pool stays busy.
+"""
+
+import os
+import sys
+import time
+import Queue
+import traceback
+import multiprocessing
+
+from .external import runCommand, CommandPool, CommandError
+
+__all__ = ["Scheduler",]
+
+
+def runTask(func, args, kwargs):
+    """Run a task, returning the elapsed time, the result and any error traceback
+
+    Errors are caught here because the (python 2) Pool.apply_async has no
+    error callback.
+    """
+    start = time.time()
+    try:
+        result = func(*args, **kwargs)
+        error = None
+    except Exception:
+        result = None
+        error = "".join(traceback.format_exception(*sys.exc_info()))
+    return time.time() - start, result, error
+
+
+def runCommandTask(task, retries):
+    """Run a command task in the foreground, returning as for runTask"""
+    return getCommandValue(task, runCommand(task.command, retries=retries, check=False))
+
+
+def getCommandValue(task, result):
+    """Convert the CommandResult for a command task into the elapsed time, result and error
+
+    On failure, any outputs of the task are removed, so that they aren't
+    mistaken for good ones.
+    """
+    if result.returncode == 0:
+        return result.wall, result, None
+    for filename in task.outputs:
+        if os.path.exists(filename):
+            os.unlink(filename)
+    return result.wall, result, str(CommandError(result))
+
+
+class Task(object):
+    def __init__(self, name, func, args, kwargs, depends, command=None, outputs=()):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.depends = set(depends)
+        self.command = command
+        self.outputs = outputs
+        self.elapsed = None
+        self.end = None
+        self.result = None
+        self.error = None
+
+
+class Scheduler(object):
+    """Run tasks, respecting their dependencies, with optional threading
+
+    Tasks are identified by name; a task may depend upon any tasks added
+    before it.  If a task fails, the tasks depending upon it are skipped,
+    and a RuntimeError is raised when everything else is done; if 'failFast'
+    is set, no further tasks are started after a failure.
+
+    A task is either a python function, run in a process pool, or an
+    external command, run directly (with up to 'retries' retries) from
+    this process by a CommandPool.  Either way, no more than 'threads'
+    tasks run at once.
+    """
+    def __init__(self, threads, retries=0, failFast=False):
+        self.threads = threads
+        self.retries = retries
+        self.failFast = failFast
+        self.tasks = {}
+        self.order = []
+
+    def add(self, name, func, args=(), kwargs=None, depends=()):
+        """Add a python function to run"""
+        self.addTask(Task(name, func, args, kwargs if kwargs is not None else {}, depends))
+
+    def addCommand(self, name, command, depends=(), outputs=()):
+        """Add an external command to run; 'outputs' are removed if it fails"""
+        self.addTask(Task(name, None, (), {}, depends, command=command, outputs=outputs))
+
+    def addTask(self, task):
+        if task.name in self.tasks:
+            raise RuntimeError("Duplicate task name: %s" % (task.name,))
+        for dep in task.depends:
+            if dep not in self.tasks:
+                raise RuntimeError("Task %s depends on unknown task %s" % (task.name, dep))
+        self.tasks[task.name] = task
+        self.order.append(task.name)
+
+    def run(self):
+        """Run all the tasks, returning a dict of task name --> result"""
+        self.execute()
+        self.report()
+        notRun = [name for name in self.order if self.tasks[name].error in ("Dependency failed", "Not run")]
+        failed = [name for name in self.order if self.tasks[name].error is not None and name not in notRun]
+        if failed:
+            raise RuntimeError("%d tasks failed (%s); %d not run" %
+                               (len(failed), ", ".join(str(name) for name in failed), len(notRun)))
+        return dict((name, self.tasks[name].result) for name in self.order)
+
+    def execute(self):
+        """Execute the tasks, setting their results (see finish) and errors"""
+        if self.threads > 1:
+            self.runPool()
+            return
+        stop = False
+        for name in self.order:
+            task = self.tasks[name]
+            if stop:
+                task.error = "Not run"
+            elif any(self.tasks[dep].error is not None for dep in task.depends):
+                task.error = "Dependency failed"
+            else:
+                if task.command is not None:
+                    self.finish(task, runCommandTask(task, self.retries))
+                else:
+                    self.finish(task, runTask(task.func, task.args, task.kwargs))
+                stop = self.failFast and task.error is not None
+
+    def runPool(self):
+        """Run the tasks in parallel, submitting each as soon as its dependencies are done
+
+        We only submit as many tasks as there are workers, so that we can stop
+        quickly on failure.
+        """
+        pool = None
+        if any(self.tasks[name].command is None for name in self.order):
+            pool = multiprocessing.Pool(self.threads)
+        commands = CommandPool(retries=self.retries)
+        results = Queue.Queue()
+        waiting = dict((name, set(self.tasks[name].depends)) for name in self.order)
+        dependents = dict((name, []) for name in self.order)
+        for name in self.order:
+            for dep in self.tasks[name].depends:
+                dependents[dep].append(name)
+
+        def submit(name):
+            task = self.tasks[name]
+            if task.command is not None:
+                commands.start(name, task.command)
+            else:
+                pool.apply_async(runTask, (task.func, task.args, task.kwargs),
+                                 callback=lambda value, name=name: results.put((name, value)))
+
+        def skip(name):
+            self.tasks[name].error = "Dependency failed"
+            del waiting[name]
+            for child in dependents[name]:
+                if child in waiting:
+                    skip(child)
+
+        def collect():
+            """Return a list of (name, value) for finished tasks, waiting for at least one"""
+            while True:
+                done = [(name, getCommandValue(self.tasks[name], result)) for name, result in commands.poll()]
+                while not results.empty():
+                    done.append(results.get())
+                if done:
+                    return done
+                try:
+                    # Doubles as the sleep between polling commands
+                    return [results.get(timeout=commands.interval if len(commands) > 0 else 60)]
+                except Queue.Empty:
+                    pass
+
+        ready = [name for name in self.order if not waiting[name]]
+        for name in ready:
+            del waiting[name]
+        running = 0
+        while ready or running > 0:
+            while ready and running < self.threads:
+                submit(ready.pop(0))
+                running += 1
+            for name, value in collect():
+                running -= 1
+                task = self.tasks[name]
+                self.finish(task, value)
+                if task.error is not None and self.failFast:
+                    for other in ready + list(waiting):
+                        self.tasks[other].error = "Not run"
+                    ready = []
+                    waiting.clear()
+                    continue
+                for child in dependents[name]:
+                    if child not in waiting:
+                        continue
+                    if task.error is not None:
+                        skip(child)
+                        continue
+                    waiting[child].discard(name)
+                    if not waiting[child]:
+                        del waiting[child]
+                        ready.append(child)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def finish(self, task, value):
+        task.elapsed, task.result, task.error = value
+        task.end = time.time()
+        if task.error is not None:
+            print "Task %s failed after %.1f sec:\n%s" % (task.name, task.elapsed, task.error)
+        else:
+            print "Task %s took %.1f sec" % (task.name, task.elapsed)
+
+    def report(self):
+        """Print the wall time for each task, longest first"""
+        done = [self.tasks[name] for name in self.order if self.tasks[name].elapsed is not None]
+        if not done:
+            return
+        print "Task wall times (total %.1f sec over %d tasks):" % (sum(t.elapsed for t in done), len(done))
+        for task in sorted(done, key=lambda t: t.elapsed, reverse=True):
+            print "    %-30s %10.1f sec%s" % (task.name, task.elapsed, "" if task.error is None else " FAILED")
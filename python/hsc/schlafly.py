@@ -0,0 +1,75 @@
+"""
+Convert the Pan-STARRS ubercal catalog of Schlafly et al. to astrometry.net format
+
+Each input file has the object id ('obj_id'), position and, for each of the
+grizy bands, the mean magnitude, its error and the standard deviation of the
+measurements, stored as vector columns ('mean', 'err' and 'stdev', each
+with an element per band).  These are split into a column per band.
+"""
+
+import numpy
+
+from .buildAndCatalog import BuildAndCatalog
+
+FILTERS = "grizy"
+VECTORS = {"mean": "", "err": "_err", "stdev": "_stdev"} # Input vector column --> output column suffix
+
+# Rows to transpose at a time: small enough that the block of each vector
+# column and its transpose stay in the cache
+BLOCK_ROWS = 4096
+
+__all__ = ["BuildSchlafly", "transposeColumn",]
+
+
+def transposeColumn(array, dtype=numpy.float32, blockRows=BLOCK_ROWS):
+    """Transpose a vector column (rows x elements) into an array of contiguous rows, one per element
+
+    Taking each element as array[:,i] makes a strided pass over the whole
+    column per element (and, for FITS, byte-swaps each of them); instead,
+    the column is converted in blocks of 'blockRows' rows, each of which is
+    read once and written to all the outputs while it's in the cache.
+    """
+    num, size = array.shape
+    result = numpy.empty((size, num), dtype=dtype)
+    for start in range(0, num, blockRows):
+        stop = min(start + blockRows, num)
+        result[:, start:stop] = array[start:stop].T
+    return result
+
+
+class BuildSchlafly(BuildAndCatalog):
+    """Build from the Schlafly et al. ubercal catalog
+
+    All sources are kept.
+    """
+    def __init__(self, *args, **kwargs):
+        super(BuildSchlafly, self).__init__(*args, **kwargs)
+        self.schema = dict([("id", "K"), ("ra", "D"), ("dec", "D")] +
+                           [(f + suffix, "E") for suffix in VECTORS.values() for f in FILTERS])
+        self.buildArgs = "-S r -L 20 -E -M -j 0.4 -n 100"
+        self.scales = [0, 1, 2, 3, 4]
+
+    @classmethod
+    def makeParser(cls):
+        parser = super(BuildSchlafly, cls).makeParser()
+        parser.set_defaults(nside=16)
+        return parser
+
+    def getInputColumns(self):
+        return ["obj_id", "ra", "dec"] + sorted(VECTORS)
+
+    def getInputRaDec(self):
+        return "ra", "dec"
+
+    def select(self, data):
+        # Some of the vector columns (e.g., "mean") are methods of the pyfits.FITS_rec
+        # class, so we need to use field() rather than grabbing an attribute.
+        columns = dict(id=data.field("obj_id"), ra=data.field("ra"), dec=data.field("dec"))
+        for name, suffix in VECTORS.items():
+            values = transposeColumn(data.field(name))
+            if len(values) != len(FILTERS):
+                raise RuntimeError("Column %s has %d elements; expected %d for %s" %
+                                   (name, len(values), len(FILTERS), FILTERS))
+            for f, array in zip(FILTERS, values):
+                columns[f + suffix] = array
+        return None, columns
@@ -1,8 +1,28 @@
+import os
+
 from .buildAndCatalog import BuildAndCatalog
 
 FILTERS = "UGRIZ"
 
+# From http://www.sdss3.org/dr9/algorithms/bitmask_calib_status.php
+# 0x0001 PHOTOMETRIC
+# 0x0002 OVERLAP
+# 0x0004 EXTRAP_CLEAR
+# 0x0008 EXTRAP_CLOUDY
+# 0x0010 DISJOINT
+# 0x0020 INCREMENT
+# 0x0040 RESERVED
+# 0x0080 RESERVED
+# 0x0100 PT_CLEAR
+# 0x0200 PT_CLOUDY
+# 0x0400 DEFAULT
+# 0x0800 NO_UBERCAL
+# Higher bits???
+PHOTOMETRIC = 0x0001
+
 class BuildSdss(BuildAndCatalog):
+    SELECTION = "STARNOTGAL"
+
     def __init__(self, *args, **kwargs):
         super(BuildSdss, self).__init__(*args, **kwargs)
         self.schema = dict([("id", "K"), ("ra", "D"), ("dec", "D"), ("thing_id", "K")] +
@@ -10,6 +30,65 @@ class BuildSdss(BuildAndCatalog):
                            [(f.lower() + "_err", "E") for f in FILTERS])
         self.buildArgs = "-S r -L 20 -E -M -j 0.4 -n 100 -r 1"
 
-    def filter(self, data):
-        isGood = data.field("STARNOTGAL").astype("bool")
-        return dict([(col, data.field(col.upper())[isGood]) for col in self.schema])
+    def getInputColumns(self):
+        return [col.upper() for col in self.schema]
+
+    def getInputRaDec(self):
+        return "RA", "DEC"
+
+    def select(self, data):
+        return None, dict([(col, data.field(col.upper())) for col in self.schema])
+
+
+class BuildSdssRecal(BuildSdss):
+    """Build from the recalibrated DR9 sweeps, astromSweeps-<run>.fits (see mash_sweeps.pro)
+
+    Sources are kept if they're PHOTOMETRIC (in CALIB_STATUS) in all bands,
+    whether stars or galaxies; STARNOTGAL is passed through.  The inputs
+    may be listed as files, or as runs (e.g., dr9runs.txt) to be found in
+    a directory.  The selected rows are streamed straight into the shards
+    by default, rather than partitioning the ~800 runs into fragments.
+    """
+    SELECTION = "all(CALIB_STATUS & PHOTOMETRIC)"
+    CONSTANTS = dict(PHOTOMETRIC=PHOTOMETRIC)
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("stream", True)
+        super(BuildSdssRecal, self).__init__(*args, **kwargs)
+        self.schema["starnotgal"] = "L"
+        self.buildArgs = "-S r -L 13 -E -M -j 0.4 -n 100"
+        self.scales = [0, 1, 2, 3, 4]
+
+    @classmethod
+    def makeParser(cls):
+        parser = super(BuildSdssRecal, cls).makeParser()
+        parser.add_argument("--runs", help="File listing the runs to read (e.g., dr9runs.txt)")
+        parser.add_argument("--sweeps", default=".", help="Directory containing astromSweeps-<run>.fits")
+        parser.add_argument("--no-stream", dest="stream", action="store_false",
+                            help="Partition each run into fragments, rather than streaming into the shards")
+        parser.set_defaults(nside=16, stream=True)
+        return parser
+
+    @classmethod
+    def getInputList(cls, args, parser):
+        """Return the input files, adding those for the runs listed in args.runs
+
+        Runs without a file are skipped: mash_sweeps doesn't write one for a
+        run without any good objects.
+        """
+        inputList = list(args.input)
+        if args.runs is not None:
+            with open(args.runs) as f:
+                runs = [int(line) for line in f if line.strip()]
+            missing = []
+            for run in runs:
+                inName = os.path.join(args.sweeps, "astromSweeps-%04d.fits" % run)
+                if os.path.exists(inName):
+                    inputList.append(inName)
+                else:
+                    missing.append(run)
+            if missing:
+                print "No sweeps in %s for %d runs: %s" % (args.sweeps, len(missing), " ".join(map(str, missing)))
+        if not inputList:
+            parser.error("No inputs")
+        return inputList
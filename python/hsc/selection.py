@@ -0,0 +1,204 @@
+"""
+Selection of catalog rows by expression, e.g., "o_qualityFlag & GOOD and o_iMeanPSFMag < 21"
+
+An expression is written in Python syntax, with names being input columns or
+named constants (e.g., flag bits), and is evaluated on whole columns with
+numpy.  'and', 'or' and 'not' act elementwise, as do chained comparisons
+(e.g., "0 < r < 22"), and a value that isn't boolean (e.g., masked flags) is
+true where non-zero.  A few functions are provided (see FUNCTIONS); all()
+and any() reduce vector columns (e.g., one element per band) to a value per
+row.  As in Python, & and | bind more tightly than comparisons, so write
+"(flags & BIT) == 0", not "flags & BIT == 0".
+
+The expression is split into its top-level 'and' terms, each compiled
+separately.  A chunk is evaluated one term at a time, cheap terms that
+reject many rows first, and once most rows have been rejected the remaining
+terms are evaluated only on the rows that remain; once none remain, the rest
+aren't evaluated at all.  The fraction of rows passing each term is
+measured as chunks are evaluated, so the order adapts to the data.
+"""
+
+import ast
+
+import numpy
+
+__all__ = ["Selection",]
+
+# Once fewer than this fraction of the rows remain, terms are evaluated on just those rows
+SPARSE = 0.5
+
+
+def toBool(value):
+    """Return an array as boolean: true where non-zero"""
+    value = numpy.asarray(value)
+    return value if value.dtype == bool else value != 0
+
+
+def reduceAll(value):
+    """Is a vector column true in all its elements?"""
+    value = toBool(value)
+    return value.all(axis=-1) if value.ndim > 1 else value
+
+
+def reduceAny(value):
+    """Is a vector column true in any of its elements?"""
+    value = toBool(value)
+    return value.any(axis=-1) if value.ndim > 1 else value
+
+
+FUNCTIONS = dict(abs=numpy.abs, sqrt=numpy.sqrt, log10=numpy.log10, isnan=numpy.isnan, isfinite=numpy.isfinite,
+                 all=reduceAll, any=reduceAny)
+BUILTINS = dict(True=True, False=False, nan=numpy.nan, inf=numpy.inf)
+
+# Syntax allowed in an expression
+NODES = (ast.Expression, ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name, ast.Num,
+         ast.Subscript, ast.Index, ast.Slice, ast.ExtSlice, ast.Tuple, ast.expr_context, ast.boolop, ast.operator,
+         ast.unaryop, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+
+
+class Vectorize(ast.NodeTransformer):
+    """Rewrite the logical operators and chained comparisons to act elementwise"""
+    @staticmethod
+    def makeBool(node):
+        return ast.Call(func=ast.Name(id="_bool", ctx=ast.Load()), args=[node], keywords=[], starargs=None,
+                        kwargs=None)
+
+    @staticmethod
+    def combine(nodes, op):
+        result = nodes[0]
+        for node in nodes[1:]:
+            result = ast.BinOp(left=result, op=op, right=node)
+        return result
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        return ast.copy_location(self.combine([self.makeBool(value) for value in node.values], op), node)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.copy_location(ast.UnaryOp(op=ast.Invert(), operand=self.makeBool(node.operand)), node)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        operands = [node.left] + node.comparators
+        terms = [ast.Compare(left=left, ops=[op], comparators=[right]) for
+                 left, op, right in zip(operands[:-1], node.ops, operands[1:])]
+        return ast.copy_location(self.combine(terms, ast.BitAnd()), node)
+
+
+def getTerms(node):
+    """Return the top-level 'and' terms of an expression"""
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        return sum((getTerms(value) for value in node.values), [])
+    return [node]
+
+
+class Term(object):
+    """A term of a selection: compiled, with the columns it uses and its statistics
+
+    The 'cost' is the number of operations and column reads, and the rows
+    evaluated and passed are counted to estimate how selective it is.
+    """
+    def __init__(self, node, constants):
+        names = set(n.id for n in ast.walk(node) if isinstance(n, ast.Name))
+        self.constants = dict((name, constants[name]) for name in names if name in constants)
+        self.columns = sorted(names - set(constants) - set(FUNCTIONS) - set(BUILTINS))
+        self.cost = sum(1 for n in ast.walk(node) if isinstance(n, ast.expr) and not isinstance(n, ast.Num) and
+                        (not isinstance(n, ast.Name) or n.id in self.columns))
+        tree = ast.fix_missing_locations(ast.Expression(body=Vectorize().visit(node)))
+        self.code = compile(tree, "<selection>", "eval")
+        self.evaluated = 0
+        self.passed = 0
+
+    def getRank(self):
+        """Return the rank for ordering: the cost per row rejected (lowest first)"""
+        passRate = (self.passed + 1.0)/(self.evaluated + 2.0)
+        return self.cost/(1.0 - passRate)
+
+    def evaluate(self, columns, num):
+        """Evaluate on a dict of column name --> array, returning a new boolean array of length 'num'"""
+        namespace = dict(BUILTINS, _bool=toBool, **FUNCTIONS)
+        namespace.update(self.constants)
+        namespace.update(columns)
+        with numpy.errstate(invalid="ignore", divide="ignore", over="ignore"):
+            result = toBool(eval(self.code, {"__builtins__": {}}, namespace))
+        if result.ndim == 0:
+            return numpy.resize(result, num)
+        if result.shape != (num,):
+            raise RuntimeError("Selection term on %s doesn't give one value per row (shape %s); use all() or any()"
+                               % (", ".join(self.columns), result.shape))
+        if any(numpy.may_share_memory(result, array) for array in columns.values()):
+            result = result.copy() # Don't modify the column
+        return result
+
+
+class Selection(object):
+    """A selection of rows by an expression
+
+    Names in the expression that are in 'constants' (a dict of name -->
+    value) are those values, not columns.  Calling the selection on a table
+    (anything with len() and field(name), e.g., a pyfits table) returns a
+    boolean array selecting the rows that pass.  Only the columns listed in
+    'columns' are read.
+    """
+    def __init__(self, expression, constants=None):
+        self.expression = expression
+        self.constants = dict(constants) if constants else {}
+        try:
+            tree = ast.parse(expression.strip(), mode="eval")
+        except SyntaxError as e:
+            raise RuntimeError("Bad selection %r: %s" % (expression, e))
+        for node in ast.walk(tree):
+            if not isinstance(node, NODES):
+                raise RuntimeError("Unsupported %s in selection %r" % (type(node).__name__, expression))
+            if isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name) or
+                                               node.func.id not in FUNCTIONS or node.keywords or
+                                               node.starargs or node.kwargs):
+                raise RuntimeError("Unsupported function call in selection %r: functions are %s" %
+                                   (expression, ", ".join(sorted(FUNCTIONS))))
+        self.terms = [Term(node, self.constants) for node in getTerms(tree.body)]
+        self.columns = sorted(set(sum((term.columns for term in self.terms), [])))
+
+    def __repr__(self):
+        return "Selection(%r)" % (self.expression,)
+
+    def __reduce__(self):
+        # Code objects can't be pickled, so recompile
+        return Selection, (self.expression, self.constants)
+
+    def __call__(self, data):
+        num = len(data)
+        select = None # Boolean array of the rows remaining (None: all)
+        rows = None # Indices of the rows remaining, once they're sparse
+        remaining = num
+        for term in sorted(self.terms, key=Term.getRank):
+            if remaining == 0:
+                break
+            if rows is None and select is not None and remaining < SPARSE*num:
+                rows = numpy.flatnonzero(select)
+            if rows is not None:
+                passed = term.evaluate(dict((col, data.field(col)[rows]) for col in term.columns), len(rows))
+                rows = rows[passed]
+                passing = len(rows)
+            else:
+                passed = term.evaluate(dict((col, data.field(col)) for col in term.columns), num)
+                if select is None:
+                    select = passed
+                else:
+                    select &= passed
+                passing = numpy.count_nonzero(select)
+            term.evaluated += remaining
+            term.passed += passing
+            remaining = passing
+
+        if rows is not None:
+            select = numpy.zeros(num, dtype=bool)
+            select[rows] = True
+        elif select is None:
+            select = numpy.ones(num, dtype=bool)
+        return select
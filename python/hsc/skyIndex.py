@@ -0,0 +1,242 @@
+"""
+Persistent index of catalog shards for fast cone, box and polygon queries
+
+The shards written by BuildAndCatalog ('<root>_hp_<healpix>.fits') each hold
+the sources in one healpix; for an adaptive partition, the shards are
+healpixes of various nside, named by unique id and listed in
+'<root>_shards.json'.  The index, '<root>_skyindex.npz', records for each
+shard the finer healpixes (at 'fineNside') its sources fall in, and the
+permutation of its rows that sorts them by fine healpix, so the rows in any
+fine healpix are a contiguous range of the permutation.  The fine healpixes,
+their starts and the permutations of all the shards are concatenated in
+'<root>_skyindex_pixels.npy', '<root>_skyindex_starts.npy' and
+'<root>_skyindex_order.npy', which are memory-mapped, so a query reads only
+the parts for the shards it selects, however large the catalog.
+
+A query finds the shards and then the fine healpixes that might overlap
+the region (by distance of their centres from the region's bounding cone),
+reads just those rows from the memory-mapped shards, and applies the exact
+test for the region.  Only the shards selected are checked for changes
+since the index was built.
+"""
+
+import os
+import re
+import glob
+
+import numpy
+import pyfits
+
+from .healpix import radecToHealpix, healpixToRaDec, getParentHealpix, getPixelRadius, AdaptivePartition
+from .region import getSeparation
+from .executor import Executor
+
+__all__ = ["SkyIndex", "indexShard",]
+
+# Arrays of the index written as .npy files, to be memory-mapped
+ARRAYS = ("pixels", "starts", "order")
+
+
+def indexShard(filename, healpix, nside, fineNside):
+    """Index a shard, returning the fine healpixes, the start of each in the permutation, and the permutation
+
+    The shard's sources must all be in 'healpix' at 'nside'.
+    """
+    with pyfits.open(filename, memmap=True) as inFile:
+        data = inFile[1].data
+        fine = radecToHealpix(data.field("ra"), data.field("dec"), fineNside)
+        del data
+    if numpy.any(getParentHealpix(fine, fineNside, nside) != healpix):
+        raise RuntimeError("Sources in %s aren't in healpix %d at nside=%d" % (filename, healpix, nside))
+    order = numpy.argsort(fine, kind="mergesort")
+    pixels, starts = numpy.unique(fine[order], return_index=True)
+    return pixels, starts, order.astype(numpy.int32 if len(order) < 2**31 else numpy.int64)
+
+
+def readRows(filename, rows, columns=None):
+    """Read rows of a shard (memory-mapped), returning a dict of column name --> array
+
+    The 'ra' and 'dec' columns are always included.
+    """
+    with pyfits.open(filename, memmap=True) as inFile:
+        data = inFile[1].data
+        names = list(columns) if columns is not None else data.columns.names
+        names += [col for col in ("ra", "dec") if col not in names]
+        subset = data[rows]
+        result = {}
+        for col in names:
+            result[col] = numpy.array(subset.field(col))
+        del data, subset
+    return result
+
+
+class SkyIndex(object):
+    """Index of a set of healpix shards
+
+    'shards' is a list of (healpix, filename, size, mtime) at 'nside' (either
+    one value, or a list with one per shard); for each shard, 'pixels' and
+    'starts' list the fine healpixes (at 'fineNside') and the start of their
+    rows in 'order', the permutation sorting the shard's rows by fine healpix.
+    These may be views of memory-mapped arrays.
+    """
+    def __init__(self, nside, fineNside, shards, pixels, starts, order):
+        self.nside = numpy.zeros(len(shards), dtype=numpy.int64) + nside
+        self.fineNside = fineNside
+        self.shards = shards
+        self.pixels = pixels
+        self.starts = starts
+        self.order = order
+        self.checked = set() # Shards checked against the index
+
+    @staticmethod
+    def getFilename(root, array=None):
+        """Return the filename of the index, or of one of its ARRAYS"""
+        if array is not None:
+            return "%s_skyindex_%s.npy" % (root, array)
+        return "%s_skyindex.npz" % root
+
+    @classmethod
+    def build(cls, root, nside=32, fineFactor=64, threads=0):
+        """Build the index for the shards of 'root', and write it
+
+        The fine healpixes have nside 'fineFactor' times that of the shards
+        (the largest, for an adaptive partition, when 'nside' is ignored).
+        """
+        partition = None
+        if os.path.exists("%s_shards.json" % root):
+            partition = AdaptivePartition.read("%s_shards.json" % root).getHealpixes()
+        shards = []
+        for shardName in glob.glob("%s_hp_*.fits" % root):
+            m = re.search(r"_hp_(\d+)\.fits$", shardName)
+            if m:
+                shardId = int(m.group(1))
+                healpix, shardNside = partition[shardId] if partition is not None else (shardId, nside)
+                shards.append((healpix, shardName, shardNside))
+        if not shards:
+            raise RuntimeError("No shards %s_hp_*.fits" % (root,))
+        shards.sort()
+        fineNside = max(shardNside for _, _, shardNside in shards)*fineFactor
+        with Executor(threads) as executor:
+            results = executor.map(indexShard, [(shardName, healpix, shardNside, fineNside) for
+                                                healpix, shardName, shardNside in shards])
+        stats = [os.stat(shardName) for _, shardName, _ in shards]
+        index = cls([shardNside for _, _, shardNside in shards], fineNside,
+                    [(healpix, shardName, st.st_size, st.st_mtime) for (healpix, shardName, _), st in
+                     zip(shards, stats)],
+                    [r[0] for r in results], [r[1] for r in results], [r[2] for r in results])
+        index.write(root)
+        return index
+
+    def write(self, root):
+        """Write the index for the shards of 'root'
+
+        The arrays are written first, and the index (which lists the shards
+        and how much of each array is theirs) last, each under a temporary
+        name that is then renamed.
+        """
+        sizes = numpy.array([len(p) for p in self.pixels], dtype=numpy.int64)
+        rows = numpy.array([len(o) for o in self.order], dtype=numpy.int64)
+        filename = self.getFilename(root)
+        directory = os.path.dirname(os.path.abspath(filename))
+        for array, pieces in zip(ARRAYS, (self.pixels, self.starts, self.order)):
+            arrayName = self.getFilename(root, array)
+            with open(arrayName + ".tmp", "wb") as f:
+                numpy.save(f, numpy.concatenate(pieces) if pieces else numpy.empty(0, dtype=numpy.int64))
+            os.rename(arrayName + ".tmp", arrayName)
+        tempName = filename + ".tmp"
+        with open(tempName, "wb") as f:
+            numpy.savez(f, nside=self.nside, fineNside=self.fineNside,
+                        healpix=numpy.array([s[0] for s in self.shards], dtype=numpy.int64),
+                        shardNames=numpy.array([os.path.relpath(os.path.abspath(s[1]), directory) for
+                                                s in self.shards]),
+                        shardSizes=numpy.array([s[2] for s in self.shards], dtype=numpy.int64),
+                        shardTimes=numpy.array([s[3] for s in self.shards], dtype=numpy.float64),
+                        numPixels=sizes, numRows=rows)
+        os.rename(tempName, filename)
+        print "Wrote index of %d rows in %d shards as %s" % (rows.sum(), len(self.shards), filename)
+
+    @classmethod
+    def read(cls, root):
+        """Read the index for the shards of 'root'
+
+        The arrays are memory-mapped.  The shards are checked for changes
+        when they're queried (see checkShard).
+        """
+        filename = cls.getFilename(root)
+        directory = os.path.dirname(os.path.abspath(filename))
+        with numpy.load(filename) as npz:
+            contents = dict((key, npz[key]) for key in npz.files)
+        shards = [(int(healpix), os.path.join(directory, str(name)), int(size), float(mtime)) for
+                  healpix, name, size, mtime in zip(contents["healpix"], contents["shardNames"],
+                                                    contents["shardSizes"], contents["shardTimes"])]
+        arrays = {}
+        for array, sizes in zip(ARRAYS, ("numPixels", "numPixels", "numRows")):
+            arrays[array] = numpy.load(cls.getFilename(root, array), mmap_mode="r")
+            if len(arrays[array]) != contents[sizes].sum():
+                raise RuntimeError("%s doesn't match %s" % (cls.getFilename(root, array), filename))
+
+        def split(array, sizes):
+            # Views of the memory map: nothing is read until they're used
+            bounds = numpy.concatenate(([0], numpy.cumsum(sizes)))
+            return [array[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+        return cls(contents["nside"], int(contents["fineNside"]), shards,
+                   split(arrays["pixels"], contents["numPixels"]), split(arrays["starts"], contents["numPixels"]),
+                   split(arrays["order"], contents["numRows"]))
+
+    def checkShard(self, i):
+        """Raise if a shard has changed since the index was built"""
+        if i in self.checked:
+            return
+        _, shardName, size, mtime = self.shards[i]
+        st = os.stat(shardName)
+        if st.st_size != size or st.st_mtime != mtime:
+            raise RuntimeError("Shard %s has changed since its index was built" % (shardName,))
+        self.checked.add(i)
+
+    def getRows(self, region):
+        """Return a list of (shard index, rows) that might be in the region
+
+        The rows of each shard are sorted, for reading in order.
+        """
+        ra, dec, radius = region.getBoundingCone()
+        healpix = numpy.array([s[0] for s in self.shards], dtype=numpy.int64)
+        if len(healpix) == 0:
+            return []
+        candidates = []
+        for nside in numpy.unique(self.nside):
+            shards = numpy.flatnonzero(self.nside == nside)
+            near = getSeparation(*healpixToRaDec(healpix[shards], nside) + (ra, dec)) <= \
+                radius + getPixelRadius(nside)
+            candidates += shards[near].tolist()
+        result = []
+        for i in sorted(candidates):
+            self.checkShard(i)
+            pixels = self.pixels[i]
+            starts = self.starts[i]
+            stops = numpy.append(starts[1:], len(self.order[i]))
+            near = numpy.flatnonzero(getSeparation(*healpixToRaDec(pixels, self.fineNside) + (ra, dec)) <=
+                                     radius + getPixelRadius(self.fineNside))
+            if len(near) == 0:
+                continue
+            rows = numpy.concatenate([self.order[i][starts[j]:stops[j]] for j in near])
+            rows.sort()
+            result.append((i, rows))
+        return result
+
+    def query(self, region, columns=None):
+        """Return the sources in a region (from hsc.region) as a dict of column name --> array
+
+        Only the 'columns' listed (if not None) are returned.
+        """
+        pieces = {}
+        for i, rows in self.getRows(region):
+            data = readRows(self.shards[i][1], rows, columns)
+            select = region.contains(data["ra"], data["dec"])
+            for col in (columns if columns is not None else data):
+                pieces.setdefault(col, []).append(data[col][select])
+        if not pieces and self.shards:
+            # Nothing there: return empty columns of the right types
+            data = readRows(self.shards[0][1], numpy.empty(0, dtype=int), columns)
+            return dict((col, data[col]) for col in (columns if columns is not None else data))
+        return dict((col, numpy.concatenate(arrays)) for col, arrays in pieces.items())
@@ -0,0 +1,140 @@
+"""
+Vectorised gnomonic (TAN) deprojection of pixel coordinates
+
+TanWcs converts pixel positions to (ra, dec) for any CD or CDELT+PC matrix,
+working through the positions in chunks with a handful of chunk-sized
+buffers, optionally spreading the chunks over a pool of threads (numpy
+releases the GIL for the arithmetic).  Headers may use the standard PCi_j
+keywords or those written by the PS1 IPP (PC00i00j).
+"""
+
+import numpy
+from multiprocessing.pool import ThreadPool
+
+from .healpix import radecToHealpix
+
+__all__ = ["TanWcs",]
+
+
+def getMatrix(header, keyFormats, default):
+    """Read a 2x2 matrix from the first of the keyword formats for which any element is present"""
+    for keyFormat in keyFormats:
+        keys = [[keyFormat % (i, j) for j in (1, 2)] for i in (1, 2)]
+        if any(key in header for row in keys for key in row):
+            return numpy.array([[header.get(key, default[i][j]) for j, key in enumerate(row)] for
+                                i, row in enumerate(keys)], dtype=numpy.float64)
+    return None
+
+
+class TanWcs(object):
+    """Gnomonic projection: pixels --> (ra, dec)
+
+    'crval' is the (ra, dec) of the reference point (degrees), 'crpix' the
+    (1-based, as in the header) reference pixel and 'cd' the 2x2 matrix (degrees
+    per pixel) taking pixel offsets to intermediate world coordinates.  Pixel
+    coordinates are in the same convention as crpix.
+    """
+    def __init__(self, crval, crpix, cd):
+        self.crval = numpy.array(crval, dtype=numpy.float64)
+        self.crpix = numpy.array(crpix, dtype=numpy.float64)
+        self.cd = numpy.array(cd, dtype=numpy.float64)
+        if self.cd.shape != (2, 2):
+            raise RuntimeError("CD matrix must be 2x2: %s" % (self.cd,))
+        self.matrix = numpy.radians(self.cd)
+        self.sinDec = numpy.sin(numpy.radians(self.crval[1]))
+        self.cosDec = numpy.cos(numpy.radians(self.crval[1]))
+
+    @classmethod
+    def fromHeader(cls, header):
+        """Construct from a FITS header
+
+        The matrix comes from CDi_j if present, else CDELTi with the PCi_j
+        (or PS1's PC00i00j) matrix, which defaults to the identity.
+        """
+        crval = (header["CRVAL1"], header["CRVAL2"])
+        crpix = (header["CRPIX1"], header["CRPIX2"])
+        cd = getMatrix(header, ("CD%d_%d",), [[0.0, 0.0], [0.0, 0.0]])
+        if cd is None:
+            pc = getMatrix(header, ("PC%d_%d", "PC%03d%03d"), [[1.0, 0.0], [0.0, 1.0]])
+            if pc is None:
+                pc = numpy.identity(2)
+            cdelt = numpy.array([header.get("CDELT1", 1.0), header.get("CDELT2", 1.0)])
+            cd = cdelt[:, numpy.newaxis]*pc
+        return cls(crval, crpix, cd)
+
+    def deprojectChunk(self, x, y, ra, dec):
+        """Deproject a chunk of pixel positions into the provided ra, dec arrays (degrees)"""
+        # Offsets in float64, whatever the type of x, y
+        dx = numpy.empty(len(x), dtype=numpy.float64)
+        dy = numpy.empty(len(y), dtype=numpy.float64)
+        dx[:] = x
+        dy[:] = y
+        dx -= self.crpix[0]
+        dy -= self.crpix[1]
+
+        # Intermediate world coordinates (radians)
+        xi = dx*self.matrix[0, 0]
+        xi += numpy.multiply(dy, self.matrix[0, 1], out=ra)
+        eta = numpy.multiply(dx, self.matrix[1, 0], out=dx)
+        eta += numpy.multiply(dy, self.matrix[1, 1], out=dec)
+        del dx
+
+        # Gnomonic deprojection: with rho = sqrt(1 + xi^2 + eta^2),
+        # sin(dec) = (sin(dec0) + eta*cos(dec0))/rho
+        # tan(ra - ra0) = xi/(cos(dec0) - eta*sin(dec0))
+        rho = numpy.multiply(xi, xi, out=dy)
+        rho += numpy.multiply(eta, eta, out=dec)
+        rho += 1.0
+        numpy.sqrt(rho, out=rho)
+        numpy.multiply(eta, -self.sinDec, out=ra)
+        ra += self.cosDec
+        numpy.arctan2(xi, ra, out=ra)
+        numpy.multiply(eta, self.cosDec, out=dec)
+        dec += self.sinDec
+        dec /= rho
+        numpy.arcsin(dec, out=dec)
+
+        numpy.degrees(ra, out=ra)
+        ra += self.crval[0]
+        numpy.remainder(ra, 360.0, out=ra)
+        numpy.degrees(dec, out=dec)
+
+    def pixelToSky(self, x, y, chunkRows=1000000, threads=0):
+        """Return arrays of (ra, dec) in degrees for arrays of pixel positions
+
+        The positions are deprojected 'chunkRows' at a time (zero for all
+        at once), with the chunks spread over 'threads' threads if more than
+        one.  RA is in [0, 360).
+        """
+        x = numpy.asarray(x)
+        y = numpy.asarray(y)
+        if x.shape != y.shape:
+            raise RuntimeError("Shape mismatch: %s vs %s" % (x.shape, y.shape))
+        num = len(x)
+        ra = numpy.empty(num, dtype=numpy.float64)
+        dec = numpy.empty(num, dtype=numpy.float64)
+        chunkRows = chunkRows if chunkRows > 0 else max(num, 1)
+        slices = [slice(start, start + chunkRows) for start in range(0, num, chunkRows)]
+
+        def deproject(s):
+            self.deprojectChunk(x[s], y[s], ra[s], dec[s])
+
+        if threads > 1 and len(slices) > 1:
+            pool = ThreadPool(threads)
+            try:
+                pool.map(deproject, slices)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for s in slices:
+                deproject(s)
+        return ra, dec
+
+    def pixelToHealpix(self, x, y, nside, **kwargs):
+        """Return the healpix (astrometry.net numbering) of each pixel position
+
+        Keyword arguments are passed to pixelToSky.
+        """
+        ra, dec = self.pixelToSky(x, y, **kwargs)
+        return radecToHealpix(ra, dec, nside)
@@ -0,0 +1,673 @@
+"""
+A queue of tasks in a shared directory, run by workers on any number of hosts
+
+The coordinator (e.g., BuildAndCatalog.run with a queue) writes each task as
+a file of JSON in <directory>/tasks, and waits for the results to appear in
+<directory>/done.  Workers (bin/queueWorker.py on any host that can see the
+directory, or started locally with WorkQueue.startWorkers) each take the
+first task whose dependencies are done, run it and write its result, until
+the coordinator closes the queue.
+
+A worker takes a task by creating its lease, <directory>/leases/<task>,
+exclusively, and touches the lease every 'heartbeat' seconds while the task
+runs.  A lease that hasn't been touched for 'leaseTime' seconds is taken to
+belong to a worker that has died (or lost the filesystem): another worker
+takes it over and runs the task again, and after 'maxAttempts' attempts the
+task fails.  Because leases are timed by file modification times, the
+'leaseTime' must be well beyond the 'heartbeat' plus any difference between
+the hosts' clocks.
+
+Workers run no threads, because forking (e.g., build-astrometry-index) with
+threads running can deadlock under python 2.  Instead, a worker runs each
+python task in a forked child, or starts each command with a CommandPool,
+and touches the lease from the loop that waits for it to finish.
+
+Python tasks are methods of a target object (e.g., the BuildAndCatalog),
+which is pickled into <directory>/targets for the workers, or functions
+named as "module:function"; commands are run with an external.CommandPool.
+Their arguments and results must be representable as JSON.  Files are
+written under temporary names and renamed, so no one sees them partially
+written.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import shutil
+import cPickle as pickle
+import ctypes
+import signal
+import importlib
+import traceback
+import multiprocessing
+
+from .runLog import measureCall
+from .external import CommandPool, CommandResult, CommandError, getStatus
+from .scheduler import Scheduler
+
+__all__ = ["WorkQueue", "Worker", "QueueExecutor", "QueueScheduler", "runWorker",]
+
+# Suffixes for the results of tasks that succeeded and failed (or weren't run)
+OK = ".ok"
+FAILED = ".failed"
+
+
+def toStr(value):
+    """Convert the unicode strings read from JSON to str, recursively"""
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, list):
+        return [toStr(v) for v in value]
+    if isinstance(value, dict):
+        return dict((toStr(k), toStr(v)) for k, v in value.items())
+    return value
+
+
+def toJson(value):
+    """Return JSON for a value, which may include numpy scalars and arrays"""
+    return json.dumps(value, default=lambda obj: obj.tolist() if hasattr(obj, "tolist") else str(obj))
+
+
+def readJson(filename):
+    with open(filename) as f:
+        return toStr(json.load(f))
+
+
+def writeAtomic(filename, contents):
+    """Write a file under a temporary name and rename it"""
+    tempName = "%s.tmp.%s" % (filename, getWorkerName())
+    with open(tempName, "wb") as f:
+        f.write(contents)
+    os.rename(tempName, filename)
+
+
+def getWorkerName():
+    """Return the name of this process, unique across hosts"""
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+def getFunctionName(func):
+    """Return the name of a function for a task: a method name, or "module:function\""""
+    if isinstance(func, basestring):
+        return func
+    return "%s:%s" % (func.__module__, func.__name__)
+
+
+def getFunction(target, name):
+    """Return the function named by getFunctionName"""
+    if ":" in name:
+        module, func = name.split(":")
+        return getattr(importlib.import_module(module), func)
+    return getattr(target, name)
+
+
+class WorkQueue(object):
+    """A queue of tasks in a shared directory
+
+    The coordinator calls reset() before submitting tasks, and close() when
+    done, which tells the workers to exit.  The lease parameters are written
+    to <directory>/config.json by reset(), and workers use those (see open()).
+    """
+    def __init__(self, directory, leaseTime=600.0, heartbeat=30.0, maxAttempts=3, interval=1.0):
+        self.directory = directory
+        self.leaseTime = leaseTime
+        self.heartbeat = heartbeat
+        self.maxAttempts = maxAttempts
+        self.interval = interval # Time between looking for results or work (sec)
+        self.batch = 0
+        self.processes = [] # Local workers
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["processes"] = [] # They belong to the coordinator
+        return state
+
+    @classmethod
+    def open(cls, directory):
+        """Return the queue in 'directory', as configured by the coordinator"""
+        return cls(directory, **readJson(os.path.join(directory, "config.json")))
+
+    def getPath(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def reset(self):
+        """Empty the queue, ready for a new run
+
+        No workers should still be running tasks from an earlier run.
+        """
+        for kind in ("tasks", "leases", "done", "targets"):
+            if os.path.exists(self.getPath(kind)):
+                shutil.rmtree(self.getPath(kind))
+            os.makedirs(self.getPath(kind))
+        if os.path.exists(self.getPath("closed")):
+            os.unlink(self.getPath("closed"))
+        self.batch = 0
+        writeAtomic(self.getPath("config.json"), toJson(dict(leaseTime=self.leaseTime, heartbeat=self.heartbeat,
+                                                             maxAttempts=self.maxAttempts,
+                                                             interval=self.interval)))
+
+    def close(self):
+        """Tell the workers to exit once they've nothing to do, and wait for the local ones"""
+        writeAtomic(self.getPath("closed"), "")
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def isClosed(self):
+        return os.path.exists(self.getPath("closed"))
+
+    def startWorkers(self, num):
+        """Start 'num' local workers"""
+        for _ in range(num):
+            process = multiprocessing.Process(target=runWorker, args=(self.directory,))
+            process.daemon = True # Don't outlive the coordinator
+            process.start()
+            self.processes.append(process)
+
+    def checkWorkers(self):
+        """Raise if there were local workers and they've all exited"""
+        if self.processes and not any(process.is_alive() for process in self.processes):
+            raise RuntimeError("All local workers for %s have exited" % (self.directory,))
+
+    def newBatch(self):
+        """Return a name for a new batch of tasks; sorting the names gives the order of submission"""
+        self.batch += 1
+        return "%04d" % self.batch
+
+    def putTarget(self, target):
+        """Write the target object for python tasks, returning its name"""
+        name = self.newBatch()
+        writeAtomic(self.getPath("targets", name + ".pickle"), pickle.dumps(target, pickle.HIGHEST_PROTOCOL))
+        return name
+
+    def submit(self, tasks):
+        """Add tasks, a list of (name, spec)
+
+        The spec is a dict with the 'depends' (list of names of tasks that
+        must succeed first), and either the 'command' to run (with the
+        'outputs' to remove on failure and 'retries'), or the 'func' to call
+        (see getFunctionName) on the 'args' and 'kwargs', the name of the
+        'target' (from putTarget), and whether to 'measure' the resource use.
+        """
+        for name, spec in tasks:
+            writeAtomic(self.getPath("tasks", name + ".json"), toJson(spec))
+
+    def listTasks(self):
+        """Return the names of all tasks, in order of submission"""
+        return sorted(fn[:-len(".json")] for fn in os.listdir(self.getPath("tasks")) if fn.endswith(".json"))
+
+    def listDone(self):
+        """Return a dict of task name --> whether it succeeded, for the tasks with results"""
+        done = {}
+        for fn in os.listdir(self.getPath("done")):
+            for suffix, ok in ((OK, True), (FAILED, False)):
+                if fn.endswith(suffix):
+                    done.setdefault(fn[:-len(suffix)], ok)
+        return done
+
+    def getResult(self, name):
+        """Return the result of a task (a dict), or None if it has none"""
+        for suffix in (OK, FAILED):
+            if os.path.exists(self.getPath("done", name + suffix)):
+                return readJson(self.getPath("done", name + suffix))
+        return None
+
+    def setResult(self, name, record):
+        """Record the result of a task: a dict with the 'result' and 'error' (None on success)"""
+        suffix = OK if record.get("error") is None else FAILED
+        writeAtomic(self.getPath("done", name + suffix), toJson(record))
+
+    def cancel(self, names, error="Not run"):
+        """Fail the tasks without results, so they aren't run"""
+        done = self.listDone()
+        for name in names:
+            if name not in done:
+                self.setResult(name, dict(result=None, error=error, elapsed=None))
+
+    def wait(self, names):
+        """Wait for the results of tasks, yielding (name, result) as each appears"""
+        remaining = set(names)
+        start = time.time()
+        last = start
+        while remaining:
+            finished = sorted(remaining.intersection(self.listDone()))
+            for name in finished:
+                remaining.discard(name)
+                yield name, self.getResult(name)
+            if remaining and not finished:
+                self.checkWorkers()
+                now = time.time()
+                if now - last >= 60.0:
+                    print "Waiting for %d tasks in %s after %.1f sec" % (len(remaining), self.directory, now - start)
+                    last = now
+                time.sleep(self.interval)
+
+    def claim(self, name, worker, attempt=1):
+        """Try to take the lease on a task, returning whether we got it"""
+        try:
+            fd = os.open(self.getPath("leases", name), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644)
+        except OSError as exc:
+            if exc.errno == errno.EEXIST:
+                return False
+            raise
+        with os.fdopen(fd, "w") as f:
+            f.write(toJson(dict(worker=worker, attempt=attempt, start=time.time())))
+        return True
+
+    def getLease(self, name):
+        """Return the lease on a task (a dict), or None if it's not leased"""
+        try:
+            return readJson(self.getPath("leases", name))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def holds(self, name, worker, attempt):
+        """Does the worker still hold the lease for this attempt at the task?"""
+        lease = self.getLease(name)
+        return lease is not None and lease.get("worker") == worker and lease.get("attempt") == attempt
+
+    def renew(self, name, worker, attempt):
+        """Touch the lease (a heartbeat), returning whether the worker still holds it"""
+        if not self.holds(name, worker, attempt):
+            return False
+        try:
+            os.utime(self.getPath("leases", name), None)
+        except OSError:
+            return False
+        return True
+
+    def release(self, name, worker, attempt):
+        """Remove the lease, if the worker still holds it"""
+        if self.holds(name, worker, attempt):
+            try:
+                os.unlink(self.getPath("leases", name))
+            except OSError:
+                pass
+
+    def takeExpired(self, name, worker):
+        """Try to take over an expired lease on a task, returning the attempt number, or None
+
+        The lease is renamed, so only one worker can take it.  If the task has
+        had 'maxAttempts' attempts, it fails instead.
+        """
+        path = self.getPath("leases", name)
+        try:
+            age = time.time() - os.stat(path).st_mtime
+        except OSError:
+            return None
+        if age < self.leaseTime:
+            return None
+        expired = "%s.expired.%s" % (path, worker)
+        try:
+            os.rename(path, expired)
+        except OSError:
+            return None # Someone else got it
+        try:
+            previous = readJson(expired)
+        except ValueError:
+            previous = {}
+        os.unlink(expired)
+        attempt = previous.get("attempt", 1) + 1
+        if attempt > self.maxAttempts:
+            self.setResult(name, dict(result=None, elapsed=None, worker=worker,
+                                      error="Lease expired %d times; last held by %s" %
+                                      (attempt - 1, previous.get("worker"))))
+            return None
+        print "Taking over task %s from %s, whose lease expired %.0f sec ago" % (name, previous.get("worker"), age)
+        return attempt if self.claim(name, worker, attempt) else None
+
+
+# prctl option to signal a process when its parent dies (Linux)
+PR_SET_PDEATHSIG = 1
+
+
+def dieWithParent(parent):
+    """Have this (child) process killed when its parent dies, where supported (Linux)
+
+    Otherwise, a task would carry on after its worker is killed, alongside
+    the worker that takes it over.
+    """
+    try:
+        ctypes.CDLL(None).prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+    except (OSError, AttributeError):
+        return
+    if os.getppid() != parent:
+        os._exit(1) # Too late
+
+
+class ForkedCall(object):
+    """Call a function in a forked child, which sends back its result
+
+    Unlike a multiprocessing.Process, this may be used in a daemonic process
+    (e.g., a local worker), and the child exits without any cleanup.
+    """
+    def __init__(self, func):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        parent = os.getpid()
+        self.pid = os.fork()
+        if self.pid == 0:
+            status = 1
+            try:
+                dieWithParent(parent)
+                reader.close()
+                writer.send(func())
+                status = 0
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        writer.close()
+        self.reader = reader
+        self.start = time.time()
+
+    def poll(self, timeout):
+        """Wait up to 'timeout' sec for the result, returning it (a dict), or None if not done"""
+        if not self.reader.poll(timeout):
+            return None
+        try:
+            record = self.reader.recv()
+        except EOFError:
+            record = None
+        self.reader.close()
+        _, status = os.waitpid(self.pid, 0)
+        if record is None:
+            record = dict(result=None, error="Task exited with status %d without a result" % getStatus(status),
+                          elapsed=time.time() - self.start)
+        return record
+
+    def kill(self):
+        os.kill(self.pid, signal.SIGKILL)
+        os.waitpid(self.pid, 0)
+        self.reader.close()
+
+
+class CommandCall(object):
+    """Run a command, polling for it to finish"""
+    def __init__(self, command, retries=0, outputs=()):
+        self.outputs = outputs
+        self.pool = CommandPool(retries=retries)
+        self.pool.start(None, command)
+
+    def poll(self, timeout):
+        """Wait up to 'timeout' sec for the command, returning its result (a dict), or None if not done
+
+        On failure, any 'outputs' are removed, so they aren't mistaken for
+        good ones.
+        """
+        end = time.time() + timeout
+        while True:
+            finished = self.pool.poll()
+            if finished:
+                break
+            if time.time() >= end:
+                return None
+            time.sleep(self.pool.interval)
+        _, result = finished[0]
+        error = None
+        if result.returncode != 0:
+            for filename in self.outputs:
+                if os.path.exists(filename):
+                    os.unlink(filename)
+            error = str(CommandError(result))
+        return dict(result=result.__dict__, error=error, elapsed=result.wall)
+
+    def kill(self):
+        self.pool.stop(None)
+
+
+class Worker(object):
+    """Run tasks from a WorkQueue until it's closed and there's nothing left to do"""
+    def __init__(self, queue, name=None):
+        self.queue = queue
+        self.name = name if name is not None else getWorkerName()
+        self.specs = {} # Task name --> spec; these don't change
+        self.targets = {} # Target name --> object
+        self.done = {} # Task name --> whether it succeeded
+
+    def getSpec(self, name):
+        if name not in self.specs:
+            self.specs[name] = readJson(self.queue.getPath("tasks", name + ".json"))
+        return self.specs[name]
+
+    def getTarget(self, name):
+        if name is None:
+            return None
+        if name not in self.targets:
+            with open(self.queue.getPath("targets", name + ".pickle"), "rb") as f:
+                self.targets[name] = pickle.load(f)
+        return self.targets[name]
+
+    def next(self):
+        """Take the first task that's ready, returning its name and the attempt, or (None, None)"""
+        self.done.update(self.queue.listDone())
+        leases = set(os.listdir(self.queue.getPath("leases")))
+        for name in self.queue.listTasks():
+            if name in self.done:
+                continue
+            if not all(self.done.get(dep, False) for dep in self.getSpec(name)["depends"]):
+                continue
+            if name in leases:
+                attempt = self.queue.takeExpired(name, self.name)
+            else:
+                attempt = 1 if self.queue.claim(name, self.name) else None
+            if attempt is None:
+                continue
+            if self.queue.getResult(name) is not None:
+                # Finished since we looked
+                self.queue.release(name, self.name, attempt)
+                continue
+            return name, attempt
+        return None, None
+
+    def run(self):
+        """Run tasks until the queue is closed and there's nothing to do; returns the number run"""
+        num = 0
+        while True:
+            name, attempt = self.next()
+            if name is None:
+                if self.queue.isClosed():
+                    break
+                time.sleep(self.queue.interval)
+                continue
+            self.runTask(name, attempt)
+            num += 1
+        return num
+
+    def runTask(self, name, attempt):
+        """Run a task we've leased, touching the lease while we wait for it, and record its result
+
+        If we lose the lease (e.g., we were too slow touching it, and another
+        worker took it over), the task is killed.
+        """
+        call = self.start(self.getSpec(name))
+        while True:
+            record = call.poll(self.queue.heartbeat)
+            if record is not None:
+                break
+            if not self.queue.renew(name, self.name, attempt):
+                call.kill()
+                break
+        if record is None or not self.queue.holds(name, self.name, attempt):
+            print "Lost the lease on task %s; discarding its result" % (name,)
+            return
+        if self.queue.getResult(name) is not None:
+            # Cancelled while we ran it
+            self.queue.release(name, self.name, attempt)
+            return
+        record.update(worker=self.name, attempt=attempt)
+        try:
+            toJson(record)
+        except (TypeError, ValueError) as exc:
+            record.update(result=None, error="Result of task %s can't be written as JSON: %s" % (name, exc))
+        self.queue.setResult(name, record)
+        self.queue.release(name, self.name, attempt)
+
+    def start(self, spec):
+        """Start a task, returning a ForkedCall or CommandCall to poll for its result"""
+        if spec.get("command") is not None:
+            return CommandCall(spec["command"], retries=spec.get("retries", 0), outputs=spec.get("outputs", []))
+        target = self.getTarget(spec.get("target")) # Load it here, so it's kept for later tasks
+        return ForkedCall(lambda: self.call(target, spec))
+
+    def call(self, target, spec):
+        """Call a python task, returning a dict with the 'result', 'error' (or None) and 'elapsed' time"""
+        start = time.time()
+        args = spec.get("args", [])
+        kwargs = spec.get("kwargs", {})
+        try:
+            func = getFunction(target, spec["func"])
+            if spec.get("measure"):
+                result, usage = measureCall(lambda *args: func(*args, **kwargs), args, reset=True)
+                usage.update(worker=self.name)
+                result = (result, usage)
+            else:
+                result = func(*args, **kwargs)
+            error = None
+        except Exception:
+            result = None
+            error = "Task %s%s failed on %s:\n%s" % (spec["func"], tuple(args), self.name,
+                                                     "".join(traceback.format_exception(*sys.exc_info())))
+        return dict(result=result, error=error, elapsed=time.time() - start)
+
+
+def runWorker(directory, wait=True):
+    """Run a worker on the queue in 'directory' until the queue is closed
+
+    If 'wait', waits for the coordinator to create the queue.
+    """
+    config = os.path.join(directory, "config.json")
+    while wait and not os.path.exists(config):
+        time.sleep(1.0)
+    worker = Worker(WorkQueue.open(directory))
+    num = worker.run()
+    print "Worker %s ran %d tasks" % (worker.name, num)
+    return num
+
+
+class QueueExecutor(object):
+    """Map functions over lists of arguments, as tasks in a WorkQueue
+
+    This has the interface of executor.Executor, for the coordinator.  The
+    'target' is written for the workers when the executor is created, so it
+    should be created once the target is ready (as for the Executor, whose
+    workers get the target when they start).
+    """
+    def __init__(self, queue, target=None, interval=30.0):
+        self.queue = queue
+        self.target = queue.putTarget(target) if target is not None else None
+        self.interval = interval
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def imap(self, func, argList, measure=False):
+        """Call func(*args) for each args in argList, yielding (index, result) as each completes
+
+        As for Executor.imap.  If a task fails, the tasks not yet run are
+        cancelled, and RuntimeError is raised.
+        """
+        batch = self.queue.newBatch()
+        funcName = getFunctionName(func)
+        tasks = [("%s-%06d" % (batch, i), dict(func=funcName, args=list(args), target=self.target, measure=measure,
+                                               depends=[])) for i, args in enumerate(argList)]
+        self.queue.submit(tasks)
+        indices = dict((name, i) for i, (name, _) in enumerate(tasks))
+
+        start = time.time()
+        last = start
+        try:
+            for num, (name, record) in enumerate(self.queue.wait(indices), 1):
+                if record["error"] is not None:
+                    raise RuntimeError(record["error"])
+                now = time.time()
+                if now - last >= self.interval and num < len(tasks):
+                    print "%s: %d/%d tasks done after %.1f sec" % (funcName, num, len(tasks), now - start)
+                    last = now
+                yield indices[name], tuple(record["result"]) if measure else record["result"]
+        finally:
+            self.queue.cancel(indices)
+        if tasks:
+            print "%s: %d tasks done in %.1f sec" % (funcName, len(tasks), time.time() - start)
+
+    def map(self, func, argList, measure=False):
+        """Call func(*args) for each args in argList, returning the list of results in order"""
+        argList = list(argList)
+        results = [None]*len(argList)
+        for index, result in self.imap(func, argList, measure=measure):
+            results[index] = result
+        return results
+
+
+class QueueScheduler(Scheduler):
+    """Run tasks, respecting their dependencies, as tasks in a WorkQueue
+
+    As for scheduler.Scheduler, except that the tasks are run by the
+    queue's workers, which respect the dependencies themselves, so all the
+    tasks are submitted at once.  Python tasks are methods of 'target'
+    (named by string) or functions defined at module level.
+    """
+    def __init__(self, queue, target=None, retries=0, failFast=False):
+        super(QueueScheduler, self).__init__(0, retries=retries, failFast=failFast)
+        self.queue = queue
+        self.target = target
+
+    def execute(self):
+        batch = self.queue.newBatch()
+        target = self.queue.putTarget(self.target) if self.target is not None else None
+        names = dict((name, "%s-%06d" % (batch, i)) for i, name in enumerate(self.order))
+        tasks = dict((queueName, name) for name, queueName in names.items())
+        dependents = dict((name, []) for name in self.order)
+        specs = []
+        for name in self.order:
+            task = self.tasks[name]
+            spec = dict(depends=sorted(names[dep] for dep in task.depends))
+            for dep in task.depends:
+                dependents[dep].append(name)
+            if task.command is not None:
+                spec.update(command=task.command, outputs=list(task.outputs), retries=self.retries)
+            else:
+                spec.update(func=getFunctionName(task.func), args=list(task.args), kwargs=task.kwargs,
+                            target=target)
+            specs.append((names[name], spec))
+        self.queue.submit(specs)
+
+        def skip(name):
+            task = self.tasks[name]
+            if task.error is None and task.end is None:
+                task.error = "Dependency failed"
+                self.queue.cancel([names[name]], task.error)
+            for child in dependents[name]:
+                skip(child)
+
+        try:
+            for queueName, record in self.queue.wait(tasks):
+                task = self.tasks[tasks[queueName]]
+                if task.error is not None or task.end is not None:
+                    continue # Cancelled
+                result = record["result"]
+                if task.command is not None and result is not None:
+                    result = CommandResult(**result)
+                self.finish(task, (record["elapsed"] or 0.0, result, record["error"]))
+                if task.error is None:
+                    continue
+                if self.failFast:
+                    for name in self.order:
+                        if self.tasks[name].end is None and self.tasks[name].error is None:
+                            self.tasks[name].error = "Not run"
+                    self.queue.cancel(tasks)
+                else:
+                    for child in dependents[task.name]:
+                        skip(child)
+        finally:
+            self.queue.cancel(tasks)
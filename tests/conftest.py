@@ -0,0 +1,5 @@
+# Run the tests against this checkout, as 'setup hscMisc' would
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "python"))
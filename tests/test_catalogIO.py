@@ -0,0 +1,101 @@
+import numpy
+import pyfits
+import pytest
+
+from hsc.catalogIO import readChunks, getSchema, getColumnNames, writeCatalog, convertCatalog, \
+    concatenateCatalogs
+
+pyarrow = pytest.importorskip("pyarrow")
+
+SCHEMA = dict(id="K", ra="D", mag="E", count="J", flag="L", small="I", byte="B")
+
+
+def makeColumns(num=1000, start=0, seed=0):
+    rng = numpy.random.RandomState(seed)
+    return dict(id=numpy.arange(start, start + num, dtype=numpy.int64),
+                ra=rng.uniform(0, 360, num),
+                mag=numpy.linspace(10, 30, num).astype(numpy.float32),
+                count=rng.randint(-1000, 1000, num).astype(numpy.int32),
+                flag=rng.uniform(size=num) < 0.5,
+                small=rng.randint(-100, 100, num).astype(numpy.int16),
+                byte=rng.randint(0, 256, num).astype(numpy.uint8))
+
+
+def readAll(filename, columns=None):
+    """Return the columns of a catalog, as a dict of column name --> array"""
+    chunks = list(readChunks(filename, columns=columns))
+    return dict((name, numpy.concatenate([numpy.asarray(data.field(name)) for data in chunks]))
+                for name in (columns or getColumnNames(filename)))
+
+
+def assertEqualColumns(columns, expected):
+    assert sorted(columns) == sorted(expected)
+    for name in expected:
+        assert numpy.array_equal(columns[name], expected[name]), name
+
+
+def testRoundTrip(tmpdir):
+    """FITS --> Parquet --> FITS preserves the columns and their types"""
+    fitsName = str(tmpdir.join("input.fits"))
+    parquetName = str(tmpdir.join("converted.parquet"))
+    outName = str(tmpdir.join("output.fits"))
+    expected = makeColumns()
+    writeCatalog(fitsName, SCHEMA, expected)
+
+    assert convertCatalog(fitsName, parquetName, chunkRows=300) == 1000
+    assert pyarrow.parquet.ParquetFile(parquetName).metadata.num_row_groups == 4
+    assert dict(getSchema(parquetName)) == SCHEMA
+    assertEqualColumns(readAll(parquetName), expected)
+
+    assert convertCatalog(parquetName, outName) == 1000
+    assert dict(getSchema(outName)) == SCHEMA
+    assertEqualColumns(readAll(outName), expected)
+    data = pyfits.getdata(outName)
+    for name in SCHEMA:
+        assert data.field(name).dtype.newbyteorder("=") == expected[name].dtype, name
+
+
+def testColumns(tmpdir):
+    """Only the columns requested are converted and read"""
+    fitsName = str(tmpdir.join("input.fits"))
+    parquetName = str(tmpdir.join("converted.parquet"))
+    expected = makeColumns()
+    writeCatalog(fitsName, SCHEMA, expected)
+    convertCatalog(fitsName, parquetName, columns=["id", "mag"])
+    assert list(getSchema(parquetName)) == ["id", "mag"]
+    assert sorted(next(readChunks(parquetName, columns=["mag"])).names) == ["mag"]
+    with pytest.raises(RuntimeError):
+        getSchema(parquetName, columns=["ra"])
+
+
+def testSkipRowGroups(tmpdir):
+    """Row groups whose statistics fail keepRowGroup aren't read"""
+    fitsName = str(tmpdir.join("input.fits"))
+    parquetName = str(tmpdir.join("converted.parquet"))
+    expected = makeColumns()
+    writeCatalog(fitsName, SCHEMA, expected)
+    convertCatalog(fitsName, parquetName, chunkRows=250) # mag increases, so each group has a distinct range
+
+    seen = []
+    def keepRowGroup(stats):
+        seen.append(stats["mag"])
+        return stats["mag"][0] < 20.0
+    chunks = list(readChunks(parquetName, chunkRows=100, keepRowGroup=keepRowGroup))
+    assert len(seen) == 4
+    mag = numpy.concatenate([data.field("mag") for data in chunks])
+    assert len(mag) == 500 and all(len(data) <= 100 for data in chunks)
+    assert numpy.array_equal(mag, expected["mag"][:500])
+
+
+def testConcatenateUnique(tmpdir):
+    """Concatenating FITS and Parquet catalogs keeps the first row with each id"""
+    first = makeColumns(600, seed=1)
+    second = makeColumns(600, start=400, seed=2)
+    inList = [str(tmpdir.join("first.fits")), str(tmpdir.join("second.parquet"))]
+    writeCatalog(inList[0], SCHEMA, first)
+    writeCatalog(inList[1], SCHEMA, second)
+    for outName in (str(tmpdir.join("out.fits")), str(tmpdir.join("out.parquet"))):
+        assert concatenateCatalogs(inList, outName, SCHEMA, unique="id") == 1000
+        expected = dict((name, numpy.concatenate([first[name], second[name][200:]])) for name in SCHEMA)
+        assertEqualColumns(readAll(outName), expected)
+        assert concatenateCatalogs(inList, outName, SCHEMA) == 1200
@@ -0,0 +1,122 @@
+import glob
+
+import numpy
+import pytest
+
+from hsc.catalogIO import writeCatalog, readChunks
+from hsc.healpix import radecToHealpix, healpixToRaDec
+from hsc.region import radecToVector
+
+pytest.importorskip("scipy")
+from hsc.crossmatch import CrossMatch, getNeighbours
+
+NSIDE = 2
+RADIUS = 5.0 # arcsec
+SCHEMA = dict(id="K", ra="D", dec="D", mag="E", count="J", flag="L")
+
+
+def offset(ra, dec, distance, rng):
+    """Offset positions by 'distance' (arcsec) in random directions"""
+    angle = rng.uniform(0, 2*numpy.pi, len(ra))
+    dDec = distance/3600.0*numpy.cos(angle)
+    dRa = distance/3600.0*numpy.sin(angle)/numpy.cos(numpy.radians(dec))
+    return (ra + dRa) % 360.0, numpy.clip(dec + dDec, -90.0, 90.0)
+
+
+def makeCatalogs(tmpdir, num=500, seed=0):
+    """Write two catalogs with pairs straddling healpix edges, and sources in only one or the other
+
+    Returns the filenames and the columns of each.
+    """
+    rng = numpy.random.RandomState(seed)
+    # Positions on the edges of healpixes, then moved off them
+    healpix = rng.randint(0, 12*NSIDE**2, num)
+    ra, dec = healpixToRaDec(healpix, NSIDE, dx=rng.uniform(0.05, 0.95, num), dy=0.0)
+    ra, dec = offset(ra, dec, rng.uniform(0, 2*RADIUS, num), rng)
+    ra2, dec2 = offset(ra, dec, rng.uniform(0, 2*RADIUS, num), rng) # Some beyond the radius
+    # A close pair in the second catalog, to check we take the nearest
+    ra2 = numpy.concatenate([ra2, offset(ra[:20], dec[:20], 2*RADIUS, rng)[0]])
+    dec2 = numpy.concatenate([dec2, dec[:20]])
+    # Unrelated sources
+    extraRa, extraDec = rng.uniform(0, 360, 100), numpy.degrees(numpy.arcsin(rng.uniform(-1, 1, 100)))
+    ra, dec = numpy.concatenate([ra, extraRa]), numpy.concatenate([dec, extraDec])
+
+    catalogs = []
+    for i, (r, d) in enumerate(((ra, dec), (ra2, dec2))):
+        n = len(r)
+        columns = dict(id=numpy.arange(n, dtype=numpy.int64) + 100000*i, ra=r, dec=d,
+                       mag=rng.uniform(15, 25, n).astype(numpy.float32),
+                       count=rng.randint(0, 100, n).astype(numpy.int32), flag=numpy.ones(n, dtype=bool))
+        filename = str(tmpdir.join("cat%d.fits" % i))
+        writeCatalog(filename, SCHEMA, columns)
+        catalogs.append((filename, columns))
+    return catalogs
+
+
+def bruteForce(first, second, radius):
+    """Return the index of the nearest source in 'second' within 'radius' (arcsec) of each in 'first'
+
+    The index is -1 where there's none.  Also returns the separations (arcsec).
+    """
+    firstVectors = radecToVector(first["ra"], first["dec"])
+    secondVectors = radecToVector(second["ra"], second["dec"])
+    chord = numpy.sqrt(((firstVectors[:, numpy.newaxis, :] - secondVectors[numpy.newaxis, :, :])**2).sum(axis=2))
+    separation = 3600.0*numpy.degrees(2.0*numpy.arcsin(0.5*chord)) # More precise than arccos for small angles
+    nearest = numpy.argmin(separation, axis=1)
+    best = separation[numpy.arange(len(nearest)), nearest]
+    return numpy.where(best <= radius, nearest, -1), best
+
+
+def readOutput(root):
+    pieces = [data for filename in sorted(glob.glob(root + "_hp_*.fits")) for data in readChunks(filename)]
+    return dict((name, numpy.concatenate([numpy.asarray(data.field(name)) for data in pieces]))
+                for name in pieces[0].names)
+
+
+@pytest.mark.parametrize("keepUnmatched", [False, True])
+def testMatch(tmpdir, keepUnmatched):
+    """The matches are those of a brute-force search, including across healpix edges"""
+    (firstName, first), (secondName, second) = makeCatalogs(tmpdir)
+    nearest, separation = bruteForce(first, second, RADIUS)
+    matched = nearest >= 0
+    assert 0 < matched.sum() < len(nearest)
+    straddling = radecToHealpix(first["ra"][matched], first["dec"][matched], NSIDE) != \
+        radecToHealpix(second["ra"][nearest[matched]], second["dec"][nearest[matched]], NSIDE)
+    assert straddling.sum() > 20
+
+    root = str(tmpdir.join("match"))
+    CrossMatch([firstName, secondName], ["a", "b"], root, radius=RADIUS, nside=NSIDE,
+               keepUnmatched=keepUnmatched).run()
+    output = readOutput(root)
+    order = numpy.argsort(output["a_id"])
+    output = dict((name, values[order]) for name, values in output.items())
+
+    expected = numpy.arange(len(nearest)) if keepUnmatched else numpy.flatnonzero(matched)
+    assert numpy.array_equal(output["a_id"], first["id"][expected])
+    assert numpy.array_equal(output["ra"], first["ra"][expected])
+    isMatched = matched[expected]
+    assert numpy.array_equal(output["b_id"][isMatched], second["id"][nearest[expected][isMatched]])
+    assert numpy.array_equal(output["b_mag"][isMatched], second["mag"][nearest[expected][isMatched]])
+    assert numpy.allclose(output["separation"][isMatched], separation[expected][isMatched], atol=1.0e-4)
+
+    # Missing values for the unmatched
+    assert isMatched.sum() < len(expected) if keepUnmatched else numpy.all(isMatched)
+    unmatched = ~isMatched
+    assert numpy.all(numpy.isnan(output["separation"][unmatched]))
+    assert numpy.all(numpy.isnan(output["b_mag"][unmatched]))
+    assert numpy.all(output["b_id"][unmatched] == -1) and numpy.all(output["b_count"][unmatched] == -1)
+    assert not numpy.any(output["b_flag"][unmatched])
+    assert numpy.all(output["b_flag"][isMatched])
+
+
+@pytest.mark.parametrize("radius", [1.0, 60.0, 600.0])
+def testNeighbours(radius):
+    """Every healpix touched by a match circle is found"""
+    rng = numpy.random.RandomState(1)
+    nside = 8
+    ra, dec = rng.uniform(0, 360, 200), numpy.degrees(numpy.arcsin(rng.uniform(-1, 1, 200)))
+    for r, d in zip(ra, dec):
+        neighbours = getNeighbours([r], [d], radius, nside)
+        num = 360
+        circleRa, circleDec = offset(numpy.full(num, r), numpy.full(num, d), radius*rng.uniform(0, 1, num), rng)
+        assert set(radecToHealpix(circleRa, circleDec, nside).tolist()) <= neighbours
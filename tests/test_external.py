@@ -0,0 +1,55 @@
+import time
+
+import pytest
+
+from hsc.external import runCommand, CommandPool, CommandError
+
+
+def testRun():
+    result = runCommand("sh -c 'echo message >&2'")
+    assert result.returncode == 0 and result.attempts == 1
+    assert result.stderr == "message\n"
+    assert result.command == "sh -c echo message >&2"
+
+
+def testError():
+    with pytest.raises(CommandError) as exc:
+        runCommand(["sh", "-c", "echo oops >&2; exit 3"], retries=2)
+    result = exc.value.result
+    assert result.returncode == 3 and result.attempts == 3
+    assert "exit status 3" in str(exc.value) and "oops" in str(exc.value)
+
+    result = runCommand("false", check=False)
+    assert result.returncode == 1 and result.attempts == 1
+
+
+def testNotFound():
+    result = runCommand("no-such-command-hscMisc", check=False)
+    assert result.returncode == 127
+
+
+def testRetries(tmpdir):
+    counter = tmpdir.join("counter")
+    result = runCommand(["sh", "-c", "echo x >> %s; test $(wc -l < %s) -gt 1" % (counter, counter)], retries=3)
+    assert result.returncode == 0 and result.attempts == 2
+
+
+def testPool(tmpdir):
+    """Commands run at once, with retries"""
+    counter = tmpdir.join("counter")
+    pool = CommandPool(retries=1)
+    start = time.time()
+    for i in range(3):
+        pool.start(i, "sleep 0.5")
+    pool.start("flaky", ["sh", "-c", "echo x >> %s; test $(wc -l < %s) -gt 1" % (counter, counter)])
+    pool.start("fail", "false")
+    pool.start("missing", "no-such-command-hscMisc")
+    results = {}
+    while len(pool) > 0:
+        results.update(pool.poll(wait=True))
+    assert time.time() - start < 1.5
+    assert sorted(results) == sorted([0, 1, 2, "flaky", "fail", "missing"])
+    assert all(results[i].returncode == 0 for i in range(3))
+    assert results["flaky"].returncode == 0 and results["flaky"].attempts == 2
+    assert results["fail"].returncode == 1 and results["fail"].attempts == 2
+    assert results["missing"].returncode == 127
@@ -0,0 +1,160 @@
+import re
+
+import numpy
+import pytest
+
+from hsc import fixedWidth
+from hsc.fixedWidth import getColumnExtents, readFixedWidth
+
+# Column name, width, numpy type
+COLUMNS = [("ID", 20, numpy.int64), ("RA", 12, numpy.float64), ("DEC", 12, numpy.float64), ("star", 4, numpy.bool_),
+           ("r_mag", 9, numpy.float32), ("r_mag_err", 9, numpy.float32)]
+DTYPES = [(name, dtype) for name, _, dtype in COLUMNS]
+
+
+def makeLines(num=100, seed=0, blank=0.1):
+    """Return the header and data lines of a table, with a fraction 'blank' of the magnitudes blank
+
+    The lines are as in the COSMOS catalog: names, dashes, a units line and
+    another line of dashes, then the data and a line that isn't data.
+    """
+    rng = numpy.random.RandomState(seed)
+    ident = rng.randint(0, 2**40, num).astype(numpy.int64)
+    ident[0] = 2**60 + 1 # Not exact as a double
+    values = [ident, rng.uniform(0, 360, num), rng.uniform(-90, 90, num), rng.uniform(size=num) < 0.5,
+              rng.uniform(-99, 99, num), rng.uniform(0, 1, num)]
+    data = []
+    for i in range(num):
+        fields = ["%d" % values[0][i], "%.7f" % values[1][i], "%.7f" % values[2][i], "%d" % values[3][i],
+                  "%.4f" % values[4][i], "%.4f" % values[5][i]]
+        for j in (4, 5):
+            if rng.uniform() < blank:
+                fields[j] = ""
+        data.append("|" + "|".join(value.rjust(width) for value, (_, width, _) in zip(fields, COLUMNS)) + "|")
+    header = ["|" + "|".join(name.rjust(width) for name, width, _ in COLUMNS) + "|",
+              "|" + "|".join("-"*width for _, width, _ in COLUMNS) + "|",
+              "|" + "|".join(("deg" if name in ("RA", "DEC") else "").rjust(width) for name, width, _ in COLUMNS) + "|",
+              "|" + "|".join("-"*width for _, width, _ in COLUMNS) + "|"]
+    return header, data
+
+
+def writeTable(filename, header, data, footer=None):
+    """Write a table, with a blank line amongst the header lines and a footer that isn't data"""
+    if footer is None:
+        footer = "Total of %d objects" % len(data)
+    with open(filename, "w") as f:
+        f.write("\n".join(header[:2] + [""] + header[2:] + data + [footer]) + "\n")
+
+
+def splitLines(filename, dtypes, dataStart=4, dataEnd=-1):
+    """Read a table the simple way, splitting each line with the extents of the runs of dashes"""
+    with open(filename) as f:
+        lines = [line.rstrip("\n") for line in f if line.strip()]
+    extents = [(m.start(), m.end()) for m in re.finditer(r"-+", lines[1])]
+    names = [lines[0][start:end].strip() for start, end in extents]
+    columns = {}
+    for name, dtype in dtypes:
+        start, end = extents[names.index(name)]
+        values = [line[start:end].strip() for line in lines[dataStart:dataEnd]]
+        if numpy.dtype(dtype).kind == "f":
+            columns[name] = numpy.array([float(v) if v else numpy.nan for v in values], dtype=dtype)
+        else:
+            columns[name] = numpy.array([int(v) for v in values]).astype(dtype)
+    return columns
+
+
+def readAll(filename, dtypes, **kwargs):
+    chunks = list(readFixedWidth(filename, dtypes, dataStart=4, dataEnd=-1, **kwargs))
+    return dict((name, numpy.concatenate([chunk[name] for chunk in chunks])) for name, _ in dtypes)
+
+
+def assertSameColumns(columns, expected):
+    """The columns have the same types and values, with NaN for the same blank values"""
+    assert sorted(columns) == sorted(expected)
+    for name in expected:
+        assert columns[name].dtype == expected[name].dtype, name
+        if expected[name].dtype.kind == "f":
+            good = ~numpy.isnan(expected[name])
+            assert numpy.array_equal(numpy.isnan(columns[name]), ~good), name
+            assert numpy.array_equal(columns[name][good], expected[name][good]), name
+        else:
+            assert numpy.array_equal(columns[name], expected[name]), name
+
+
+@pytest.mark.parametrize("chunkRows", [7, 100, 1000])
+def testFixed(tmpdir, monkeypatch, chunkRows):
+    """Equal-length lines are parsed through the memory map, as splitting each line would"""
+    filename = str(tmpdir.join("table.txt"))
+    header, data = makeLines()
+    writeTable(filename, header, data)
+    def readPadded(*args):
+        raise AssertionError("Lines should be read through the memory map")
+    monkeypatch.setattr(fixedWidth, "readPadded", readPadded)
+    columns = readAll(filename, DTYPES, chunkRows=chunkRows)
+    expected = splitLines(filename, DTYPES)
+    assert len(columns["ID"]) == len(data)
+    assert numpy.any(numpy.isnan(expected["r_mag"])) and numpy.any(numpy.isnan(expected["r_mag_err"]))
+    assert columns["ID"][0] == 2**60 + 1
+    assertSameColumns(columns, expected)
+
+
+@pytest.mark.parametrize("chunkRows", [7, 1000])
+def testRagged(tmpdir, monkeypatch, chunkRows):
+    """Lines stripped of trailing blanks are read and padded, with the same results"""
+    filename = str(tmpdir.join("table.txt"))
+    header, data = makeLines(blank=0.3)
+    # Blank trailing fields, without their delimiters, and blank lines amongst the data
+    data = [line.rstrip(" |") for line in data]
+    data = data[:10] + [""] + data[10:]
+    assert len(set(len(line) for line in data)) > 1
+    writeTable(filename, header, data, footer="end")
+    called = []
+    readPadded = fixedWidth.readPadded
+    monkeypatch.setattr(fixedWidth, "readPadded", lambda *args: called.append(True) or readPadded(*args))
+    columns = readAll(filename, DTYPES, chunkRows=chunkRows)
+    assert called
+    expected = splitLines(filename, DTYPES)
+    assert len(columns["ID"]) == len(data) - 1
+    assert numpy.isnan(expected["r_mag_err"]).sum() > 10
+    assertSameColumns(columns, expected)
+
+
+def testDataStartEnd(tmpdir):
+    """The units line, the second line of dashes, blank lines and the footer aren't data"""
+    filename = str(tmpdir.join("table.txt"))
+    header, data = makeLines(5, blank=0.0)
+    writeTable(filename, header, data)
+    columns = readAll(filename, [("ID", numpy.int64)])
+    assert columns["ID"].tolist() == [int(line.split("|")[1]) for line in data]
+    # Without dropping the footer, it's parsed as data
+    with pytest.raises(ValueError):
+        list(readFixedWidth(filename, [("ID", numpy.int64)], dataStart=4))
+    # Nothing but the footer
+    writeTable(filename, header, [])
+    assert list(readFixedWidth(filename, [("ID", numpy.int64)], dataStart=4, dataEnd=-1)) == []
+    with pytest.raises(RuntimeError):
+        list(readFixedWidth(filename, [("ID", numpy.int64)], dataStart=4, dataEnd=-10))
+
+
+def testExtents():
+    """The columns are the runs of dashes between delimiters, with or without a leading delimiter"""
+    header, _ = makeLines(1)
+    expected = [(m.start(), m.end()) for m in re.finditer(r"-+", header[1])]
+    assert getColumnExtents(header[1]) == expected
+    assert getColumnExtents(header[1][1:] + "\n") == [(start - 1, end - 1) for start, end in expected]
+    assert getColumnExtents("|---|-|--|\r\n") == [(1, 4), (5, 6), (7, 9)]
+    assert getColumnExtents("--- -- -", delimiter=" ") == [(0, 3), (4, 6), (7, 8)]
+    # As for asciitable, anything between the delimiters is part of the column
+    assert getColumnExtents(" ---|--  |") == [(0, 4), (5, 9)]
+
+
+def testErrors(tmpdir):
+    filename = str(tmpdir.join("table.txt"))
+    header, data = makeLines(20, blank=0.5)
+    writeTable(filename, header, data)
+    with pytest.raises(RuntimeError):
+        list(readFixedWidth(filename, [("nonexistent", numpy.float64)], dataStart=4, dataEnd=-1))
+    with pytest.raises(RuntimeError):
+        list(readFixedWidth(filename, [("r_mag", numpy.int32)], dataStart=4, dataEnd=-1)) # Blank values
+    with pytest.raises(RuntimeError):
+        list(readFixedWidth(filename, [("ID", numpy.int64)], dataStart=4, dataEnd=1))
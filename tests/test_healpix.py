@@ -0,0 +1,181 @@
+import os
+import glob
+
+import numpy
+import pyfits
+import pytest
+
+from hsc.healpix import radecToHealpix, healpixToRaDec, getParentHealpix, getPixelRadius, getUniqueId, \
+    splitUniqueId, getHistogram, getBrightest, splitByShard, AdaptivePartition, HealpixPartitioner, \
+    ShardWriter
+from hsc.region import radecToVector
+
+
+def makePositions(num=20000, seed=0):
+    """Return positions uniform on the sphere, plus the poles and the RA wrap"""
+    rng = numpy.random.RandomState(seed)
+    ra = numpy.concatenate([rng.uniform(0, 360, num), [0.0, 0.0, 359.9999, 180.0]])
+    dec = numpy.concatenate([numpy.degrees(numpy.arcsin(rng.uniform(-1, 1, num))), [90.0, -90.0, 0.0, 0.0]])
+    return ra, dec
+
+
+@pytest.mark.parametrize("nside", [1, 2, 8, 64])
+def testRoundTrip(nside):
+    """Positions are near the centres of their healpixes, which are in the same healpixes"""
+    ra, dec = makePositions()
+    healpix = radecToHealpix(ra, dec, nside)
+    centreRa, centreDec = healpixToRaDec(healpix, nside)
+    cosSeparation = (radecToVector(ra, dec)*radecToVector(centreRa, centreDec)).sum(axis=1)
+    assert numpy.all(numpy.degrees(numpy.arccos(numpy.clip(cosSeparation, -1, 1))) <= getPixelRadius(nside))
+    assert numpy.array_equal(radecToHealpix(centreRa, centreDec, nside), healpix)
+
+
+def testEqualArea():
+    """Every healpix gets roughly the same number of uniform positions"""
+    ra, dec = makePositions(120000)
+    nside = 2
+    counts = getHistogram(ra, dec, nside)
+    assert counts.sum() == len(ra)
+    assert numpy.all(numpy.abs(counts - counts.mean()) < 5*numpy.sqrt(counts.mean()))
+
+
+@pytest.mark.parametrize("nside", [1, 4, 16])
+def testHierarchy(nside):
+    """Positions are in the children of their healpixes: (bighp, 2x + i, 2y + j) at 2*nside"""
+    ra, dec = makePositions()
+    healpix = radecToHealpix(ra, dec, nside)
+    child = radecToHealpix(ra, dec, 2*nside)
+    for hp, num in ((healpix, nside), (child, 2*nside)):
+        assert hp.min() >= 0 and hp.max() < 12*num**2
+    bighp, x, y = child//(4*nside**2), (child//(2*nside)) % (2*nside), child % (2*nside)
+    assert numpy.array_equal((bighp*nside + x//2)*nside + y//2, healpix)
+
+
+@pytest.mark.parametrize("nside, parentNside", [(8, 1), (16, 4), (32, 32)])
+def testParent(nside, parentNside):
+    ra, dec = makePositions()
+    assert numpy.array_equal(getParentHealpix(radecToHealpix(ra, dec, nside), nside, parentNside),
+                             radecToHealpix(ra, dec, parentNside))
+
+
+def testPoles():
+    """The poles are at the corners of base healpixes 0-3 (north) and 8-11 (south)"""
+    for nside in (1, 2, 16):
+        north, south = radecToHealpix([0.0, 0.0], [90.0, -90.0], nside)
+        assert north//nside**2 in range(4) and south//nside**2 in range(8, 12)
+
+
+def testUniqueId():
+    for nside in (1, 2, 16, 1024):
+        healpix = numpy.array([0, 12*nside**2 - 1])
+        for hp in healpix:
+            assert splitUniqueId(getUniqueId(hp, nside)) == (hp, nside)
+
+
+def testBrightest():
+    """The brightest in each healpix, as found by a loop"""
+    rng = numpy.random.RandomState(1)
+    ra, dec = makePositions(5000)
+    mag = rng.uniform(10, 20, len(ra))
+    mag[::50] = numpy.nan
+    nside = 2
+    keep = getBrightest(ra, dec, mag, nside, 10)
+    assert numpy.all(numpy.diff(mag[keep][~numpy.isnan(mag[keep])]) >= 0)
+    healpix = radecToHealpix(ra, dec, nside)
+    expected = []
+    for hp in numpy.unique(healpix):
+        indices = numpy.flatnonzero(healpix == hp)
+        expected += indices[numpy.argsort(mag[indices], kind="mergesort")[:10]].tolist()
+    assert sorted(keep.tolist()) == sorted(expected)
+    assert len(getBrightest(ra, dec, mag, nside, 0)) == len(ra)
+
+
+def testAdaptivePartition(tmpdir):
+    """The shards cover every non-empty healpix once, with no more than the maximum rows unless at maxNside"""
+    rng = numpy.random.RandomState(2)
+    ra, dec = makePositions(50000)
+    # A dense clump
+    ra = numpy.concatenate([ra, rng.normal(150, 0.5, 50000) % 360])
+    dec = numpy.concatenate([dec, numpy.clip(rng.normal(2, 0.5, 50000), -90, 90)])
+    minNside, maxNside, maxRows = 2, 32, 2000
+    counts = getHistogram(ra, dec, maxNside)
+    partition = AdaptivePartition.fromHistogram(counts, minNside, maxNside, maxRows)
+    assert sum(rows for _, rows in partition.shards) == len(ra)
+    nsides = set()
+    for uniqueId, rows in partition.shards:
+        healpix, nside = splitUniqueId(uniqueId)
+        nsides.add(nside)
+        assert minNside <= nside <= maxNside
+        assert rows <= maxRows or nside == maxNside
+    assert len(nsides) > 1
+
+    shard = partition.getShard(ra, dec)
+    for uniqueId, rows in partition.shards:
+        assert (shard == uniqueId).sum() == rows
+        healpix, nside = splitUniqueId(uniqueId)
+        assert numpy.all(radecToHealpix(ra[shard == uniqueId], dec[shard == uniqueId], nside) == healpix)
+
+    filename = str(tmpdir.join("shards.json"))
+    partition.write(filename)
+    copy = AdaptivePartition.read(filename)
+    assert copy.shards == partition.shards and copy.getConfig() == partition.getConfig()
+
+
+def testPartitioner(tmpdir):
+    """Rows are written to fragments by healpix, once each"""
+    ra, dec = makePositions(3000)
+    ident = numpy.arange(len(ra), dtype=numpy.int64)
+    schema = dict(id="K", ra="D", dec="D")
+    nside = 2
+    partitioner = HealpixPartitioner(str(tmpdir), schema, nside, bufferRows=1000)
+    for start in range(0, len(ra), 500):
+        rows = slice(start, start + 500)
+        partitioner.add(dict(id=ident[rows], ra=ra[rows], dec=dec[rows]))
+    counts = partitioner.close()
+
+    seen = []
+    for fragName in glob.glob(os.path.join(str(tmpdir), "hp_*_*.fits")):
+        hp = int(os.path.basename(fragName).split("_")[1])
+        data = pyfits.getdata(fragName)
+        assert numpy.all(radecToHealpix(data.field("ra"), data.field("dec"), nside) == hp)
+        seen += data.field("id").tolist()
+    assert sum(counts.values()) == len(seen)
+    assert sorted(seen) == ident.tolist()
+
+
+def testPartitionerUnique(tmpdir):
+    """Duplicate ids in the same buffer are written once"""
+    ra, dec = makePositions(1000)
+    ident = numpy.arange(len(ra), dtype=numpy.int64)
+    partitioner = HealpixPartitioner(str(tmpdir), dict(id="K", ra="D", dec="D"), 2, unique="id")
+    partitioner.add(dict(id=ident, ra=ra, dec=dec))
+    partitioner.add(dict(id=ident[:300], ra=ra[:300], dec=dec[:300]))
+    partitioner.add(dict(id=ident[:10], ra=ra[:10], dec=dec[:10]), select=numpy.arange(10) % 2 == 0)
+    partitioner.close()
+    seen = []
+    for fragName in glob.glob(os.path.join(str(tmpdir), "hp_*_*.fits")):
+        seen += pyfits.getdata(fragName).field("id").tolist()
+    assert sorted(seen) == ident.tolist()
+
+
+def testShardWriter(tmpdir):
+    """Rows streamed in are appended to a file per healpix, in the order added"""
+    ra, dec = makePositions(3000)
+    ident = numpy.arange(len(ra), dtype=numpy.int64)
+    schema = dict(id="K", ra="D", dec="D")
+    nside = 2
+    template = os.path.join(str(tmpdir), "shard_%d.fits")
+    writer = ShardWriter(template, schema, bufferRows=700)
+    for start in range(0, len(ra), 500):
+        rows = slice(start, start + 500)
+        healpix = radecToHealpix(ra[rows], dec[rows], nside)
+        writer.add(splitByShard(dict(id=ident[rows], ra=ra[rows], dec=dec[rows]), schema, healpix))
+    counts = writer.close()
+
+    healpix = radecToHealpix(ra, dec, nside)
+    assert sorted(counts) == sorted(set(healpix.tolist()))
+    for hp, num in counts.items():
+        data = pyfits.getdata(template % hp)
+        assert len(data) == num
+        assert numpy.array_equal(data.field("id"), ident[healpix == hp])
+        assert numpy.array_equal(data.field("ra"), ra[healpix == hp])
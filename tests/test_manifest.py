@@ -0,0 +1,105 @@
+import os
+
+from hsc.manifest import Manifest, makeKey, removeArtifact
+
+
+def write(path, contents):
+    with open(str(path), "w") as f:
+        f.write(contents)
+
+
+def testHashFile(tmpdir):
+    """Hashes follow the contents, and are cached against the size and modification time"""
+    manifest = Manifest(str(tmpdir.join("manifest.json")))
+    inputName = str(tmpdir.join("input"))
+    write(inputName, "abcd")
+    os.utime(inputName, (1000, 1000))
+    original = manifest.hashFile(inputName)
+
+    write(inputName, "abce") # Same size and mtime: the cached hash is used, without reading
+    os.utime(inputName, (1000, 1000))
+    assert manifest.hashFile(inputName) == original
+    os.utime(inputName, (2000, 2000)) # A new mtime causes the contents to be read again
+    changed = manifest.hashFile(inputName)
+    assert changed != original
+
+    write(inputName, "abcd")
+    os.utime(inputName, (3000, 3000))
+    assert manifest.hashFile(inputName) == original
+    write(inputName, "abcde") # A new size, even with the same mtime
+    os.utime(inputName, (3000, 3000))
+    assert manifest.hashFile(inputName) not in (original, changed)
+
+    # The cache survives saving
+    manifest.save()
+    write(inputName, "abcdf")
+    os.utime(inputName, (3000, 3000))
+    assert Manifest(manifest.filename).hashFile(inputName) == manifest.hashFile(inputName)
+
+
+def testCurrent(tmpdir):
+    """An artifact is current only if recorded with the same key, and still present and the same size"""
+    manifest = Manifest(str(tmpdir.join("manifest.json")))
+    inputName = str(tmpdir.join("input"))
+    artifact = str(tmpdir.join("artifact"))
+    write(inputName, "input")
+    key = makeKey(manifest.hashFile(inputName), dict(nside=32))
+    assert not manifest.isCurrent(artifact, key)
+    write(artifact, "output")
+    assert not manifest.isCurrent(artifact, key) # Not recorded
+    manifest.record(artifact, key)
+    assert manifest.isCurrent(artifact, key)
+
+    # Changed parameters or input contents
+    assert not manifest.isCurrent(artifact, makeKey(manifest.hashFile(inputName), dict(nside=16)))
+    write(inputName, "changed input")
+    assert not manifest.isCurrent(artifact, makeKey(manifest.hashFile(inputName), dict(nside=32)))
+
+    # Truncated or missing
+    write(artifact, "out")
+    assert not manifest.isCurrent(artifact, key)
+    write(artifact, "output")
+    assert manifest.isCurrent(artifact, key)
+    os.unlink(artifact)
+    assert not manifest.isCurrent(artifact, key)
+
+    write(artifact, "output")
+    manifest.forget(artifact)
+    assert not manifest.isCurrent(artifact, key)
+    manifest.forget(artifact) # Forgetting twice is harmless
+
+
+def testSave(tmpdir):
+    """Records persist only once saved"""
+    filename = str(tmpdir.join("manifest.json"))
+    artifact = str(tmpdir.join("artifact"))
+    write(artifact, "output")
+    manifest = Manifest(filename)
+    manifest.record(artifact, "key")
+    assert not Manifest(filename).isCurrent(artifact, "key")
+    manifest.save()
+    assert Manifest(filename).isCurrent(artifact, "key")
+    assert not os.path.exists(filename + ".tmp")
+
+    manifest.forget(artifact)
+    manifest.save()
+    assert not Manifest(filename).isCurrent(artifact, "key")
+
+
+def testDirectory(tmpdir):
+    """Directories are artifacts, sized by their contents"""
+    manifest = Manifest(str(tmpdir.join("manifest.json")))
+    directory = tmpdir.mkdir("part")
+    write(directory.join("a"), "aaa")
+    manifest.record(str(directory), "key")
+    assert manifest.isCurrent(str(directory), "key")
+    write(directory.join("b"), "b")
+    assert not manifest.isCurrent(str(directory), "key")
+    removeArtifact(str(directory))
+    assert not directory.check()
+    removeArtifact(str(directory)) # Removing a missing artifact is harmless
+
+
+def testMakeKey():
+    assert makeKey("a", dict(x=1, y=2)) == makeKey("a", dict(y=2, x=1))
+    assert makeKey("a", [1, 2]) != makeKey("a", [2, 1])
@@ -0,0 +1,35 @@
+import numpy
+
+from hsc import ps1db
+from hsc.benchmark import makePsps, filterPs1Float64
+from hsc.fitsTable import makeDtype
+
+
+def makeData(num=5000, seed=0):
+    """Return a synthetic PSPS table with NaN magnitudes and magnitudes at the limits"""
+    rng = numpy.random.RandomState(seed)
+    data = makePsps(num, seed=seed)[1].data
+    for f in ps1db.FILTERS:
+        for kind, limits in (("Mean", ps1db.LIMITS_MEAN), ("Stack", ps1db.LIMITS_STACK)):
+            mag = data.field("o_%s%sPSFMag" % (f, kind))
+            mag[rng.uniform(size=num) < 0.05] = numpy.nan
+            mag[rng.uniform(size=num) < 0.05] = limits[f]
+            mag[rng.uniform(size=num) < 0.02] = -999
+    return data
+
+
+def testSelectMatchesFloat64():
+    """The float32 BuildPS1.select gives the same rows as the original float64 filter, as written"""
+    data = makeData()
+    build = ps1db.BuildPS1([], "test")
+    expected = filterPs1Float64(data)
+    select, columns = build.select(data)
+    if select is not None:
+        columns = dict((col, columns[col][select]) for col in build.schema)
+    assert 0 < len(columns["id"]) < len(data)
+    for col in build.schema:
+        dtype = makeDtype({col: build.schema[col]})[col].newbyteorder("=")
+        want = expected[col].astype(dtype)
+        got = numpy.asarray(columns[col]).astype(dtype)
+        assert numpy.array_equal(numpy.isnan(got), numpy.isnan(want)) if dtype.kind == "f" else True, col
+        assert numpy.array_equal(numpy.nan_to_num(got), numpy.nan_to_num(want)), col
@@ -0,0 +1,72 @@
+import numpy
+import pyfits
+import pytest
+
+from hsc import ps1md
+from hsc.benchmark import makeMdSkycell, addLoop
+
+COLUMNS = ["id", "flags"] + ["mag_" + f for f in ps1md.FILTERS] + ["mag_" + f + "_err" for f in ps1md.FILTERS]
+
+
+def reorder(inFits, order):
+    """Return a copy of an MD skycell catalog with the rows in a new order"""
+    return pyfits.HDUList([inFits[0], pyfits.BinTableHDU(inFits[1].data[order], header=inFits[1].header)])
+
+
+def makeInputs(num=2000, seed=0):
+    """Make a template with shuffled and duplicated ids, and other bands with missing and extra ids"""
+    rng = numpy.random.RandomState(seed)
+    ident = rng.permutation(num)
+    ident[:20] = ident[20:40] # Duplicates
+    template = makeMdSkycell(num, ps1md.TEMPLATE, ident=ident, seed=seed)
+    others = []
+    for i, f in enumerate(set(ps1md.FILTERS) - set(ps1md.TEMPLATE)):
+        ident = numpy.concatenate([numpy.flatnonzero(rng.uniform(size=num) < 0.8), # Some missing
+                                   num + numpy.arange(100), # Not in the template
+                                   numpy.arange(10), # Repeated
+                                   ])
+        others.append(makeMdSkycell(len(ident), f, ident=rng.permutation(ident), seed=seed + i + 1))
+    return template, others
+
+
+def testAdd():
+    """Matching shuffled inputs gives the same as the original loop on sorted inputs"""
+    template, others = makeInputs()
+    data = ps1md.Data(template)
+    for inFits in others:
+        data.add(inFits)
+
+    order = numpy.argsort(template[1].data.field("IPP_IDET"), kind="mergesort")
+    expected = ps1md.Data(reorder(template, order))
+    for inFits in others:
+        addLoop(expected, reorder(inFits, numpy.argsort(inFits[1].data.field("IPP_IDET"), kind="mergesort")))
+
+    for name in COLUMNS:
+        assert numpy.array_equal(numpy.nan_to_num(getattr(data, name)[order]),
+                                 numpy.nan_to_num(getattr(expected, name))), name
+    # Every band was matched for some sources
+    for f in ps1md.FILTERS:
+        assert numpy.isfinite(getattr(data, "mag_" + f)).sum() > 0.5*data.num
+
+
+def testAddEmpty():
+    template, others = makeInputs()
+    data = ps1md.Data(makeMdSkycell(0, ps1md.TEMPLATE))
+    data.add(others[0])
+    assert data.num == 0
+
+
+def testTossBad():
+    """All the columns are subset together, including stargal"""
+    template, others = makeInputs()
+    data = ps1md.Data(template)
+    for inFits in others:
+        data.add(inFits)
+    before = dict((name, getattr(data, name).copy()) for name in COLUMNS + ["stargal", "x", "y"])
+    data.tossBad()
+    assert 0 < data.num < len(before["id"])
+    keep = numpy.in1d(before["x"], data.x) # Positions are unique
+    assert keep.sum() == data.num
+    for name in before:
+        assert len(getattr(data, name)) == data.num, name
+        assert numpy.array_equal(numpy.nan_to_num(getattr(data, name)), numpy.nan_to_num(before[name][keep])), name
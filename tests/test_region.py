@@ -0,0 +1,95 @@
+import numpy
+import pytest
+
+from hsc.region import Cone, Box, Polygon, Union, getFootprint, getSeparation, radecToVector
+
+
+def makePositions(num=20000, seed=0):
+    """Return positions uniform on the sphere"""
+    rng = numpy.random.RandomState(seed)
+    ra = rng.uniform(0, 360, num)
+    dec = numpy.degrees(numpy.arcsin(rng.uniform(-1, 1, num)))
+    return ra, dec
+
+
+def checkBoundingCone(region, ra, dec):
+    """Everything in the region is within its bounding cone"""
+    inside = region.contains(ra, dec)
+    coneRa, coneDec, radius = region.getBoundingCone()
+    assert numpy.all(getSeparation(ra[inside], dec[inside], coneRa, coneDec) <= radius + 1.0e-9)
+
+
+def testSeparation():
+    assert getSeparation(10.0, 0.0, 20.0, 0.0) == pytest.approx(10.0)
+    assert getSeparation(0.0, 89.0, 180.0, 89.0) == pytest.approx(2.0)
+    assert getSeparation(359.5, 0.0, 0.5, 0.0) == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize("ra, dec, radius", [(150.0, 2.0, 1.5), (0.0, 0.0, 5.0), (45.0, 89.0, 3.0)])
+def testCone(ra, dec, radius):
+    allRa, allDec = makePositions()
+    cone = Cone(ra, dec, radius)
+    assert numpy.array_equal(cone.contains(allRa, allDec), getSeparation(allRa, allDec, ra, dec) <= radius)
+    checkBoundingCone(cone, allRa, allDec)
+
+
+@pytest.mark.parametrize("raMin, raMax, decMin, decMax", [(10, 30, -5, 5), (350, 10, -10, 10), (0, 360, 80, 90)])
+def testBox(raMin, raMax, decMin, decMax):
+    ra, dec = makePositions()
+    box = Box(raMin, raMax, decMin, decMax)
+    if raMax >= raMin:
+        inRa = (ra >= raMin) & (ra <= raMax)
+    else:
+        inRa = (ra >= raMin) | (ra <= raMax)
+    assert numpy.array_equal(box.contains(ra, dec), inRa & (dec >= decMin) & (dec <= decMax))
+    checkBoundingCone(box, ra, dec)
+
+
+def testPolygonSquare():
+    """A small square matches the equivalent box, away from its edges"""
+    ra, dec = makePositions(200000)
+    polygon = Polygon([(10, -1), (12, -1), (12, 1), (10, 1)])
+    box = Box(10, 12, -1, 1)
+    # Great-circle edges bulge slightly from lines of constant Dec; ignore a margin
+    interior = Box(10.01, 11.99, -0.99, 0.99).contains(ra, dec)
+    exterior = ~Box(9.99, 12.01, -1.01, 1.01).contains(ra, dec)
+    inside = polygon.contains(ra, dec)
+    assert numpy.all(inside[interior]) and not numpy.any(inside[exterior])
+    assert numpy.array_equal(inside[interior | exterior], box.contains(ra, dec)[interior | exterior])
+    checkBoundingCone(polygon, ra, dec)
+
+
+def testPolygonConcave():
+    """Points in the notch of a concave polygon are outside, regardless of vertex order"""
+    vertices = [(0, 0), (4, 0), (4, 4), (2, 1), (0, 4)]
+    for verts in (vertices, vertices[::-1]):
+        polygon = Polygon(verts)
+        assert polygon.contains([1.0, 3.0, 2.0, 2.0], [1.0, 1.0, 3.0, 0.5]).tolist() == [True, True, False, True]
+    ra, dec = makePositions()
+    checkBoundingCone(Polygon(vertices), ra, dec)
+
+
+def testPolygonHemisphere():
+    with pytest.raises(RuntimeError):
+        Polygon([(0, 0), (120, 0), (240, 0)])
+
+
+def testUnion():
+    ra, dec = makePositions()
+    regions = [Cone(10, 10, 2), Box(200, 210, -30, -20)]
+    union = Union(regions)
+    assert numpy.array_equal(union.contains(ra, dec), regions[0].contains(ra, dec) | regions[1].contains(ra, dec))
+    checkBoundingCone(union, ra, dec)
+
+
+@pytest.mark.parametrize("name", ["hsc_fall", "hsc_spring", "hsc_north", "elaisn1"])
+def testFootprint(name):
+    ra, dec = makePositions()
+    footprint = getFootprint(name)
+    assert 0 < footprint.contains(ra, dec).sum() < len(ra)
+    checkBoundingCone(footprint, ra, dec)
+
+
+def testVectors():
+    vectors = radecToVector([0, 90, 0], [0, 0, 90])
+    assert numpy.allclose(vectors, numpy.eye(3))
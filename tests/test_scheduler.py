@@ -0,0 +1,137 @@
+import os
+import time
+import operator
+
+import pytest
+
+from hsc.scheduler import Scheduler
+
+
+def fail(message):
+    raise RuntimeError(message)
+
+
+def getErrors(scheduler):
+    return dict((name, scheduler.tasks[name].error) for name in scheduler.order)
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def testOrder(threads):
+    """Tasks finish after their dependencies, and their results are returned"""
+    scheduler = Scheduler(threads)
+    scheduler.add("a", time.sleep, (0.3,))
+    scheduler.add("b", time.sleep, (0.1,))
+    scheduler.add("c", operator.add, (1, 2), depends=["a", "b"])
+    scheduler.add("d", operator.mul, (3, 4), depends=["c"])
+    scheduler.add("e", time.sleep, (0.1,))
+    results = scheduler.run()
+    assert results["c"] == 3 and results["d"] == 12
+    tasks = scheduler.tasks
+    for name in scheduler.order:
+        for dep in tasks[name].depends:
+            assert tasks[name].end - tasks[name].elapsed >= tasks[dep].end - 0.01
+    assert all(error is None for error in getErrors(scheduler).values())
+
+
+def testParallel():
+    """Independent tasks run at once"""
+    scheduler = Scheduler(4)
+    for i in range(4):
+        scheduler.add("sleep%d" % i, time.sleep, (0.5,))
+    start = time.time()
+    scheduler.run()
+    assert time.time() - start < 1.5
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def testFailure(threads):
+    """The dependents of a failed task (and theirs) are skipped, but other tasks run"""
+    scheduler = Scheduler(threads)
+    scheduler.add("fail", fail, ("Bad task",))
+    scheduler.add("child", operator.add, (1, 2), depends=["fail"])
+    scheduler.add("grandchild", operator.add, (1, 2), depends=["child"])
+    scheduler.add("other", time.sleep, (0.2,))
+    scheduler.add("otherChild", operator.add, (1, 2), depends=["other"])
+    with pytest.raises(RuntimeError) as exc:
+        scheduler.run()
+    assert "1 tasks failed (fail); 2 not run" in str(exc.value)
+    errors = getErrors(scheduler)
+    assert "Bad task" in errors["fail"]
+    assert errors["child"] == errors["grandchild"] == "Dependency failed"
+    assert errors["other"] is None and errors["otherChild"] is None
+
+
+def testBadDependency():
+    scheduler = Scheduler(1)
+    scheduler.add("a", time.sleep, (0,))
+    with pytest.raises(RuntimeError):
+        scheduler.add("a", time.sleep, (0,))
+    with pytest.raises(RuntimeError):
+        scheduler.add("b", time.sleep, (0,), depends=["unknown"])
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def testCommands(threads, tmpdir):
+    """Commands and python tasks depend upon each other"""
+    output = tmpdir.join("output")
+    scheduler = Scheduler(threads)
+    scheduler.addCommand("a", "sleep 0.3")
+    scheduler.add("b", time.sleep, (0.1,))
+    scheduler.addCommand("c", "touch %s" % (output,), depends=["a", "b"])
+    scheduler.add("d", os.path.exists, (str(output),), depends=["c"])
+    results = scheduler.run()
+    assert results["a"].returncode == 0 and results["d"] is True
+    tasks = scheduler.tasks
+    assert tasks["c"].end - tasks["c"].elapsed >= tasks["a"].end - 0.01
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def testCommandFailure(threads, tmpdir):
+    """A failed command's outputs are removed, and its dependents skipped"""
+    output = tmpdir.join("output")
+    scheduler = Scheduler(threads)
+    scheduler.addCommand("fail", "sh -c 'touch %s; false'" % (output,), outputs=[str(output)])
+    scheduler.addCommand("child", "true", depends=["fail"])
+    scheduler.addCommand("other", "true")
+    with pytest.raises(RuntimeError) as exc:
+        scheduler.run()
+    assert "1 tasks failed (fail); 1 not run" in str(exc.value)
+    errors = getErrors(scheduler)
+    assert "exit status 1" in errors["fail"]
+    assert errors["child"] == "Dependency failed" and errors["other"] is None
+    assert not output.check()
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def testFailFast(threads):
+    """After a failure, no further tasks are started"""
+    scheduler = Scheduler(threads, failFast=True)
+    scheduler.addCommand("fail", "false")
+    for i in range(5):
+        scheduler.addCommand("later%d" % i, "sleep 0.2")
+    with pytest.raises(RuntimeError):
+        scheduler.run()
+    errors = getErrors(scheduler)
+    notRun = [name for name in scheduler.order if errors[name] == "Not run"]
+    assert len(notRun) >= 5 - (threads - 1)
+    assert all(scheduler.tasks[name].elapsed is None for name in notRun)
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def testRetries(threads, tmpdir):
+    """A failed command is retried, and succeeds if a retry does"""
+    counter = tmpdir.join("counter")
+    # Fails on the first two attempts
+    command = "sh -c 'echo x >> %s; test $(wc -l < %s) -gt 2'" % (counter, counter)
+    scheduler = Scheduler(threads, retries=2)
+    scheduler.addCommand("flaky", command)
+    result = scheduler.run()["flaky"]
+    assert result.returncode == 0 and result.attempts == 3
+    assert len(counter.readlines()) == 3
+
+    counter.remove()
+    scheduler = Scheduler(threads, retries=1)
+    scheduler.addCommand("flaky", command)
+    with pytest.raises(RuntimeError):
+        scheduler.run()
+    assert scheduler.tasks["flaky"].result.attempts == 2
@@ -0,0 +1,73 @@
+import numpy
+import pyfits
+import pytest
+
+from hsc.schlafly import BuildSchlafly, transposeColumn, BLOCK_ROWS, FILTERS
+from hsc.benchmark import makeTable
+
+NUM = 2*BLOCK_ROWS + 123 # Not a multiple of the block size
+
+
+def makeSchlafly(filename, num=NUM, seed=0, elements=len(FILTERS)):
+    """Write a synthetic ubercal file, with values distinct in each band and vector column"""
+    rng = numpy.random.RandomState(seed)
+    columns = [("obj_id", "K", rng.randint(0, 2**62, num).astype(numpy.int64)),
+               ("ra", "D", rng.uniform(0, 360, num)),
+               ("dec", "D", rng.uniform(-30, 90, num))]
+    for i, name in enumerate(("mean", "err", "stdev")):
+        columns.append((name, "%dE" % elements, 100*i + 10*numpy.arange(elements) + rng.uniform(0, 1, (num, elements))))
+    makeTable(columns).writeto(filename, clobber=True)
+
+
+@pytest.mark.parametrize("num", [0, 1, BLOCK_ROWS - 1, BLOCK_ROWS, NUM])
+@pytest.mark.parametrize("dtype", [">f4", "<f4", ">f8"])
+def testTranspose(num, dtype):
+    """The blocked transpose is array.T, as contiguous float32 rows"""
+    array = numpy.random.RandomState(num).uniform(0, 30, (num, 5)).astype(dtype)
+    for kwargs in ({}, dict(blockRows=7)):
+        result = transposeColumn(array, **kwargs)
+        assert result.dtype == numpy.float32 and result.flags.c_contiguous
+        assert result.shape == (5, num)
+        assert numpy.array_equal(result, array.T.astype(numpy.float32))
+    assert numpy.array_equal(transposeColumn(array, dtype=numpy.float64), array.T.astype(numpy.float64))
+
+
+def testSelect(tmpdir):
+    """Each element of the vector columns goes to its own band's column"""
+    filename = str(tmpdir.join("schlafly.fits"))
+    makeSchlafly(filename)
+    data = pyfits.getdata(filename)
+    build = BuildSchlafly([filename], str(tmpdir.join("out")))
+    select, columns = build.select(data)
+    assert select is None
+    assert sorted(columns) == sorted(build.schema)
+    assert numpy.array_equal(columns["id"], data.field("obj_id"))
+    assert numpy.array_equal(columns["ra"], data.field("ra"))
+    assert numpy.array_equal(columns["dec"], data.field("dec"))
+    for i, f in enumerate(FILTERS):
+        assert numpy.array_equal(columns[f], data.field("mean")[:, i])
+        assert numpy.array_equal(columns[f + "_err"], data.field("err")[:, i])
+        assert numpy.array_equal(columns[f + "_stdev"], data.field("stdev")[:, i])
+
+
+def testConvert(tmpdir):
+    """Converting in chunks that aren't a multiple of the block size gives the same columns"""
+    inName = str(tmpdir.join("schlafly.fits"))
+    outName = str(tmpdir.join("converted.fits"))
+    makeSchlafly(inName)
+    build = BuildSchlafly([inName], str(tmpdir.join("out")), chunkRows=BLOCK_ROWS + 1000)
+    assert build.convert(inName, outName)["rowsOut"] == NUM
+    data = pyfits.getdata(inName)
+    output = pyfits.getdata(outName)
+    assert numpy.array_equal(output.field("id"), data.field("obj_id"))
+    for i, f in enumerate(FILTERS):
+        assert numpy.array_equal(output.field(f), data.field("mean")[:, i])
+        assert numpy.array_equal(output.field(f + "_err"), data.field("err")[:, i])
+        assert numpy.array_equal(output.field(f + "_stdev"), data.field("stdev")[:, i])
+
+
+def testWrongBands(tmpdir):
+    filename = str(tmpdir.join("schlafly.fits"))
+    makeSchlafly(filename, num=10, elements=4)
+    with pytest.raises(RuntimeError):
+        BuildSchlafly([filename], str(tmpdir.join("out"))).select(pyfits.getdata(filename))
@@ -0,0 +1,78 @@
+import os
+import glob
+
+import numpy
+import pytest
+
+from hsc.sdssSweep import BuildSdssRecal
+from hsc.benchmark import writeInputs, getSweepColumns, AREA
+from hsc.fitsTable import readTable
+from hsc.manifest import Manifest
+
+NSIDE = 8
+
+
+def readShards(root, schema):
+    """Return the columns of each shard, as a dict of shard id --> columns"""
+    shards = {}
+    for shardName in glob.glob(root + "_hp_*.fits"):
+        shardId = int(shardName[len(root + "_hp_"):-len(".fits")])
+        shards[shardId] = readTable(shardName, schema)
+    return shards
+
+
+def build(tmpdir, name, inputList, **kwargs):
+    """Select the inputs into shards, returning the build, the shard keys and the shards"""
+    root = str(tmpdir.join(name))
+    recal = BuildSdssRecal(inputList, root, nside=NSIDE, bufferRows=500, chunkRows=400, **kwargs)
+    manifest = Manifest(root + "_manifest.json")
+    shardKeys = recal.streamShards(manifest) if recal.stream else recal.partitionAndGather(manifest)
+    return recal, shardKeys, readShards(root, recal.schema)
+
+
+@pytest.fixture
+def inputList(tmpdir):
+    return [filename for filename, _ in writeInputs(str(tmpdir), "sweep", getSweepColumns, 3000, 1000, area=AREA)]
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def testStream(tmpdir, inputList, threads):
+    """Streaming gives the shards of partitioning, with the rows in input order and no intermediate files"""
+    _, _, expected = build(tmpdir, "parts", inputList, stream=False)
+    recal, shardKeys, shards = build(tmpdir, "stream", inputList, threads=threads)
+    assert recal.stream
+    assert sorted(shards) == sorted(expected) == sorted(shardKeys)
+    assert sum(len(columns["id"]) for columns in shards.values()) > 0
+    for shardId, columns in shards.items():
+        order = numpy.argsort(expected[shardId]["id"])
+        for col in recal.schema:
+            assert numpy.array_equal(columns[col], expected[shardId][col][order]), col
+    assert not glob.glob(recal.outputRoot + "_part_*") and not glob.glob(recal.outputRoot + "_stream_*")
+
+    # Nothing has changed, so nothing is written again
+    mtimes = dict((name, os.path.getmtime(name)) for name in glob.glob(recal.outputRoot + "_hp_*.fits"))
+    _, again, _ = build(tmpdir, "stream", inputList, threads=threads)
+    assert again == shardKeys
+    assert all(os.path.getmtime(name) == mtime for name, mtime in mtimes.items())
+
+
+def testStreamDedupeSort(tmpdir, inputList):
+    """Duplicates across inputs are dropped, and the shards sorted, as when partitioning"""
+    inputList = inputList + inputList[:1]
+    kwargs = dict(dedupe=True, cullNside=NSIDE*4)
+    _, _, expected = build(tmpdir, "parts", inputList, stream=False, **kwargs)
+    recal, _, shards = build(tmpdir, "stream", inputList, threads=3, **kwargs)
+    assert sorted(shards) == sorted(expected)
+    for shardId, columns in shards.items():
+        assert len(numpy.unique(columns["id"])) == len(columns["id"])
+        assert numpy.all(numpy.diff(columns["r"]) >= 0)
+        for col in recal.schema:
+            assert numpy.array_equal(columns[col], expected[shardId][col]), col
+    assert not glob.glob(recal.outputRoot + "_stream_*")
+
+
+def testStreamIncompatible(inputList):
+    with pytest.raises(RuntimeError):
+        BuildSdssRecal(inputList, "unused", useHpsplit=True)
+    with pytest.raises(RuntimeError):
+        BuildSdssRecal(inputList, "unused", queue="unused")
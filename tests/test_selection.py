@@ -0,0 +1,67 @@
+import pickle
+
+import numpy
+import pytest
+
+from hsc.selection import Selection
+from hsc.catalogIO import ColumnTable
+
+
+def makeTable(num=10000, seed=0):
+    rng = numpy.random.RandomState(seed)
+    return ColumnTable(dict(r=rng.uniform(10, 25, num), err=rng.uniform(0, 0.3, num),
+                            flags=rng.randint(0, 16, num).astype(numpy.int32),
+                            status=rng.randint(0, 4, (num, 5)).astype(numpy.int16)))
+
+
+@pytest.mark.parametrize("expression, expected", [
+    ("r < 20", lambda t: t.field("r") < 20),
+    ("15 < r < 20", lambda t: (t.field("r") > 15) & (t.field("r") < 20)),
+    ("r < 20 and err < 0.1", lambda t: (t.field("r") < 20) & (t.field("err") < 0.1)),
+    ("r < 12 or not err < 0.25", lambda t: (t.field("r") < 12) | (t.field("err") >= 0.25)),
+    ("flags & BIT", lambda t: (t.field("flags") & 4) != 0),
+    ("(flags & BIT) == 0 and r < 22", lambda t: ((t.field("flags") & 4) == 0) & (t.field("r") < 22)),
+    ("all(status & 1)", lambda t: ((t.field("status") & 1) != 0).all(axis=1)),
+    ("any(status == 3) and sqrt(err) < 0.4", lambda t: (t.field("status") == 3).any(axis=1) &
+     (numpy.sqrt(t.field("err")) < 0.4)),
+    ("r > 30", lambda t: numpy.zeros(len(t), dtype=bool)),
+])
+def testSelection(expression, expected):
+    """Evaluating term by term gives the same rows as evaluating the whole expression"""
+    table = makeTable()
+    selection = Selection(expression, dict(BIT=4))
+    want = expected(table)
+    for _ in range(3): # Term order adapts as chunks are evaluated
+        assert numpy.array_equal(selection(table), want)
+
+
+def testSparse():
+    """Later terms are evaluated only on the few remaining rows"""
+    table = makeTable()
+    selection = Selection("r < 11 and err < 0.1 and flags == 3")
+    want = (table.field("r") < 11) & (table.field("err") < 0.1) & (table.field("flags") == 3)
+    assert numpy.array_equal(selection(table), want)
+
+
+def testColumns():
+    selection = Selection("(flags & BIT) == 0 and r < LIMIT and isfinite(err)", dict(BIT=4, LIMIT=20))
+    assert selection.columns == ["err", "flags", "r"]
+
+
+@pytest.mark.parametrize("expression", ["__import__('os')", "r.sum() > 0", "open('x')", "r < ",
+                                        "[r for r in x]", "lambda: 1"])
+def testUnsupported(expression):
+    with pytest.raises(RuntimeError):
+        Selection(expression)
+
+
+def testVectorNeedsReduction():
+    with pytest.raises(RuntimeError):
+        Selection("status == 3")(makeTable())
+
+
+def testPickle():
+    selection = Selection("r < LIMIT and err < 0.1", dict(LIMIT=20))
+    copy = pickle.loads(pickle.dumps(selection, pickle.HIGHEST_PROTOCOL))
+    table = makeTable()
+    assert numpy.array_equal(copy(table), selection(table))
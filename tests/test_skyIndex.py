@@ -0,0 +1,49 @@
+import numpy
+import pytest
+
+from hsc.skyIndex import SkyIndex
+from hsc.region import Cone, Box, Polygon
+from hsc.healpix import radecToHealpix
+from hsc.catalogIO import writeCatalog
+
+
+@pytest.fixture
+def shards(tmpdir):
+    """Write shards of random positions at nside=2, returning the root name and the positions"""
+    rng = numpy.random.RandomState(3)
+    num = 20000
+    ra = rng.uniform(0, 360, num)
+    dec = numpy.degrees(numpy.arcsin(rng.uniform(-1, 1, num)))
+    ident = numpy.arange(num, dtype=numpy.int64)
+    root = str(tmpdir.join("test"))
+    healpix = radecToHealpix(ra, dec, 2)
+    for hp in numpy.unique(healpix):
+        select = healpix == hp
+        writeCatalog("%s_hp_%d.fits" % (root, hp), dict(id="K", ra="D", dec="D"),
+                     dict(id=ident[select], ra=ra[select], dec=dec[select]))
+    return root, ra, dec
+
+
+@pytest.mark.parametrize("region", [Cone(30, 20, 10), Cone(0, -89, 3), Box(350, 20, -15, 15),
+                                    Polygon([(100, 0), (130, 5), (120, 30)])])
+def testQuery(shards, region):
+    """A query finds exactly the sources in the region"""
+    root, ra, dec = shards
+    SkyIndex.build(root, nside=2, fineFactor=8)
+    index = SkyIndex.read(root)
+    result = index.query(region, columns=["id"])
+    assert sorted(result["id"].tolist()) == numpy.flatnonzero(region.contains(ra, dec)).tolist()
+    assert len(index.checked) < len(index.shards)
+
+
+def testChanged(shards):
+    """Only the shards queried are checked for changes"""
+    root, ra, dec = shards
+    SkyIndex.build(root, nside=2, fineFactor=8)
+    changed = "%s_hp_%d.fits" % (root, radecToHealpix([0.0], [0.0], 2)[0])
+    with open(changed, "ab") as f:
+        f.write("\0"*2880)
+    index = SkyIndex.read(root)
+    index.query(Cone(180, 0, 1))
+    with pytest.raises(RuntimeError):
+        index.query(Cone(0, 0, 1))
@@ -0,0 +1,94 @@
+import numpy
+import pyfits
+import pytest
+
+from hsc.wcs import TanWcs
+from hsc.benchmark import calculateRaDecOriginal
+
+SIZE = 6400
+SCALE = 0.25/3600 # degrees/pixel
+
+
+def makeHeader(crval1, crval2, form, angle=0.0):
+    """Make a header for a TAN projection with PS1 MD skycell scales, in one of the header forms
+
+    'angle' (degrees) rotates the pixel axes, through the off-diagonal terms.
+    """
+    cos, sin = numpy.cos(numpy.radians(angle)), numpy.sin(numpy.radians(angle))
+    cdelt = numpy.array([-SCALE, SCALE])
+    pc = numpy.array([[cos, -sin], [sin, cos]])
+    header = pyfits.Header()
+    for key, value in (("CRVAL1", crval1), ("CRVAL2", crval2), ("CRPIX1", 0.5*SIZE), ("CRPIX2", 0.5*SIZE)):
+        header[key] = value
+    for i in (1, 2):
+        for j in (1, 2):
+            if form == "CD":
+                header["CD%d_%d" % (i, j)] = cdelt[i - 1]*pc[i - 1, j - 1]
+            elif form == "PC":
+                header["PC%d_%d" % (i, j)] = pc[i - 1, j - 1]
+            elif form == "PS1":
+                header["PC%03d%03d" % (i, j)] = pc[i - 1, j - 1]
+    if form != "CD":
+        header["CDELT1"], header["CDELT2"] = cdelt
+    return header
+
+
+def getReference(crval1, crval2, x, y, angle=0.0):
+    """Deproject with the original (diagonal only) code, rotating the pixel offsets ourselves"""
+    cos, sin = numpy.cos(numpy.radians(angle)), numpy.sin(numpy.radians(angle))
+    dx, dy = x - 0.5*SIZE, y - 0.5*SIZE
+    x, y = 0.5*SIZE + cos*dx - sin*dy, 0.5*SIZE + sin*dx + cos*dy
+    return calculateRaDecOriginal(makeHeader(crval1, crval2, "PS1"), x, y)
+
+
+def makePixels(num=100000, seed=0):
+    rng = numpy.random.RandomState(seed)
+    return rng.uniform(0, SIZE, num), rng.uniform(0, SIZE, num)
+
+
+def assertSameSky(ra, dec, refRa, refDec, tolerance=1.0e-5):
+    """Positions agree to within 'tolerance' arcsec, allowing for the RA wrap
+
+    The tolerance allows for arcsin losing precision near the poles.
+    """
+    dRa = numpy.remainder(ra - refRa + 180.0, 360.0) - 180.0
+    assert numpy.all(numpy.abs(dRa*numpy.cos(numpy.radians(dec)))*3600 < tolerance)
+    assert numpy.all(numpy.abs(dec - refDec)*3600 < tolerance)
+
+
+@pytest.mark.parametrize("form", ["CD", "PC", "PS1"])
+@pytest.mark.parametrize("crval1, crval2", [(150.0, 2.2), (0.1, -5.0), (359.95, 30.0), (36.0, -89.9)])
+@pytest.mark.parametrize("angle", [0.0, 30.0])
+def testHeaderForms(form, crval1, crval2, angle):
+    """Each header form gives the original deprojection, with RA in [0, 360)"""
+    x, y = makePixels()
+    ra, dec = TanWcs.fromHeader(makeHeader(crval1, crval2, form, angle)).pixelToSky(x, y)
+    assert numpy.all((ra >= 0.0) & (ra < 360.0))
+    assertSameSky(ra, dec, *getReference(crval1, crval2, x, y, angle))
+
+
+def testCrossesZero():
+    """A field straddling RA=0 has positions on both sides, wrapped into [0, 360)"""
+    x, y = makePixels()
+    ra, dec = TanWcs.fromHeader(makeHeader(0.1, 0.0, "PS1")).pixelToSky(x, y)
+    assert numpy.any(ra < 1.0) and numpy.any(ra > 359.0)
+    assert numpy.all((ra >= 0.0) & (ra < 360.0))
+
+
+def testChunks():
+    """Chunking and threading give the same positions, for either input type"""
+    x, y = makePixels(12345)
+    wcs = TanWcs.fromHeader(makeHeader(150.0, 2.2, "CD", 10.0))
+    ra, dec = wcs.pixelToSky(x, y, chunkRows=0)
+    for kwargs in (dict(chunkRows=1000), dict(chunkRows=1000, threads=4), dict(chunkRows=100000, threads=4)):
+        chunkRa, chunkDec = wcs.pixelToSky(x, y, **kwargs)
+        assert numpy.array_equal(chunkRa, ra) and numpy.array_equal(chunkDec, dec)
+    x32, y32 = x.astype(numpy.float32), y.astype(numpy.float32)
+    ra32, dec32 = wcs.pixelToSky(x32, y32, chunkRows=1000, threads=3)
+    assert numpy.array_equal((ra32, dec32), wcs.pixelToSky(x32.astype(numpy.float64), y32.astype(numpy.float64)))
+    assert wcs.pixelToSky([], [])[0].shape == (0,)
+
+
+def testShapeMismatch():
+    with pytest.raises(RuntimeError):
+        TanWcs.fromHeader(makeHeader(150.0, 2.2, "CD")).pixelToSky(numpy.zeros(3), numpy.zeros(4))
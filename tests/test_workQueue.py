@@ -0,0 +1,109 @@
+import os
+import glob
+import time
+import signal
+import operator
+import multiprocessing
+
+import numpy
+import pyfits
+import pytest
+
+from hsc import ps1db
+from hsc.benchmark import makePsps
+from hsc.workQueue import WorkQueue, QueueExecutor, QueueScheduler, runWorker
+
+
+@pytest.fixture
+def queue(tmpdir):
+    """A queue with two local workers, closed at the end"""
+    queue = WorkQueue(str(tmpdir.join("queue")), leaseTime=5.0, heartbeat=0.2, maxAttempts=2, interval=0.05)
+    queue.reset()
+    queue.startWorkers(2)
+    yield queue
+    queue.close()
+
+
+def fail(message):
+    raise RuntimeError(message)
+
+
+def testExecutor(queue):
+    executor = QueueExecutor(queue)
+    assert executor.map(operator.add, [(i, 10) for i in range(20)]) == [i + 10 for i in range(20)]
+    results = executor.map(operator.mul, [(3, 4)], measure=True)
+    assert results[0][0] == 12 and results[0][1]["wall"] >= 0
+    with pytest.raises(RuntimeError):
+        executor.map(fail, [("bad",)])
+
+
+def testScheduler(queue, tmpdir):
+    """Commands run after their dependencies, and those depending on a failure are skipped"""
+    output = str(tmpdir.join("output"))
+    scheduler = QueueScheduler(queue)
+    scheduler.addCommand("first", ["sh", "-c", "echo first >> %s" % output])
+    scheduler.addCommand("second", ["sh", "-c", "echo second >> %s" % output], depends=["first"])
+    scheduler.addCommand("bad", ["sh", "-c", "exit 3"], depends=["first"])
+    scheduler.addCommand("skipped", ["sh", "-c", "echo skipped >> %s" % output], depends=["bad"])
+    scheduler.add("python", operator.add, (1, 2))
+    with pytest.raises(RuntimeError):
+        scheduler.run()
+    assert open(output).read().split() == ["first", "second"]
+    assert scheduler.tasks["second"].result.returncode == 0
+    assert scheduler.tasks["bad"].result.returncode == 3
+    assert scheduler.tasks["skipped"].error == "Dependency failed"
+    assert scheduler.tasks["python"].result == 3
+
+
+def testExpiredLease(tmpdir):
+    """A task whose worker dies is run by another, until it's been tried 'maxAttempts' times"""
+    queue = WorkQueue(str(tmpdir.join("queue")), leaseTime=1.0, heartbeat=0.2, maxAttempts=2, interval=0.05)
+    queue.reset()
+    queue.submit([("0001-000000", dict(func="time:sleep", args=[2], depends=[])),
+                  ("0001-000001", dict(func="operator:add", args=[1, 2], depends=["0001-000000"]))])
+
+    def killWorker(attempt=1):
+        """Start a worker, and kill it once it has leased the task"""
+        worker = multiprocessing.Process(target=runWorker, args=(queue.directory,))
+        worker.start()
+        while (queue.getLease("0001-000000") or {}).get("attempt") != attempt:
+            time.sleep(0.05)
+        os.kill(worker.pid, signal.SIGKILL)
+        worker.join()
+
+    killWorker()
+    queue.startWorkers(1)
+    results = dict(queue.wait(["0001-000000", "0001-000001"]))
+    queue.close()
+    assert results["0001-000000"]["error"] is None and results["0001-000000"]["attempt"] == 2
+    assert results["0001-000001"]["result"] == 3
+
+    queue.reset()
+    queue.submit([("0001-000000", dict(func="time:sleep", args=[2], depends=[]))])
+    killWorker()
+    killWorker(2) # Takes over the expired lease
+    queue.startWorkers(1)
+    results = dict(queue.wait(["0001-000000"]))
+    queue.close()
+    assert "expired" in results["0001-000000"]["error"]
+
+
+def testBuildPS1(tmpdir):
+    """Building with a queue gives the same shards as without"""
+    inputs = []
+    for i in range(3):
+        inputs.append(str(tmpdir.join("psps_%d.fits" % i)))
+        makePsps(20000, seed=i).writeto(inputs[-1])
+    shards = {}
+    for name, kwargs in (("local", dict(threads=0)), ("queue", dict(queue=str(tmpdir.join("queue")), workers=2))):
+        build = ps1db.BuildPS1(inputs, str(tmpdir.join(name)), nside=4, chunkRows=5000, **kwargs)
+        build.scales = [] # No build-astrometry-index here
+        build.run()
+        shards[name] = dict((os.path.basename(fn).replace(name, ""), pyfits.getdata(fn)) for
+                            fn in glob.glob(str(tmpdir.join(name + "_hp_*.fits"))))
+    assert len(shards["local"]) > 1 and sorted(shards["local"]) == sorted(shards["queue"])
+    for shard, local in shards["local"].items():
+        queued = shards["queue"][shard]
+        assert len(local) == len(queued)
+        for col in local.names:
+            assert numpy.array_equal(numpy.nan_to_num(local.field(col)), numpy.nan_to_num(queued.field(col))), col